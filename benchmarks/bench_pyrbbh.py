@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+#
+# bench_pyrbbh.py
+#
+# This code is part of the pyrbbh package, and is governed by its licence.
+# Please see the LICENSE file that should have been included as part of this
+# package.
+
+"""Offline benchmarks for pyrbbh.
+
+Times job graph construction (blast.make_blast_jobs), graph levelling
+(mp.create_cmdsets), local scheduler dispatch overhead (aio, with stub
+commands in place of BLAST) and hit table parsing/RBH calling
+(rbh.call_rbh, and rbh.sweep_rbh over a grid of thresholds, with hit
+tables read as text or as memory-mapped binary tables), on synthetic
+proteome sets and synthetic BLASTP tabular output. Nothing is downloaded
+and no BLAST executables are needed, so results can be compared across
+releases on the same machine.
+
+    python benchmarks/bench_pyrbbh.py [--genomes 10 100 1000] [--json out]
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from pyrbbh import aio, blast, hittable, io, jobs, mp, rbh
+
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+
+# Grid of (identity, coverage) thresholds for the RBH sweep benchmark
+SWEEP_GRID = [(identity, coverage) for identity in (0.3, 0.5, 0.7, 0.9) for
+              coverage in (0.5, 0.7, 0.9)]
+
+
+# Write a set of synthetic proteome FASTA files
+def write_proteomes(outdir, ngenomes, nproteins=20, length=300, seed=0):
+    """Writes ngenomes FASTA files of random protein sequences to outdir,
+    returning the list of paths, as found by io.get_fasta_files().
+
+    - outdir - path to directory for FASTA files
+    - ngenomes - number of proteomes
+    - nproteins - number of proteins per proteome
+    - length - length of each protein
+    - seed - random seed
+    """
+    rng = random.Random(seed)
+    for gidx in range(ngenomes):
+        with open(os.path.join(outdir, "genome%06d.fasta" % gidx), 'w') as ofh:
+            for pidx in range(nproteins):
+                seq = ''.join(rng.choice(AMINO_ACIDS) for idx in range(length))
+                ofh.write(">g%06d_p%06d\n%s\n" % (gidx, pidx, seq))
+    return io.get_fasta_files(outdir)
+
+
+# Write a synthetic BLASTP tabular output file
+def write_hit_table(filename, nqueries, hits_per_query, qprefix, sprefix,
+                    seed=0):
+    """Writes a synthetic BLASTP tabular output file with hits_per_query
+    HSPs for each of nqueries queries, in the column order of
+    blast.BLASTP_COLUMNS.
+
+    - filename - path to output file
+    - nqueries - number of query sequences
+    - hits_per_query - number of HSPs per query
+    - qprefix - prefix for query sequence IDs
+    - sprefix - prefix for subject sequence IDs
+    - seed - random seed
+    """
+    rng = np.random.default_rng(seed)
+    nrows = nqueries * hits_per_query
+    qidx = np.repeat(np.arange(nqueries), hits_per_query)
+    sidx = rng.integers(0, nqueries, nrows)
+    sidx[::hits_per_query] = qidx[::hits_per_query]  # a likely best hit
+    length = rng.integers(50, 500, nrows)
+    nident = (length * rng.uniform(0.3, 1.0, nrows)).astype(int)
+    pd.DataFrame({'qseqid': np.char.add(qprefix, qidx.astype(str)),
+                  'sseqid': np.char.add(sprefix, sidx.astype(str)),
+                  'qlen': length, 'slen': length,
+                  'bitscore': rng.uniform(20, 1000, nrows).round(1),
+                  'length': length, 'nident': nident,
+                  'pident': (100.0 * nident / length).round(3),
+                  'qcovhsp': rng.integers(50, 101, nrows),
+                  'qcovs': rng.integers(50, 101, nrows),
+                  'qstart': 1, 'qend': length, 'sstart': 1, 'send': length},
+                 columns=blast.BLASTP_COLUMNS).to_csv(filename, sep='\t',
+                                                      header=False,
+                                                      index=False)
+
+
+# Time a function call, keeping the best of several repeats
+def best_time(func, repeats):
+    """Returns a tuple of (best time in seconds, last return value) from
+    calling func repeats times.
+
+    - func - function taking no arguments
+    - repeats - number of calls
+    """
+    times, retval = [], None
+    for idx in range(repeats):
+        t0 = time.perf_counter()
+        retval = func()
+        times.append(time.perf_counter() - t0)
+    return min(times), retval
+
+
+# Benchmark job graph construction and levelling
+def bench_job_graph(tmpdir, genome_counts, repeats):
+    """Returns benchmark results for blast.make_blast_jobs() and
+    mp.create_cmdsets() on synthetic proteome sets of each size in
+    genome_counts.
+
+    - tmpdir - path to scratch directory
+    - genome_counts - list of numbers of genomes
+    - repeats - number of repeats of each timing
+    """
+    results = []
+    for ngenomes in genome_counts:
+        indir = os.path.join(tmpdir, "genomes_%d" % ngenomes)
+        os.makedirs(indir)
+        infiles = write_proteomes(indir, ngenomes)
+        outdir = os.path.join(tmpdir, "output_%d" % ngenomes)
+        elapsed, jobgraph = best_time(lambda: blast.make_blast_jobs(
+            infiles, outdir, jobprefix='BENCH'), repeats)
+        results.append({'benchmark': 'make_blast_jobs', 'size': ngenomes,
+                        'jobs': len(jobgraph), 'seconds': elapsed})
+        elapsed, cmdsets = best_time(lambda: mp.create_cmdsets(jobgraph),
+                                     repeats)
+        results.append({'benchmark': 'create_cmdsets', 'size': ngenomes,
+                        'jobs': len(jobgraph), 'seconds': elapsed})
+        shutil.rmtree(indir)
+    return results
+
+
+# Benchmark local scheduler dispatch overhead with stub commands
+def bench_dispatch(job_counts, cores, repeats):
+    """Returns benchmark results for aio.run_dependency_graph() running
+    graphs of stub commands (':', the shell no-op) shaped like RBBH runs,
+    with one database job for every ten query jobs.
+
+    - job_counts - list of numbers of query jobs
+    - cores - core budget for the scheduler
+    - repeats - number of repeats of each timing
+    """
+    results = []
+    for njobs in job_counts:
+        def run():
+            dbjobs = [jobs.Job("db_%06d" % idx, ':') for idx in
+                      range(max(1, njobs // 10))]
+            queryjobs = []
+            for idx in range(njobs):
+                job = jobs.Job("query_%06d" % idx, ':')
+                job.add_dependency(dbjobs[idx % len(dbjobs)])
+                queryjobs.append(job)
+            return aio.run_dependency_graph(dbjobs + queryjobs, cores)
+        elapsed, retvals = best_time(run, repeats)
+        results.append({'benchmark': 'aio_dispatch', 'size': njobs,
+                        'jobs': len(retvals), 'seconds': elapsed,
+                        'per_job_ms': 1000 * elapsed / len(retvals)})
+    return results
+
+
+# Benchmark hit table parsing and RBH calling
+def bench_rbh(tmpdir, query_counts, hits_per_query, repeats):
+    """Returns benchmark results for rbh.read_hits() and rbh.call_rbh() on
+    pairs of synthetic hit tables with the passed numbers of queries, as
+    text and as binary hit tables (see hittable).
+
+    - tmpdir - path to scratch directory
+    - query_counts - list of numbers of queries per genome
+    - hits_per_query - number of HSPs per query
+    - repeats - number of repeats of each timing
+    """
+    results = []
+    for nqueries in query_counts:
+        fwdfile = os.path.join(tmpdir, "a_vs_b_%d.tab" % nqueries)
+        revfile = os.path.join(tmpdir, "b_vs_a_%d.tab" % nqueries)
+        write_hit_table(fwdfile, nqueries, hits_per_query, 'a', 'b', 1)
+        write_hit_table(revfile, nqueries, hits_per_query, 'b', 'a', 2)
+        nrows = nqueries * hits_per_query
+        elapsed, hits = best_time(lambda: rbh.read_hits(fwdfile), repeats)
+        results.append({'benchmark': 'read_hits', 'size': nrows,
+                        'seconds': elapsed})
+        binfiles = [os.path.splitext(fname)[0] + blast.HITTABLE_EXT for
+                    fname in (fwdfile, revfile)]
+        for fname, binfile in zip((fwdfile, revfile), binfiles):
+            hittable.write_hits(rbh.read_hits(fname), binfile)
+        elapsed, hits = best_time(lambda: rbh.read_hits(binfiles[0]),
+                                  repeats)
+        results.append({'benchmark': 'read_hits_binary', 'size': nrows,
+                        'seconds': elapsed})
+        elapsed, rbhits = best_time(lambda: rbh.call_rbh(*binfiles, 0.3, 0.5),
+                                    repeats)
+        results.append({'benchmark': 'call_rbh_binary', 'size': 2 * nrows,
+                        'rbh': len(rbhits), 'seconds': elapsed})
+        elapsed, rbhits = best_time(lambda: rbh.call_rbh(fwdfile, revfile,
+                                                         0.3, 0.5), repeats)
+        results.append({'benchmark': 'call_rbh', 'size': 2 * nrows,
+                        'rbh': len(rbhits), 'seconds': elapsed})
+        elapsed, sweep = best_time(lambda: rbh.sweep_rbh(
+            rbh.read_hits(fwdfile), rbh.read_hits(revfile), SWEEP_GRID),
+                                   repeats)
+        results.append({'benchmark': 'sweep_rbh', 'size': 2 * nrows,
+                        'thresholds': len(SWEEP_GRID), 'rbh': len(sweep),
+                        'seconds': elapsed})
+    return results
+
+
+# Process command-line arguments
+def parse_cmdline(args):
+    """Parse command-line arguments for the benchmarks.
+
+    - args - list of command-line arguments
+    """
+    parser = argparse.ArgumentParser(description="pyrbbh offline benchmarks")
+    parser.add_argument('--genomes', dest='genomes', nargs='+', type=int,
+                        default=[10, 100, 500],
+                        help='Numbers of genomes for job graph benchmarks')
+    parser.add_argument('--dispatch', dest='dispatch', nargs='+', type=int,
+                        default=[100, 1000],
+                        help='Numbers of stub jobs for dispatch benchmarks')
+    parser.add_argument('--queries', dest='queries', nargs='+', type=int,
+                        default=[1000, 10000, 100000],
+                        help='Numbers of queries for RBH benchmarks')
+    parser.add_argument('--hits', dest='hits', type=int, default=10,
+                        help='HSPs per query in synthetic hit tables')
+    parser.add_argument('--cores', dest='cores', type=int, default=None,
+                        help='Core budget for dispatch benchmarks')
+    parser.add_argument('--repeats', dest='repeats', type=int, default=3,
+                        help='Repeats of each timing (best is kept)')
+    parser.add_argument('--json', dest='json', default=None,
+                        help='Path to write results as JSON')
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    args = parse_cmdline(sys.argv[1:])
+    tmpdir = tempfile.mkdtemp(prefix='pyrbbh_bench_')
+    try:
+        results = bench_job_graph(tmpdir, args.genomes, args.repeats)
+        results += bench_dispatch(args.dispatch, args.cores, args.repeats)
+        results += bench_rbh(tmpdir, args.queries, args.hits, args.repeats)
+    finally:
+        shutil.rmtree(tmpdir)
+    for result in results:
+        print("%-16s %10d %10.4fs" % (result['benchmark'], result['size'],
+                                      result['seconds']))
+    if args.json is not None:
+        with open(args.json, 'w') as ofh:
+            json.dump(results, ofh, indent=2)
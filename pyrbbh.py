@@ -1,12 +1,18 @@
 #!/usr/bin/env python
 
 import argparse
+import itertools
 import logging
 import os
+import secrets
+import socket
 import sys
 import time
 
-from pyrbbh import blast, config, io, mp
+import pandas as pd
+
+from pyrbbh import (aio, blast, cache, config, costs, dedup, engines, io,
+                    mcl, plan, rbh, report, seqindex, sge, store, workqueue)
 
 class PyRBBH(object):
     """pyrbbh module script"""
@@ -19,6 +25,8 @@ The most commonly used commands are:
     rbvh        Reciprocal best VSEARCH
     mclb        MCL clustering from best BLASTP
     mclv        MCL clustering from best VSEARCH
+    worker      Run jobs for a coordinator (-s queue) on another host
+    plan        Write the rbbh job graph for make, Snakemake or as JSON
 """
         # set up parser for common arguments
         parser = argparse.ArgumentParser(prog="pyrbbh.py",
@@ -51,22 +59,240 @@ The most commonly used commands are:
         self._parser.add_argument('-f', '--force', dest='force',
                                   action='store_true', default=False,
                                   help='Force output overwrite')
+        self._parser.add_argument('-r', '--resume', dest='resume',
+                                  action='store_true', default=False,
+                                  help='Reuse completed output, only run ' +
+                                  'new or changed jobs')
         self._parser.add_argument('-s', '--scheduler', dest='scheduler',
                                   action='store', default='mp',
-                                  type=str, choices=['mp', 'SGE'],
+                                  type=str, choices=['mp', 'SGE', 'queue'],
                                   help='Scheduler')
+        self._parser.add_argument('-n', '--cores', dest='cores',
+                                  action='store', default=None, type=int,
+                                  help='Number of cores to use (mp only)')
+        self._parser.add_argument('--qsub_exe', dest='qsub_exe',
+                                  action='store',
+                                  default=config.QSUB_DEFAULT,
+                                  help='Path to qsub executable (SGE only)')
+        self._parser.add_argument('--qstat_exe', dest='qstat_exe',
+                                  action='store',
+                                  default=config.QSTAT_DEFAULT,
+                                  help='Path to qstat executable (SGE only)')
+        self._parser.add_argument('--queue_host', dest='queue_host',
+                                  action='store', default=None,
+                                  help='Address to serve jobs to workers ' +
+                                  'on (queue only; default: all)')
+        self._parser.add_argument('--queue_port', dest='queue_port',
+                                  action='store', default=config.QUEUE_PORT,
+                                  type=int,
+                                  help='Port to serve jobs to workers on ' +
+                                  '(queue only)')
+        self._parser.add_argument('--queue_token', dest='queue_token',
+                                  action='store',
+                                  default=os.environ.get('PYRBBH_QUEUE_TOKEN'),
+                                  help='Token workers must present ' +
+                                  '(queue only; default: ' +
+                                  '$PYRBBH_QUEUE_TOKEN, or random)')
+        self._parser.add_argument('--retries', dest='retries',
+                                  action='store', default=config.RETRIES,
+                                  type=int,
+                                  help='Times to retry a failed job, with ' +
+                                  'backoff (mp and queue only)')
+        self._parser.add_argument('--fail_fast', dest='fail_fast',
+                                  action='store_true', default=False,
+                                  help='Start no new jobs after a job ' +
+                                  'fails (default: run every job not ' +
+                                  'depending on the failure)')
+        self._parser.add_argument('--cost_file', dest='cost_file',
+                                  action='store', default=None,
+                                  help='Path to job timings from earlier ' +
+                                  'runs, used to order jobs (default: in ' +
+                                  'output directory)')
 
 
     def rbbh(self):
         "Conduct reciprocal best BLAST hit analysis"
         # Parse arguments
         self.__build_common_parser(description="Reciprocal best BLASTP")
+        self.__add_search_arguments()
+        self.__add_blastp_arguments()
+        self._args = self._parser.parse_args(sys.argv[2:])
+
+        # Run BLAST jobs, calling reciprocal best hits for each pair
+        self.__run_searches()
+
+
+    def rbvh(self):
+        "Conduct reciprocal best VSEARCH hit analysis"
+        # Parse arguments
+        self.__build_common_parser(description="Reciprocal best VSEARCH")
+        self.__add_search_arguments()
+        self.__add_vsearch_arguments()
+        self._args = self._parser.parse_args(sys.argv[2:])
+
+        # Run VSEARCH jobs, calling reciprocal best hits for each pair
+        self.__run_searches()
+
+
+    def mclb(self):
+        "Conduct MCL clustering of best BLAST hits"
+        # Parse arguments
+        self.__build_common_parser(description="MCL clustering from best " +
+                                   "BLASTP")
+        self.__add_search_arguments()
+        self.__add_blastp_arguments()
+        self.__add_mcl_arguments()
+        self._args = self._parser.parse_args(sys.argv[2:])
+
+        # Run BLAST jobs, collecting best hits for each pair
+        self.__run_searches()
+
+        # Cluster sequences by MCL of best hits
+        self.__cluster_mcl('mclb')
+
+
+    def mclv(self):
+        "Conduct MCL clustering of best VSEARCH hits"
+        # Parse arguments
+        self.__build_common_parser(description="MCL clustering from best " +
+                                   "VSEARCH")
+        self.__add_search_arguments()
+        self.__add_vsearch_arguments()
+        self.__add_mcl_arguments()
+        self._args = self._parser.parse_args(sys.argv[2:])
+
+        # Run VSEARCH jobs, collecting best hits for each pair
+        self.__run_searches()
+
+        # Cluster sequences by MCL of best hits
+        self.__cluster_mcl('mclv')
+
+
+    def plan(self):
+        "Write the reciprocal best BLAST hit job graph, without running it"
+        # Parse arguments
+        self.__build_common_parser(description="Plan reciprocal best " +
+                                   "BLASTP")
+        self.__add_search_arguments()
+        self.__add_blastp_arguments()
+        self.__add_plan_arguments()
+        self._args = self._parser.parse_args(sys.argv[2:])
+        if self._args.dedup:
+            self._parser.error("--dedup cannot be planned, as its " +
+                               "reciprocal best hits are not called by jobs")
+
+        # Build the BLAST and RBH calling jobs, and write them out
+        self.__plan_searches()
+
+
+    def worker(self):
+        "Run jobs sent by a pyrbbh coordinator"
+        # Parse arguments
+        self._parser = argparse.ArgumentParser(description="Work queue " +
+                                               "worker")
+        self._parser.add_argument('address', action='store',
+                                  help='Coordinator address, HOST:PORT')
+        self._parser.add_argument('-v', '--verbose', dest='verbose',
+                                  action='store_true', default=False,
+                                  help='Give verbose output')
+        self._parser.add_argument('-l', '--logfile', dest='logfile',
+                                  action='store', default=None,
+                                  help='Path to logfile')
+        self._parser.add_argument('-n', '--cores', dest='cores',
+                                  action='store', default=None, type=int,
+                                  help='Number of cores to offer')
+        self._parser.add_argument('--name', dest='name', action='store',
+                                  default=None,
+                                  help='Worker name (default: host name)')
+        self._parser.add_argument('--token', dest='token', action='store',
+                                  default=os.environ.get('PYRBBH_QUEUE_TOKEN'),
+                                  help='Token shared with the coordinator ' +
+                                  '(default: $PYRBBH_QUEUE_TOKEN)')
+        self._parser.add_argument('--wait', dest='wait', action='store',
+                                  default=config.QUEUE_TIMEOUT, type=float,
+                                  help='Seconds to keep trying to connect')
+        self._args = self._parser.parse_args(sys.argv[2:])
+        self.__start_logger()
+        if self._args.token is None:
+            self._logger.error("No token given (exiting)")
+            sys.exit(1)
+
+        # Run jobs until the coordinator says to stop
+        count = workqueue.run_worker(self._args.address, self._args.token,
+                                     self._args.cores, self._args.name,
+                                     self._args.wait, self._logger)
+        if count is None:
+            sys.exit(1)
+
+
+    def __add_search_arguments(self):
+        """Add arguments for searches and best hit calling to the parser."""
         self._parser.add_argument('-p', '--pid', dest='identity',
-                                  action='store', default=0.8,
+                                  action='store', default=0.8, type=float,
                                   help='Percentage identity threshold')
         self._parser.add_argument('-c', '--cov', dest='coverage',
-                                  action='store', default=0.8,
+                                  action='store', default=0.8, type=float,
                                   help='Percentage coverage threshold')
+        self._parser.add_argument('--sweep_pid', dest='sweep_identity',
+                                  action='store', nargs='+', default=None,
+                                  type=float,
+                                  help='Percentage identity thresholds to ' +
+                                  'sweep, with each --sweep_cov threshold')
+        self._parser.add_argument('--sweep_cov', dest='sweep_coverage',
+                                  action='store', nargs='+', default=None,
+                                  type=float,
+                                  help='Percentage coverage thresholds to ' +
+                                  'sweep, with each --sweep_pid threshold')
+        self._parser.add_argument('--jobprefix', dest='jobprefix',
+                                  action='store',
+                                  default="PyRBBH_%s" % str(int(time.time())),
+                                  help='Prefix for jobs in this run')
+        self._parser.add_argument('--stream', dest='stream',
+                                  action='store_true', default=False,
+                                  help='Keep only compressed best hits from ' +
+                                  'BLASTP output')
+        self._parser.add_argument('--binary_hits', dest='binary_hits',
+                                  action='store_true', default=False,
+                                  help='Write search output as binary, ' +
+                                  'memory-mapped hit tables')
+        self._parser.add_argument('--allvsall', dest='allvsall',
+                                  action='store_true', default=False,
+                                  help='Search each genome against a single ' +
+                                  'combined database (see ' +
+                                  '--targets_per_genome)')
+        self._parser.add_argument('--shard_size', dest='shard_size',
+                                  action='store', default=None, type=int,
+                                  help='Split queries into shards of at ' +
+                                  'most this many residues')
+        self._parser.add_argument('--dedup', dest='dedup',
+                                  action='store_true', default=False,
+                                  help='Search only one copy of each ' +
+                                  'identical sequence (see ' +
+                                  '--targets_per_genome)')
+        self._parser.add_argument('--targets_per_genome',
+                                  dest='targets_per_genome', action='store',
+                                  default=blast.ALLVSALL_TARGETS_PER_GENOME,
+                                  type=int,
+                                  help='With --allvsall or --dedup, each ' +
+                                  'query reports at most this many hits ' +
+                                  'times the number of genomes; a best ' +
+                                  'hit in one genome ranked below that ' +
+                                  'many hits in others (e.g. paralogs) ' +
+                                  'is missed')
+        self._parser.add_argument('--lazy', dest='lazy',
+                                  action='store_true', default=False,
+                                  help='Generate jobs as they are run, ' +
+                                  'without a run report (mp only)')
+
+
+    def __add_blastp_arguments(self):
+        """Add arguments choosing and locating a protein search engine to the
+        parser.
+        """
+        self._parser.add_argument('--engine', dest='engine',
+                                  action='store', default='blast',
+                                  choices=['blast', 'diamond'],
+                                  help='Protein search engine')
         self._parser.add_argument('--blastp_exe', dest='blastp_exe',
                                   action='store',
                                   default=config.BLASTP_DEFAULT,
@@ -75,28 +301,158 @@ The most commonly used commands are:
                                   action='store',
                                   default=config.BLASTDB_DEFAULT,
                                   help='Path to makeblastdb executable')
-        self._parser.add_argument('--jobprefix', dest='jobprefix',
+        self._parser.add_argument('--diamond_exe', dest='diamond_exe',
                                   action='store',
-                                  default="PyRBBH_%s" % str(int(time.time())),
-                                  help='Prefix for jobs in this run')
-        self._args = self._parser.parse_args(sys.argv[2:])
-        
+                                  default=config.DIAMOND_DEFAULT,
+                                  help='Path to DIAMOND executable')
+
+
+    def __add_vsearch_arguments(self):
+        """Add arguments locating VSEARCH to the parser."""
+        self._parser.add_argument('--vsearch_exe', dest='vsearch_exe',
+                                  action='store',
+                                  default=config.VSEARCH_DEFAULT,
+                                  help='Path to VSEARCH executable')
+        self._parser.set_defaults(engine='vsearch')
+
+
+    def __add_mcl_arguments(self):
+        """Add arguments for MCL clustering to the parser."""
+        self._parser.add_argument('-I', '--inflation', dest='inflation',
+                                  action='store', default=mcl.INFLATION,
+                                  type=float,
+                                  help='MCL inflation (higher values give ' +
+                                  'smaller clusters)')
+        self._parser.add_argument('--prune', dest='prune',
+                                  action='store',
+                                  default=mcl.PRUNE_THRESHOLD, type=float,
+                                  help='Smallest MCL matrix entry kept')
+        self._parser.add_argument('--max_entries', dest='max_entries',
+                                  action='store', default=mcl.MAX_ENTRIES,
+                                  type=int,
+                                  help='Most MCL matrix entries kept per ' +
+                                  'sequence')
+        self._parser.add_argument('--mcl_iterations', dest='mcl_iterations',
+                                  action='store',
+                                  default=mcl.MAX_ITERATIONS, type=int,
+                                  help='Most MCL iterations')
+
+
+    def __add_plan_arguments(self):
+        """Add arguments choosing the format and location of a plan to the
+        parser.
+        """
+        self._parser.add_argument('--format', dest='plan_format',
+                                  action='store', default='json',
+                                  choices=sorted(plan.PLAN_WRITERS),
+                                  help='Format of the job graph')
+        self._parser.add_argument('-o', '--planfile', dest='planfile',
+                                  action='store', default=None,
+                                  help='Path to write the job graph to ' +
+                                  '(default: in output directory)')
+
+
+    def __run_searches(self):
+        """Run searches of each pair of input files, and call best hits and
+        reciprocal best hits for each pair.
+        """
+        # Build the job graph
+        self.__prepare_searches()
+
+        # Despatch to appropriate method by scheduler
+        despatch = {'mp': self.__mp_run_rbbh,
+                    'SGE': self.__sge_run_rbbh,
+                    'queue': self.__queue_run_rbbh}
+        despatch[self._args.scheduler]()
+
+        # Call reciprocal best hits from deduplicated BLAST output
+        if self._args.dedup:
+            self.__call_dedup_rbbh()
+
+        # Count reciprocal best hits at each swept threshold
+        if self._thresholds:
+            self.__write_sweep_counts()
+
+
+    def __plan_searches(self):
+        """Write the job graph of searches of each pair of input files, and
+        of calling reciprocal best hits for each pair, for an external
+        executor, without running any job.
+        """
+        self.__prepare_searches()
+        if self._thresholds:
+            self._logger.warning("Planned jobs write a sweep table per " +
+                                 "pair, but not pyrbbh_sweep_counts.tab")
+        planfile = self._args.planfile or os.path.join(
+            self._args.outdirname, plan.PLAN_FILENAMES[self._args.plan_format])
+        count = plan.write_plan(self._jobs, planfile, self._args.outdirname,
+                                self._args.plan_format, self._costs.estimate)
+        self._logger.info("Wrote %d jobs to %s" % (count, planfile))
+
+
+    def __prepare_searches(self):
+        """Build the job graph of searches of each pair of input files, and
+        of calling best hits and reciprocal best hits for each pair, leaving
+        out jobs completed in an earlier run if resuming.
+        """
         # Set up logger
         self.__start_logger()
 
+        # Set the grid of thresholds to sweep, if any
+        self.__set_sweep()
+
         # Validate input/output locations
         self.__validate_paths()
 
         # Process input files
         self.__get_input_files()
 
-        # Get BLAST jobs
+        # Index input sequences
+        self.__index_input_files()
+
+        # Choose the search engine
+        self.__set_engine()
+
+        # Get search and RBH calling jobs
         self.__make_rbbh_jobs()
 
-        # Despatch to appropriate method by scheduler
-        despatch = {'mp': self.__mp_run_rbbh,
-                    'SGE': self.__sge_run_rbbh}
-        despatch[self._args.scheduler]()
+        # Skip jobs with results from an earlier run
+        self.__apply_cache()
+
+        # Estimate job run times, to start the longest first
+        self.__load_costs()
+
+
+    def __cluster_mcl(self, command):
+        """Cluster every input sequence by MCL of the best hits in the
+        results store, writing cluster membership to file.
+
+        - command        Name of the subcommand, naming the output file
+        """
+        self._logger.info("Clustering sequences by MCL (inflation %.2f)" %
+                          self._args.inflation)
+        t0 = time.time()
+        stems, seqids = [], []
+        for fname in self._infiles:
+            ids = self._indices[fname].ids
+            stems.append([os.path.splitext(os.path.split(fname)[-1])[0]] *
+                         len(ids))
+            seqids.append(ids)
+        nodes = pd.DataFrame({'genome': list(itertools.chain(*stems)),
+                              'seqid': list(itertools.chain(*seqids))})
+        outfile = os.path.join(self._args.outdirname,
+                               'pyrbbh_%s_clusters.tab' % command)
+        results = store.ResultStore(self._storefile)
+        nclusters = mcl.cluster_best_hits(results, nodes, outfile,
+                                          self._args.inflation,
+                                          self._args.prune,
+                                          self._args.max_entries,
+                                          self._args.mcl_iterations,
+                                          self._args.cores, self._logger)
+        results.close()
+        self._logger.info("Wrote %d clusters of %d sequences to %s" %
+                          (nclusters, len(nodes), outfile))
+        self._logger.info("Time to cluster: %.02fs" % (time.time() - t0))
 
 
     def __get_input_files(self):
@@ -107,52 +463,416 @@ The most commonly used commands are:
         self._logger.info("Found %d FASTA files" % len(self._infiles))
 
 
+    def __index_input_files(self):
+        """Index the sequences in each input FASTA file, reusing any index
+        from an earlier run if the file has not changed.
+        """
+        self._logger.info("Indexing input sequences")
+        self._indices = seqindex.index_fasta_files(self._infiles,
+                                                   self._args.outdirname,
+                                                   self._logger)
+
+
+    def __set_engine(self):
+        """Set the search engine running the searches, from --engine and the
+        paths to its executables.
+        """
+        if self._args.engine == 'blast':
+            self._engine = engines.get_engine('blast', self._args.blastp_exe,
+                                              self._args.blastdb_exe)
+        else:
+            exe = getattr(self._args, '%s_exe' % self._args.engine)
+            self._engine = engines.get_engine(self._args.engine, exe, exe)
+        self._logger.info("Searching with %s (%s)" % (self._engine.name,
+                                                      self._engine.search_exe))
+
+
+    def __set_sweep(self):
+        """Set the grid of (identity, coverage) thresholds at which
+        reciprocal best hits are called, besides --pid and --cov, from
+        --sweep_pid and --sweep_cov, each defaulting to the single value
+        of --pid or --cov.
+
+        Streamed and all-vs-all best-hit tables are reduced at --pid and
+        --cov as they are written, so a sweep needs full BLASTP output, and
+        is refused with --stream or --allvsall (unless --dedup, which
+        ignores them).
+        """
+        self._thresholds = None
+        if self._args.sweep_identity is None and \
+           self._args.sweep_coverage is None:
+            return
+        if (self._args.stream or self._args.allvsall) and \
+           not self._args.dedup:
+            self._parser.error("--sweep_pid and --sweep_cov need full " +
+                               "search output, so cannot be used with " +
+                               "--stream or --allvsall")
+        self._thresholds = list(itertools.product(
+            self._args.sweep_identity or [self._args.identity],
+            self._args.sweep_coverage or [self._args.coverage]))
+        self._logger.info("Sweeping %d thresholds: %s" %
+                          (len(self._thresholds),
+                           ", ".join("pid>=%.2f/cov>=%.2f" % point for point
+                                     in self._thresholds)))
+
+
     def __make_rbbh_jobs(self):
-        """Make dependency graph of RBBH BLAST jobs."""
-        self._logger.info("Creating BLAST jobs for RBBH")
+        """Make dependency graph of RBBH BLAST jobs.
+
+        Except with --dedup, where a single search serves every pair, each
+        pair's reciprocal best hits are called by a job in the graph that
+        runs once both of the pair's searches are done, and adds them to
+        the results store, so that they are called alongside the remaining
+        searches rather than after them all.
+
+        With --lazy, the pairwise jobs are not built here, but generated as
+        the local scheduler draws on them, so that memory use does not grow
+        with the square of the number of input files.
+
+        Under SGE or the work queue, RBH jobs run on other hosts, which
+        share the output directory over a network filesystem, so they do
+        not write to the results store themselves; each pair's results are
+        added to it here, as its job finishes (see __record_job()).
+        """
+        self._lazy = False
+        self._storefile = os.path.join(self._args.outdirname,
+                                       store.STORE_FILENAME)
+        storefile = self._storefile
+        self._storepairs = {}            # RBH output file -> genome pair
+        if self._args.scheduler != 'mp':
+            storefile = None
+            stems = [os.path.splitext(os.path.split(fname)[-1])[0] for
+                     fname in self._infiles]
+            self._storepairs = {
+                blast.get_rbh_outfile(stem1, stem2, self._args.outdirname):
+                (stem1, stem2) for idx, stem1 in enumerate(stems) for
+                stem2 in stems[idx+1:]}
+        if self._args.lazy and (self._args.allvsall or self._args.dedup or
+                                self._args.scheduler != 'mp'):
+            self._logger.warning("--lazy is ignored with --allvsall, " +
+                                 "--dedup or SGE/queue")
+        if self._args.dedup:
+            self._logger.info("Creating search jobs for unique sequences")
+            for option in ('allvsall', 'stream'):
+                if getattr(self._args, option):
+                    self._logger.warning("--%s is ignored with --dedup" %
+                                         option)
+            self._logger.info("Reporting at most %d hits per query " %
+                              (self._args.targets_per_genome *
+                               len(self._infiles)) +
+                              "(--targets_per_genome %d)" %
+                              self._args.targets_per_genome)
+            uniquefile, self._mapfile = dedup.deduplicate(
+                self._infiles, self._args.outdirname, self._logger)
+            self._jobs = blast.make_dedup_jobs(uniquefile,
+                                               len(self._infiles),
+                                               self._args.outdirname,
+                                               self._engine.search_exe,
+                                               self._engine.db_exe,
+                                               self._args.jobprefix,
+                                               self._args.shard_size,
+                                               self._engine,
+                                               self._args.binary_hits,
+                                               self._args.targets_per_genome)
+            self._logger.info("Created %d jobs" % len(self._jobs))
+            return
+        if self._args.allvsall:
+            self._logger.info("Creating all-vs-all search jobs for RBH")
+            if self._args.shard_size:
+                self._logger.warning("--shard_size is ignored with --allvsall")
+            targets = self._args.targets_per_genome
+            self._logger.info("Reporting at most %d hits per query " %
+                              (targets * len(self._infiles)) +
+                              "(--targets_per_genome %d)" % targets)
+            self._jobs = blast.make_allvsall_jobs(self._infiles,
+                                                  self._args.outdirname,
+                                                  self._engine.search_exe,
+                                                  self._engine.db_exe,
+                                                  self._args.jobprefix,
+                                                  self._args.identity,
+                                                  self._args.coverage,
+                                                  storefile,
+                                                  self._engine,
+                                                  self._args.binary_hits,
+                                                  targets)
+            self._logger.info("Created %d jobs" % len(self._jobs))
+            return
+        if self._args.lazy and self._args.scheduler == 'mp':
+            self._logger.info("Generating search jobs for RBH as they run")
+            self._lazy = True
+            self._jobs = blast.iter_blast_jobs(self._infiles,
+                                               self._args.outdirname,
+                                               self._engine.search_exe,
+                                               self._engine.db_exe,
+                                               self._args.jobprefix,
+                                               self._args.stream,
+                                               self._args.identity,
+                                               self._args.coverage,
+                                               self._args.shard_size,
+                                               self._indices,
+                                               storefile,
+                                               self._thresholds,
+                                               self._engine,
+                                               self._args.binary_hits)
+            return
+        self._logger.info("Creating search jobs for RBH")
         self._jobs = blast.make_blast_jobs(self._infiles,
                                            self._args.outdirname,
-                                           self._args.blastp_exe,
-                                           self._args.blastdb_exe,
-                                           self._args.jobprefix)
+                                           self._engine.search_exe,
+                                           self._engine.db_exe,
+                                           self._args.jobprefix,
+                                           self._args.stream,
+                                           self._args.identity,
+                                           self._args.coverage,
+                                           self._args.shard_size,
+                                           self._indices,
+                                           storefile,
+                                           self._thresholds,
+                                           self._engine,
+                                           self._args.binary_hits)
         self._logger.info("Created %d jobs" % len(self._jobs))
 
 
+    def __apply_cache(self):
+        """Remove jobs completed in an earlier run from the job graph, if
+        resuming.
+        """
+        self._cache = cache.JobCache(self._args.outdirname, self._engine)
+        if self._args.resume and not self._args.force:
+            self._logger.info("Checking %s for cached job results" %
+                              self._cache.cachedir)
+            if self._lazy:
+                self._jobs = cache.skip_completed(self._jobs, self._cache,
+                                                  self._logger)
+                return
+            self._jobs = cache.remove_completed(self._jobs, self._cache,
+                                                self._logger)
+            self._logger.info("%d jobs remain to be run" % len(self._jobs))
+
+
+    def __load_costs(self):
+        """Load timings of jobs from earlier runs into a model estimating the
+        run time of each job.
+        """
+        self._costfile = self._args.cost_file or \
+                         os.path.join(self._args.outdirname,
+                                      costs.COSTS_FILENAME)
+        self._costs = costs.CostModel(self._indices)
+        self._costs.load(self._costfile)
+        self._logger.info("Estimating job run times from %s" %
+                          (", ".join(sorted(self._costs.timings)) or
+                           "defaults"))
+
+
+    def __record_job(self, job, retval):
+        """Record a successfully completed job in the cache, and its timings
+        in the cost model, adding the results of an RBH job run on another
+        host to the results store.
+        """
+        if retval == 0:
+            if job.outputs and job.outputs[0] in self._storepairs:
+                self.__store_pair(job.outputs[0])
+            self._cache.record(job)
+            self._costs.update([job])
+
+
+    def __store_pair(self, rbhfile):
+        """Add the best hits and reciprocal best hits written by an RBH job
+        to the results store.
+
+        - rbhfile        Path to the reciprocal best hits of the pair
+        """
+        stem1, stem2 = self._storepairs[rbhfile]
+        fwdfile, revfile = blast.get_besthits_outfiles(stem1, stem2,
+                                                       self._args.outdirname)
+        results = store.ResultStore(self._storefile)
+        try:
+            results.add_pair(stem1, stem2, rbh.read_rbh(fwdfile),
+                             rbh.read_rbh(revfile), rbh.read_rbh(rbhfile))
+        finally:
+            results.close()
+
+
+    def __save_costs(self):
+        """Write job timings for use by later runs."""
+        self._costs.save(self._costfile)
+        self._logger.info("Wrote job timings to %s" % self._costfile)
+
+
+    def __write_report(self):
+        """Write JSON and CSV reports of per-job resource use."""
+        if self._lazy:
+            self._logger.info("No run report is written with --lazy")
+            return
+        outstem = os.path.join(self._args.outdirname, 'pyrbbh_report')
+        count = report.write_report(self._jobs, outstem, self._infiles,
+                                    self._args.resume and
+                                    not self._args.force)
+        self._logger.info("Wrote run report of %d jobs to %s.json/.csv" %
+                          (count, outstem))
+
+
+    def __call_dedup_rbbh(self):
+        """Call reciprocal best hits for each pair of input files from the
+        search of unique sequences, writing them to file, and adding them
+        with the best hits in each direction to the results store.
+        """
+        self._logger.info("Calling reciprocal best hits (pid>=%.2f, cov>=%.2f)"
+                          % (self._args.identity, self._args.coverage))
+        hitsfile = blast.get_blastp_outfile(dedup.DEDUP_STEM, dedup.DEDUP_STEM,
+                                            self._args.outdirname,
+                                            binary=self._args.binary_hits)
+        besthits = dedup.iter_best_hits(hitsfile, self._mapfile,
+                                        self._infiles, self._args.identity,
+                                        self._args.coverage)
+        pairs = rbh.get_rbh_pairs(self._infiles, self._args.outdirname)
+        results = store.ResultStore(self._storefile)
+        stems = [os.path.splitext(os.path.split(fname)[-1])[0] for fname in
+                 self._infiles]
+        genomepairs = [(stem1, stem2) for idx, stem1 in enumerate(stems) for
+                       stem2 in stems[idx+1:]]
+        for (stem1, stem2), (fwdfile, revfile, rbhfile), (fwdbest, revbest) \
+                in zip(genomepairs, pairs, besthits):
+            rbhits = rbh.reciprocal_best_hits(fwdbest, revbest)
+            results.add_pair(stem1, stem2, fwdbest, revbest, rbhits)
+            rbh.write_rbh(rbhits, rbhfile)
+            self._logger.info("Wrote %d reciprocal best hits to %s" %
+                              (len(rbhits), rbhfile))
+        results.close()
+        self._logger.info("Added results to %s" % self._storefile)
+        if self._thresholds:
+            sweeps = dedup.iter_sweep(hitsfile, self._mapfile, self._infiles,
+                                      self._thresholds)
+            for (stem1, stem2), sweep in zip(genomepairs, sweeps):
+                rbh.write_rbh(sweep, blast.get_sweep_outfile(
+                    stem1, stem2, self._args.outdirname))
+
+
+    def __write_sweep_counts(self):
+        """Write the number of reciprocal best hits for each pair of input
+        files at each swept threshold to a single table.
+        """
+        stems = [os.path.splitext(os.path.split(fname)[-1])[0] for fname in
+                 self._infiles]
+        counts = []
+        for idx, stem1 in enumerate(stems):
+            for stem2 in stems[idx+1:]:
+                sweep = rbh.read_sweep(blast.get_sweep_outfile(
+                    stem1, stem2, self._args.outdirname))
+                counts.append(rbh.sweep_counts(sweep, self._thresholds).assign(
+                    genome1=stem1, genome2=stem2))
+        counts = pd.concat(counts, ignore_index=True)
+        counts = counts[['genome1', 'genome2', 'identity', 'coverage', 'rbh']]
+        outfile = os.path.join(self._args.outdirname,
+                               'pyrbbh_sweep_counts.tab')
+        counts.to_csv(outfile, sep='\t', index=False)
+        self._logger.info("Wrote reciprocal best hit counts at %d thresholds "
+                          "to %s" % (len(self._thresholds), outfile))
+
+
+    def __check_failures(self, retvals):
+        """Exit, listing the failed jobs, if any job failed.
+
+        Completed jobs are recorded in the cache as they finish, so that a
+        rerun with --resume runs only the jobs that failed, were blocked
+        by a failure, or did not run.
+        """
+        failed = sorted(name for name, retval in retvals.items() if retval)
+        if not failed:
+            self._logger.info("All jobs complete, no errors indicated")
+            return
+        self._logger.error("%d jobs failed: %s" % (len(failed),
+                                                   ", ".join(failed)))
+        if not self._lazy:
+            blocked = [job.name for job in self._jobs if
+                       job.stats.get('status') == 'blocked']
+            if blocked:
+                self._logger.error("%d jobs were blocked by failures" %
+                                   len(blocked))
+        self._logger.error("Rerun with --resume to run only failed, " +
+                           "blocked and unfinished jobs (exiting)")
+        sys.exit(1)
+
     def __mp_run_rbbh(self):
-        """Run RBBH jobs with multiprocessing.
+        """Run RBBH jobs as local subprocesses.
         
         RBBH jobs exist on two levels of dependency. Database creation jobs
         do not have any dependencies, but the query jobs do - but only on
-        database creation. This allows us to split the two task types up into
-        distinct asynchronous pools, so we can pass the database creation out
-        to all cores first, then do the same with query jobs.
-
-        We make two sets of commands to run.
+        database creation. Rather than waiting for every database to be
+        built before starting any queries, each query job is started as soon
+        as the database it searches is ready, so that a single slow database
+        does not hold up the whole run. Each job's stdout and stderr are
+        written to log files in the output directory.
         """
-        self._logger.info("Using multiprocessing to schedule jobs")
-        
-        # Create sets of commands to run
-        cmdsets = mp.create_cmdsets(self._jobs, self._logger)
-        self._logger.info("%d sets of commands to be scheduled" % len(cmdsets))
-        for idx, cmdset in enumerate(cmdsets):
-            self._logger.info("Running Level %d pool: %d commands" %
-                              (idx, len(cmdset)))
-            for cmd in cmdset:
-                self._logger.info("\t%s" % cmd)
-            t0 = time.time()
-            cumretval = mp.mp_run_cmdset(cmdset)
-            if cumretval:
-                self._logger.error("Pool returned nonzero - errors (exiting)")
-                sys.exit(1)
-            else:
-                self._logger.info("Pool complete, no errors indicated")
-            self._logger.info("Time to run pool: %.02fs" % (time.time() - t0))
+        self._logger.info("Using local subprocesses to schedule jobs")
+        self._logger.info("Running %s jobs on %s cores" %
+                          ("generated" if self._lazy else len(self._jobs),
+                           self._args.cores or "all"))
+        t0 = time.time()
+        logdir = os.path.join(self._args.outdirname, 'logs')
+        retvals = aio.run_dependency_graph(self._jobs, self._args.cores,
+                                           logdir, self._logger,
+                                           self.__record_job,
+                                           not self._args.fail_fast,
+                                           self._costs.estimate,
+                                           self._args.retries)
+        self.__write_report()
+        self.__save_costs()
+        self.__check_failures(retvals)
+        self._logger.info("Time to run jobs: %.02fs" % (time.time() - t0))
+        self._logger.info("Results are in %s" % self._storefile)
 
+    def __sge_run_rbbh(self):
+        """Run RBBH jobs as SGE array jobs.
 
-        
+        Each level of the job dependency graph is submitted as array jobs
+        held until the previous level's arrays have finished, so that only a
+        few qsub calls are made however many jobs there are.
+        """
+        self._logger.info("Using SGE to schedule jobs")
+        t0 = time.time()
+        retvals = sge.run_dependency_graph(self._jobs, self._args.outdirname,
+                                           self._args.jobprefix,
+                                           self._args.qsub_exe,
+                                           self._args.qstat_exe,
+                                           self._logger, self.__record_job,
+                                           self._costs.estimate)
+        self.__write_report()
+        self.__save_costs()
+        self.__check_failures(retvals)
+        self._logger.info("Time to run jobs: %.02fs" % (time.time() - t0))
+        self._logger.info("Results are in %s" % self._storefile)
 
-    def __sge_run_rbbh(self):
-        raise NotImplementedError
+    def __queue_run_rbbh(self):
+        """Run RBBH jobs on workers connecting over TCP.
+
+        Jobs are sent to workers, on this or any other host that shares the
+        input and output paths, as their dependencies complete; jobs on a
+        worker that is lost are sent to another.
+        """
+        self._logger.info("Using a work queue to schedule jobs")
+        token = self._args.queue_token or secrets.token_hex(16)
+        self._logger.warning("Start workers with: pyrbbh.py worker %s:%d " %
+                             (self._args.queue_host or socket.getfqdn(),
+                              self._args.queue_port) +
+                             ("--token %s" % token if
+                              self._args.queue_token is None else
+                              "(with --token or $PYRBBH_QUEUE_TOKEN)"))
+        t0 = time.time()
+        logdir = os.path.join(self._args.outdirname, 'logs')
+        retvals = workqueue.run_dependency_graph(self._jobs, token,
+                                                 self._args.queue_host,
+                                                 self._args.queue_port,
+                                                 logdir, self._logger,
+                                                 self.__record_job,
+                                                 not self._args.fail_fast,
+                                                 self._costs.estimate,
+                                                 retries=self._args.retries)
+        self.__write_report()
+        self.__save_costs()
+        self.__check_failures(retvals)
+        self._logger.info("Time to run jobs: %.02fs" % (time.time() - t0))
+        self._logger.info("Results are in %s" % self._storefile)
 
     def __validate_paths(self):
         """Exits if the input/output paths have problems. Creates output
@@ -167,7 +887,10 @@ The most commonly used commands are:
         if os.path.isdir(self._args.outdirname):
             self._logger.warning("Output directory %s already exists" % 
                                  self._args.outdirname)
-            if not self._args.force:
+            if self._args.resume and not self._args.force:
+                self._logger.warning("Will reuse completed output in %s" %
+                                     self._args.outdirname)
+            elif not self._args.force:
                 self._logger.error("Will not overwrite output in %s (exiting)" %
                                    self._args.outdirname)
                 sys.exit(1)
@@ -202,7 +925,7 @@ The most commonly used commands are:
             try:
                 logstream = open(self._args.logfile, 'w')
                 err_handler_file = logging.StreamHandler(logstream)
-                err_handler_file = setFormatter(err_formatter)
+                err_handler_file.setFormatter(err_formatter)
                 err_handler_file.setLevel(logging.INFO)
                 self._logger.addHandler(err_handler_file)
             except:
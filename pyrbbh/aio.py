@@ -0,0 +1,290 @@
+# Copyright 2015-2016 The James Hutton Institute
+# Author: Leighton Pritchard
+#
+# aio.py
+#
+# This code is part of the pyrbbh package, and is governed by its licence.
+# Please see the LICENSE file that should have been included as part of this
+# package.
+
+"""Code to run job dependency graphs locally with asyncio.
+
+Commands are launched directly as subprocesses from a single event loop,
+without intermediate Python worker processes. Each command's stdout and
+stderr are connected straight to per-job log files (or discarded), so no
+pipe is left for a chatty command to fill, and the exit code of every job
+is reported individually.
+
+Each subprocess is reaped with os.wait4() in a thread, so that its resource
+use can be recorded in the Job's stats dictionary: queue wait (seconds from
+the Job becoming ready to starting), wall time, CPU time (user + system),
+peak resident set size (kB, Linux) and the number of cores allocated.
+
+The dependency graph may be passed as a list of Jobs, or as a generator
+yielding each Job after those it depends on. A generator is only drawn on
+when more Jobs are needed to keep the cores busy, so that Jobs (and their
+command lines) are held in memory only while they are waiting or running.
+
+A Job that fails may be retried after a delay that doubles with each
+attempt, so that transient failures (e.g. a full disk, or a filesystem
+briefly unavailable) do not end a run; its cores are free for other Jobs
+while it waits. Each Job's outcome is recorded in
+its stats as 'status': 'done', 'failed', or 'blocked' if a Job it depends
+on failed, so that it was never run.
+"""
+
+import asyncio
+import concurrent.futures
+import multiprocessing
+import os
+import subprocess
+import time
+
+from . import jobs
+from .config import RETRY_BACKOFF
+
+# Maximum number of Jobs drawn from a job generator that may be waiting on
+# their dependencies at one time
+MAX_PENDING = 10000
+
+# Minimum interval in seconds between progress reports in the log
+PROGRESS_INTERVAL = 60
+
+
+# Run a single Job as a subprocess
+async def run_job(job, threads=1, logdir=None, executor=None):
+    """Runs the passed Job's command in a shell, returning its exit code, and
+    recording its wall time, CPU time and peak RSS in job.stats.
+
+    - job - Job object to run
+    - threads - number of cores allocated to the Job
+    - logdir - path to directory for '<job name>.out' and '<job name>.err'
+      log files, or None to discard output
+    - executor - concurrent.futures executor in which to wait for the
+      subprocess, or None for the event loop's default
+    """
+    loop = asyncio.get_running_loop()
+    cmd = job.get_command(threads)
+    t0 = time.time()
+    if logdir is None:
+        retval, rusage = await loop.run_in_executor(executor, __run_cmd, cmd,
+                                                    subprocess.DEVNULL,
+                                                    subprocess.DEVNULL)
+    else:
+        with open(os.path.join(logdir, "%s.out" % job.name), 'wb') as outfh, \
+             open(os.path.join(logdir, "%s.err" % job.name), 'wb') as errfh:
+            retval, rusage = await loop.run_in_executor(executor, __run_cmd,
+                                                        cmd, outfh, errfh)
+    job.stats.update({'threads': threads, 'start_time': t0,
+                      'wall_time': time.time() - t0, 'exit_code': retval})
+    if rusage is not None:
+        job.stats.update({'cpu_time': rusage.ru_utime + rusage.ru_stime,
+                          'max_rss': rusage.ru_maxrss})
+    return retval
+
+
+# Run a single command line as a subprocess, and wait for it
+def __run_cmd(cmd, stdout, stderr):
+    """Runs cmd in a shell with the passed stdout and stderr, blocking until
+    it finishes. Returns a tuple of (exit code, resource usage), where the
+    exit code is -1 if the command could not be started, and the resource
+    usage is None where os.wait4() is not available.
+
+    - cmd - command line to run
+    - stdout - file object or subprocess constant for stdout
+    - stderr - file object or subprocess constant for stderr
+    """
+    try:
+        proc = subprocess.Popen(cmd, shell=True, stdout=stdout, stderr=stderr)
+    except OSError:
+        return -1, None
+    if not hasattr(os, 'wait4'):
+        return proc.wait(), None
+    pid, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return proc.returncode, rusage
+
+
+# Run a job dependency graph with asyncio, as dependencies allow
+def run_dependency_graph(jobgraph, cores=None, logdir=None, logger=None,
+                         callback=None, keep_going=False, costs=None,
+                         retries=0, backoff=RETRY_BACKOFF):
+    """Runs the Jobs in the passed dependency graph as local subprocesses,
+    returning a dictionary of exit values keyed by job name.
+
+    - jobgraph - dependency graph of Job objects as list of Jobs, or an
+      iterator yielding each Job after the Jobs it depends on
+    - cores - total number of cores available to Jobs (defaults to CPU count)
+    - logdir - path to directory for per-job log files, or None
+    - logger - logger object
+    - callback - function called with (job, exit value) as each Job finishes
+    - keep_going - if True, carry on running Jobs after a failure
+    - costs - function returning the estimated CPU time of a Job, or None
+    - retries - most times to rerun a Job after a failure
+    - backoff - seconds to wait before a Job's first retry, doubling for
+      each retry after
+
+    Each Job is started as soon as all of its own dependencies have
+    completed, and is allocated a number of cores from those free (see
+    jobs.allocate_threads()), so that the total in use never exceeds the
+    core budget. If a Job still returns a nonzero exit value after its
+    retries, no further Jobs are started, and the function returns once the
+    running Jobs have finished, unless keep_going is True, in which case
+    only Jobs depending on the failed Job are not run, and are marked as
+    blocked.
+
+    If costs is given, the ready Jobs with the longest estimated running
+    time are started first, so that long Jobs do not leave a tail at the
+    end of the run, and the estimated time remaining is logged as the run
+    progresses (for a list of Jobs).
+    """
+    if cores is None:
+        cores = multiprocessing.cpu_count()
+    if logdir is not None:
+        os.makedirs(logdir, exist_ok=True)
+    return asyncio.run(__run_graph(jobgraph, cores, logdir, logger, callback,
+                                   keep_going, costs, retries, backoff))
+
+
+# Coroutine running a job dependency graph
+async def __run_graph(jobgraph, cores, logdir, logger, callback, keep_going,
+                      costs, retries, backoff):
+    """Runs the Jobs in jobgraph; see run_dependency_graph().
+
+    - jobgraph - dependency graph of Job objects as list of Jobs, or an
+      iterator of Jobs
+    - cores - total number of cores available to Jobs
+    - logdir - path to directory for per-job log files, or None
+    - logger - logger object
+    - callback - function called with (job, exit value) as each Job finishes
+    - keep_going - if True, carry on running Jobs after a failure
+    - costs - function returning the estimated CPU time of a Job, or None
+    - retries - most times to rerun a Job after a failure
+    - backoff - seconds to wait before a Job's first retry
+    """
+    remaining = None  # estimated CPU time of Jobs not yet finished
+    if isinstance(jobgraph, list):
+        tracker = jobs.JobTracker(jobgraph, costs)
+        jobiter = iter(())
+        if costs is not None:
+            remaining = sum(costs(job) for job in jobgraph)
+            if logger:
+                logger.info("Estimated time to run %d jobs: %.0fs" %
+                            (len(jobgraph), remaining / cores))
+    else:
+        tracker, jobiter = jobs.JobTracker(priority=costs), iter(jobgraph)
+    lastreport = time.time()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=cores)
+    retvals = {}
+    allocated = {}  # cores allocated to each running job
+    running = {}    # asyncio task -> Job
+    retrying = {}   # asyncio task sleeping until a retry -> (Job, retval)
+    t0 = time.time()
+    readytimes = {}  # time each job became ready, if not at the start
+    failed = False
+    __draw_jobs(jobiter, tracker, cores, readytimes)
+    while running or retrying or (tracker.has_ready and not failed):
+        # Allocate free cores to ready jobs
+        while not failed and tracker.has_ready and \
+              sum(allocated.values()) < cores:
+            free = cores - sum(allocated.values())
+            waiting = tracker.ready_count
+            job = tracker.pop_ready(1)[0]
+            allocated[job] = jobs.allocate_threads(job, free, waiting)
+            if logger:
+                logger.info("Starting %s (%d cores): %s" %
+                            (job.name, allocated[job],
+                             job.get_command(allocated[job])))
+            job.stats['queue_wait'] = time.time() - readytimes.pop(job, t0)
+            if costs is not None:
+                job.stats['estimate'] = costs(job)
+            job.stats['attempts'] = job.stats.get('attempts', 0) + 1
+            task = asyncio.ensure_future(run_job(job, allocated[job], logdir,
+                                                 executor))
+            running[task] = job
+        # Wait for jobs to finish, and release their children
+        done, pending = await asyncio.wait(list(running) + list(retrying),
+                                           return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task in retrying:
+                job, retval = retrying.pop(task)
+                if not task.cancelled():  # requeue a Job whose retry is due
+                    readytimes[job] = time.time()
+                    tracker.requeue(job)
+                    continue
+                # the retry was cancelled by a failure: the Job has failed
+            else:
+                job = running.pop(task)
+                del allocated[job]
+                retval = task.result()
+                if retval and job.stats['attempts'] <= retries:
+                    delay = backoff * 2 ** (job.stats['attempts'] - 1)
+                    if logger:
+                        logger.warning("%s returned nonzero (%s); retry %d "
+                                       "of %d in %.0fs" %
+                                       (job.name, retval,
+                                        job.stats['attempts'], retries,
+                                        delay))
+                    retrying[asyncio.ensure_future(asyncio.sleep(delay))] = \
+                        (job, retval)
+                    continue
+            retvals[job.name] = retval
+            if remaining is not None:
+                remaining -= job.stats['estimate']
+            if callback is not None:
+                callback(job, retval)
+            job.stats['status'] = 'failed' if retval else 'done'
+            if retval:
+                if logger:
+                    logger.error("%s returned nonzero (%s)" %
+                                 (job.name, retval))
+                failed = failed or not keep_going
+                blocked = tracker.fail(job)
+                for child in blocked:
+                    child.stats['status'] = 'blocked'
+                if logger and blocked:
+                    logger.warning("Blocked %d jobs depending on %s" %
+                                   (len(blocked), job.name))
+                if remaining is not None:
+                    remaining -= sum(costs(child) for child in blocked)
+            else:
+                readytimes.update((child, time.time()) for child in
+                                  tracker.complete(job))
+        if not failed:
+            __draw_jobs(jobiter, tracker, cores, readytimes)
+        else:  # no retry will be started, so fail the Jobs awaiting one
+            for task in retrying:
+                task.cancel()
+        if logger and time.time() - lastreport > PROGRESS_INTERVAL:
+            lastreport = time.time()
+            logger.info("%d jobs finished, %d running%s" %
+                        (len(retvals), len(running),
+                         "" if remaining is None else
+                         ", about %.0fs remaining" % (max(0, remaining) /
+                                                      cores)))
+    executor.shutdown()
+    return retvals
+
+
+# Draw Jobs from a job generator until enough are ready to run
+def __draw_jobs(jobiter, tracker, cores, readytimes):
+    """Adds Jobs from jobiter to the passed JobTracker until at least cores
+    Jobs are ready to run, MAX_PENDING Jobs are outstanding, or jobiter is
+    exhausted.
+
+    - jobiter - iterator of Job objects
+    - tracker - JobTracker object
+    - cores - total number of cores available to Jobs
+    - readytimes - dictionary of the times Jobs became ready, keyed by Job
+
+    Jobs depending on a failed Job are not tracked, and are marked blocked.
+    """
+    while tracker.ready_count < cores and tracker.pending_count < MAX_PENDING:
+        job = next(jobiter, None)
+        if job is None:
+            return
+        ready = tracker.add(job)
+        if ready:
+            readytimes[job] = time.time()
+        elif ready is None:
+            job.stats['status'] = 'blocked'
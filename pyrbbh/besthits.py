@@ -0,0 +1,217 @@
+# Copyright 2015-2016 The James Hutton Institute
+# Author: Leighton Pritchard
+#
+# besthits.py
+#
+# This code is part of the pyrbbh package, and is governed by its licence.
+# Please see the LICENSE file that should have been included as part of this
+# package.
+
+"""Module to reduce streamed BLASTP output to the best hit for each query.
+
+This module is run as a wrapper around a BLASTP command that writes its
+tabular output to stdout:
+
+    python -m pyrbbh.besthits -o OUTFILE [--pid P] [--cov C] -- blastp ...
+
+BLASTP output is read from the pipe in chunks, and a running table of the
+best hit for each query is kept in memory, so that only the reduced table
+is ever written to disk. The exit code of the wrapped command is returned.
+If OUTFILE ends in .hits, it is written as a binary hit table (see
+hittable).
+
+When searching a combined database of genome-tagged sequences (see
+io.write_combined_fasta()), the --split and --query options keep the best
+hit for each query in each other genome, and OUTFILE is instead a directory
+to which one best-hit table is written per genome pair (as binary hit
+tables, with --binary).
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+import pandas as pd
+
+from .blast import (BLASTP_COLUMNS, HIT_DTYPES, HITTABLE_EXT,
+                    get_blastp_outfile)
+from .hittable import empty_hits, write_hits
+from .io import GENOME_TAG_SEP
+from .rbh import best_hits
+
+# Number of HSPs to read from the pipe at a time
+CHUNKSIZE = 100000
+
+
+# Reduce a stream of BLASTP tabular output to best hits
+def reduce_stream(stream, identity=0.8, coverage=0.8, chunksize=CHUNKSIZE,
+                  qstem=None):
+    """Returns a dataframe of the best hit for each query in the passed
+    stream of BLASTP tabular output.
+
+    - stream - file-like object yielding BLASTP tabular output
+    - identity - minimum fractional percentage identity of a hit
+    - coverage - minimum fractional query coverage of a hit
+    - chunksize - number of HSPs to read and reduce at a time
+    - qstem - if given, subject IDs are genome-tagged, and the best hit is
+      kept for each query in each genome other than qstem
+
+    Each chunk is reduced to its best hits, then combined with the running
+    best-hit table, so memory use is bounded by the number of queries plus
+    the chunk size, not by the number of HSPs. If qstem is given, the
+    returned dataframe has untagged subject IDs, and an extra 'sgenome'
+    column holding the subject genome's filestem.
+    """
+    best = empty_hits()
+    keys = ('qseqid',)
+    if qstem is not None:
+        best = best.assign(sgenome=pd.Series(dtype=str))
+        keys = ('qseqid', 'sgenome')
+    try:
+        reader = pd.read_csv(stream, sep='\t', header=None,
+                             names=BLASTP_COLUMNS, dtype=HIT_DTYPES,
+                             chunksize=chunksize)
+        for chunk in reader:
+            if qstem is not None:
+                chunk = untag_subjects(chunk, qstem)
+            best = best_hits(pd.concat([best, best_hits(chunk, identity,
+                                                        coverage, keys)]),
+                             identity, coverage, keys)
+    except pd.errors.EmptyDataError:
+        pass  # no HSPs in the stream
+    return best
+
+
+# Split genome tags from subject IDs
+def untag_subjects(hits, qstem):
+    """Returns the passed dataframe of HSPs against a combined database, with
+    the genome tag removed from each subject ID and placed in a new
+    'sgenome' column. HSPs against the query genome itself are discarded.
+
+    - hits - dataframe of HSPs with genome-tagged subject IDs
+    - qstem - filestem of the query genome
+    """
+    parts = hits['sseqid'].str.split(GENOME_TAG_SEP, n=1)
+    hits = hits.assign(sgenome=parts.str[0], sseqid=parts.str[1])
+    return hits[hits['sgenome'] != qstem]
+
+
+# Write a best-hit table, compressing if the filename requests it
+def write_best_hits(best, filename):
+    """Writes the passed dataframe of best hits to filename, in the same
+    tabular format as BLASTP output, or as a binary hit table (see
+    hittable). Output is written to a temporary file and moved into place,
+    so that a partial table is never left behind.
+
+    - best - dataframe of best hits
+    - filename - path to output file (compressed if ending in .gz, or
+      binary if ending in .hits)
+    """
+    if filename.endswith(HITTABLE_EXT):
+        write_hits(best, filename)
+        return
+    tmpname = "%s.tmp" % filename
+    best.to_csv(tmpname, sep='\t', header=False, index=False,
+                compression='gzip' if filename.endswith('.gz') else None)
+    os.replace(tmpname, filename)
+
+
+# Write one best-hit table for each subject genome
+def write_split_best_hits(best, outdir, qstem, genomes, binary=False):
+    """Writes the passed dataframe of best hits against a combined database
+    as one best-hit table per query/subject genome pair, in outdir.
+
+    - best - dataframe of best hits, with an 'sgenome' column
+    - outdir - path to directory for best-hit tables
+    - qstem - filestem of the query genome
+    - genomes - list of filestems of all genomes in the combined database
+    - binary - if True, write binary hit tables rather than compressed text
+
+    A table is written for every genome other than the query, even if it
+    holds no hits, so that every pair has output.
+    """
+    groups = dict(tuple(best.groupby('sgenome')))
+    for genome in genomes:
+        if genome == qstem:
+            continue
+        hits = groups.get(genome, best.iloc[:0]).drop(columns='sgenome')
+        write_best_hits(hits, get_blastp_outfile(qstem, genome, outdir,
+                                                 stream=True, binary=binary))
+
+
+# Run a BLASTP command, reducing its output to best hits
+def run_reduced(cmd, outfile, identity=0.8, coverage=0.8, qstem=None,
+                genomes=None, binary=False):
+    """Runs the passed command, reducing the BLASTP tabular output it writes
+    to stdout to a table of best hits in outfile. Returns the command's
+    exit code; output is only written if the command succeeds.
+
+    - cmd - the BLASTP command to run, as a list of arguments
+    - outfile - path to output file (or directory, if splitting by genome)
+    - identity - minimum fractional percentage identity of a hit
+    - coverage - minimum fractional query coverage of a hit
+    - qstem - filestem of the query genome, if splitting by genome
+    - genomes - filestems of all genomes in the database, if splitting
+    - binary - if True, write binary hit tables when splitting (otherwise,
+      the format is chosen by the extension of outfile)
+    """
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    best = reduce_stream(proc.stdout, identity, coverage, qstem=qstem)
+    proc.stdout.close()
+    retval = proc.wait()
+    if retval == 0:
+        if qstem is None:
+            write_best_hits(best, outfile)
+        else:
+            write_split_best_hits(best, outfile, qstem, genomes, binary)
+    return retval
+
+
+# Process command-line arguments
+def parse_cmdline(args):
+    """Parse command-line arguments for the reducer.
+
+    - args - list of command-line arguments
+    """
+    parser = argparse.ArgumentParser(prog="python -m pyrbbh.besthits",
+                                     description="Reduce BLASTP output to "
+                                                 "best hits")
+    parser.add_argument('-o', '--outfile', dest='outfile',
+                        action='store', required=True,
+                        help='Path to best-hit output file (or directory)')
+    parser.add_argument('--split', dest='genomefile',
+                        action='store', default=None,
+                        help='Path to list of genomes in combined database')
+    parser.add_argument('--query', dest='qstem',
+                        action='store', default=None,
+                        help='Filestem of query genome (with --split)')
+    parser.add_argument('--binary', dest='binary',
+                        action='store_true', default=False,
+                        help='Write binary hit tables (with --split)')
+    parser.add_argument('-p', '--pid', dest='identity',
+                        action='store', default=0.8, type=float,
+                        help='Percentage identity threshold')
+    parser.add_argument('-c', '--cov', dest='coverage',
+                        action='store', default=0.8, type=float,
+                        help='Percentage coverage threshold')
+    parser.add_argument('cmd', nargs=argparse.REMAINDER,
+                        help='BLASTP command writing tabular output to stdout')
+    parsed = parser.parse_args(args)
+    if parsed.cmd and parsed.cmd[0] == '--':
+        parsed.cmd = parsed.cmd[1:]
+    if not parsed.cmd:
+        parser.error("no BLASTP command given")
+    if (parsed.genomefile is None) != (parsed.qstem is None):
+        parser.error("--split and --query must be given together")
+    return parsed
+
+
+if __name__ == "__main__":
+    args = parse_cmdline(sys.argv[1:])
+    genomes = None
+    if args.genomefile is not None:
+        with open(args.genomefile) as fh:
+            genomes = [line.strip() for line in fh if line.strip()]
+    sys.exit(run_reduced(args.cmd, args.outfile, args.identity,
+                         args.coverage, args.qstem, genomes, args.binary))
@@ -8,21 +8,77 @@
 # package.
 
 """Module to produce BLAST command-line jobs for RBH analysis.
+
+Jobs run BLAST+ by default. Functions building jobs also take a search
+engine (see engines), in which case its database and search commands are
+used in place of makeblastdb and blastp, and the blastp_exe and
+blastdb_exe arguments are ignored.
+
+Search output is written as tabular text by default. Functions building
+jobs also take a binary option, with which each search's output is written
+as a binary hit table (see hittable) instead, with extension .hits, so
+that jobs reading it need not parse it again.
 """
 
+import functools
 import os
+import shlex
 import time
 
-from .config import BLASTP_DEFAULT, BLASTDB_DEFAULT
+from .config import (BLASTP_DEFAULT, BLASTDB_DEFAULT, PYRBBH_PATH,
+                     PYTHON_DEFAULT)
+
+from . import engines, io, jobs
+
+# Columns written to the tabular output of each BLASTP query, in order
+BLASTP_COLUMNS = ('qseqid', 'sseqid', 'qlen', 'slen', 'bitscore', 'length',
+                  'nident', 'pident', 'qcovhsp', 'qcovs', 'qstart', 'qend',
+                  'sstart', 'send')
+
+# Data types for each column of a BLASTP hit table (query coverage is
+# fractional from some search engines)
+HIT_DTYPES = {'qseqid': str, 'sseqid': str, 'qlen': 'int64',
+              'slen': 'int64', 'bitscore': 'float64', 'length': 'int64',
+              'nident': 'int64', 'pident': 'float64', 'qcovhsp': 'float64',
+              'qcovs': 'float64', 'qstart': 'int64', 'qend': 'int64',
+              'sstart': 'int64', 'send': 'int64'}
+
+# Filename extensions for full BLASTP output, and streamed best-hit tables
+BLASTP_EXT = '.tab'
+BESTHITS_EXT = '.best.tab.gz'
+
+# Filename extensions for the same, as binary hit tables (see hittable)
+HITTABLE_EXT = '.hits'
+BESTHITS_HITTABLE_EXT = '.best.hits'
+
+# Subdirectory of the output directory holding query shards and their output
+SHARD_DIRNAME = 'shards'
 
-from . import jobs
+# Start of the command line running a pyrbbh helper module in a job (see
+# construct_helper_cmd()): the package directory is put ahead of any
+# PYTHONPATH, as jobs may run in any working directory, and on other hosts
+HELPER_PREFIX = "PYTHONPATH=%s${PYTHONPATH:+:$PYTHONPATH} %s -m pyrbbh." % \
+                (shlex.quote(PYRBBH_PATH), shlex.quote(PYTHON_DEFAULT))
+
+# Filestem of the combined database, and the default number of database
+# sequences reported per genome when searching a database of several
+# genomes (all-vs-all and deduplicated modes). Searches report at most this
+# many times the number of genomes subject sequences per query, so a query
+# whose true best hit in one genome ranks below many close paralogs from
+# other genomes can miss it; raise it where genomes hold large families.
+ALLVSALL_STEM = 'pyrbbh_all'
+ALLVSALL_TARGETS_PER_GENOME = 5
 
 # Make a dependency graph of BLAST database and query jobs
 def make_blast_jobs(infiles, outdir,
                     blastp_exe=BLASTP_DEFAULT, blastdb_exe=BLASTDB_DEFAULT,
-                    jobprefix="PYRBBH_%s" % str(int(time.time()))):
+                    jobprefix="PYRBBH_%s" % str(int(time.time())),
+                    stream=False, identity=0.8, coverage=0.8,
+                    shard_size=None, indices=None, storefile=None,
+                    thresholds=None, engine=None, binary=False):
     """Returns a list of Job objects that represent BLAST commands required
-    to conduct RBBH on the list of passed sequence files.
+    to conduct RBBH on the list of passed sequence files, and the commands
+    calling reciprocal best hits for each pair of files.
 
     The returned list is essentially a job dependency graph. Individual jobs
     record their upstream dependencies on other jobs. In all cases, this 
@@ -38,16 +94,148 @@ def make_blast_jobs(infiles, outdir,
     - blastp_exe - path to BLASTP executable
     - blastdb_exe - path to BLAST database formatting executable
     - jobprefix - a string to prefix job IDs if run on SGE scheduler
+    - stream - if True, reduce BLASTP output to best hits as it is written
+    - identity - minimum fractional identity of best hits (stream only)
+    - coverage - minimum fractional query coverage of best hits (stream only)
+    - shard_size - if given, split query files into shards of at most this
+      many residues, each searched by its own job
+    - indices - dictionary of seqindex.FastaIndex objects, keyed by input
+      file, used to split query files into shards without parsing them
+    - storefile - path to a results store (see store.ResultStore) to which
+      each pair's best hits and reciprocal best hits are added, or None
+    - thresholds - list of (identity, coverage) tuples at which each pair's
+      reciprocal best hits are also called, or None (not with stream)
+    - engine - engines.SearchEngine running the searches (default: BLAST+)
+    - binary - if True, write search output as binary hit tables
+
+    Each pair's reciprocal best hits are called by a job depending on both
+    its query jobs (see make_rbh_job()), so that they are called as soon
+    as the pair's searches finish, while other searches are running.
+    """
+    return list(iter_blast_jobs(infiles, outdir, blastp_exe, blastdb_exe,
+                                jobprefix, stream, identity, coverage,
+                                shard_size, indices, storefile,
+                                thresholds, engine, binary))
+
+
+# Generate the BLAST database and query jobs for RBBH, as they are needed
+def iter_blast_jobs(infiles, outdir,
+                    blastp_exe=BLASTP_DEFAULT, blastdb_exe=BLASTDB_DEFAULT,
+                    jobprefix="PYRBBH_%s" % str(int(time.time())),
+                    stream=False, identity=0.8, coverage=0.8,
+                    shard_size=None, indices=None, storefile=None,
+                    thresholds=None, engine=None, binary=False):
+    """Yields the Jobs returned by make_blast_jobs(), in the same order, each
+    after the Jobs it depends on.
+
+    Arguments are as for make_blast_jobs(). Only the database jobs (one per
+    input file) are kept; each query Job is created when it is drawn from
+    the generator, and builds its command line only when it is run, so a
+    scheduler drawing Jobs as it needs them holds only the Jobs in flight.
     """
     # Create dictionary of database jobs, keyed by filestem
-    dbjobs = make_blastdb_jobs(infiles, outdir, blastdb_exe, jobprefix)
-    # Create list of BLAST query jobs
-    queryjobs = make_blastp_jobs(infiles, outdir, blastp_exe, jobprefix, dbjobs)
-    return list(dbjobs.values()) + queryjobs
-    
+    dbjobs = make_blastdb_jobs(infiles, outdir, blastdb_exe, jobprefix,
+                               engine)
+    yield from dbjobs.values()
+    # Split query files into shards, if required
+    shards = None
+    if shard_size:
+        sharddir = os.path.join(outdir, SHARD_DIRNAME)
+        os.makedirs(sharddir, exist_ok=True)
+        shards = {fname: io.split_fasta(fname, sharddir, shard_size,
+                                        (indices or {}).get(fname)) for
+                  fname in infiles}
+    # Generate BLAST query jobs
+    yield from iter_blastp_jobs(infiles, outdir, blastp_exe, jobprefix,
+                                dbjobs, stream, identity, coverage, shards,
+                                rbh=True, storefile=storefile,
+                                thresholds=thresholds, engine=engine,
+                                binary=binary)
+
+
+# Make a dependency graph of jobs searching a single combined database
+def make_allvsall_jobs(infiles, outdir,
+                       blastp_exe=BLASTP_DEFAULT, blastdb_exe=BLASTDB_DEFAULT,
+                       jobprefix="PYRBBH_%s" % str(int(time.time())),
+                       identity=0.8, coverage=0.8, storefile=None,
+                       engine=None, binary=False,
+                       targets_per_genome=ALLVSALL_TARGETS_PER_GENOME):
+    """Returns a list of Job objects that conduct RBBH searches for the
+    passed sequence files using a single combined database.
+
+    All input sequences are written to one FASTA file, with IDs tagged by
+    their genome's filestem, and a single database is built from it. Each
+    input file is then queried against the combined database by one job,
+    under the pyrbbh.besthits reducer, which writes the best hit for each
+    query in each other genome to 'qstem_vs_dbstem.best.tab.gz', as for
+    a streamed pairwise search. This needs N query jobs, rather than
+    N(N-1).
+
+    - infiles - a list of paths to input FASTA files
+    - outdir - path to directory for BLAST databases/output
+    - blastp_exe - path to BLASTP executable
+    - blastdb_exe - path to BLAST database formatting executable
+    - jobprefix - a string to prefix job IDs if run on SGE scheduler
+    - identity - minimum fractional identity of best hits
+    - coverage - minimum fractional query coverage of best hits
+    - storefile - path to a results store to which each pair's results are
+      added, or None
+    - engine - engines.SearchEngine running the searches (default: BLAST+)
+    - binary - if True, write best-hit tables as binary hit tables
+    - targets_per_genome - number of subject sequences reported for each
+      query, per input file
+
+    Reciprocal best hits for each pair of input files are called by a job
+    depending on the query jobs of both files (see make_rbh_job()).
+
+    Each query reports at most targets_per_genome times the number of input
+    files subject sequences from the combined database, rather than every
+    hit in each genome, so a best hit can be missed where another genome
+    contributes more close paralogs than that (see
+    ALLVSALL_TARGETS_PER_GENOME).
+    """
+    # Write combined, genome-tagged input sequences
+    combined = os.path.join(outdir, ALLVSALL_STEM + '.fasta')
+    genomefile = os.path.join(outdir, ALLVSALL_STEM + '.genomes')
+    io.write_combined_fasta(infiles, combined, genomefile)
+    # Create the combined database job
+    engine = engine or engines.BlastEngine(blastp_exe, blastdb_exe)
+    dbjob = make_blastdb_jobs([combined], outdir, blastdb_exe, jobprefix,
+                              engine)[ALLVSALL_STEM]
+    dbname = os.path.join(outdir, os.path.split(combined)[-1])
+    # Create one query job per input file
+    joblist = [dbjob]
+    max_targets = targets_per_genome * len(infiles)
+    for idx, qfile in enumerate(infiles):
+        qstem = os.path.splitext(os.path.split(qfile)[-1])[0]
+        cmd = construct_allvsall_cmd(qfile, dbname, outdir, blastp_exe,
+                                     genomefile, max_targets, identity,
+                                     coverage, engine, binary)
+        job = jobs.Job("%s_query_%06d_all" % (jobprefix, idx), cmd)
+        job.executable = engine.search_exe
+        job.thread_option = engine.thread_option
+        job.inputs = [qfile, combined]
+        job.outputs = [get_blastp_outfile(qstem, '*', outdir, stream=True,
+                                          binary=binary)]
+        job.add_dependency(dbjob)
+        joblist.append(job)
+    # Create one RBH job per pair of input files
+    queryjobs = joblist[1:]
+    jobnum = 0
+    for idx, infile1 in enumerate(infiles):
+        for jdx in range(idx + 1, len(infiles)):
+            jobnum += 1
+            joblist.append(make_rbh_job("%s_rbh_%06d_all" % (jobprefix,
+                                                             jobnum),
+                                        infile1, infiles[jdx], outdir,
+                                        queryjobs[idx], queryjobs[jdx], True,
+                                        identity, coverage, storefile,
+                                        binary=binary))
+    return joblist
+
 
 # Make a dictionary of makeblastdb jobs
-def make_blastdb_jobs(infiles, outdir, blastdb_exe, jobprefix):
+def make_blastdb_jobs(infiles, outdir, blastdb_exe, jobprefix, engine=None):
     """Returns a dictionary of BLAST database construction command-lines,
     keyed by the input filestem.
 
@@ -55,6 +243,7 @@ def make_blastdb_jobs(infiles, outdir, blastdb_exe, jobprefix):
     - outdir - path to directory for BLAST databases/output
     - blastdb_exe - path to BLAST database formatting executable
     - jobprefix - a string to prefix job IDs if run on SGE scheduler
+    - engine - engines.SearchEngine building the databases (default: BLAST+)
 
     >>> sorted(make_blastdb_jobs(['../tests/seqdata/infile1.fasta', \
 '../tests/seqdata/infile2.fasta'], '../tests/output/', 'makeblastdb', \
@@ -63,25 +252,33 @@ def make_blastdb_jobs(infiles, outdir, blastdb_exe, jobprefix):
 <jobs.Job instance at 0x...>)]
     """
     # Create dictionary of database jobs
+    engine = engine or engines.BlastEngine(db_exe=blastdb_exe)
     dbjobdict = {}
     for idx, fname in enumerate(infiles):
-        dbcmd, dbname = construct_makeblastdb_cmd(fname, outdir, blastdb_exe)
+        dbcmd, dbname = construct_makeblastdb_cmd(fname, outdir, blastdb_exe,
+                                                  engine)
         job = jobs.Job("%s_db_%06d" % (jobprefix, idx), dbcmd)
+        job.executable = engine.db_exe
+        job.inputs = [fname]
+        job.outputs = engine.get_db_outputs(os.path.join(
+            outdir, os.path.split(fname)[-1]))
         dbjobdict[dbname] = job
     return dbjobdict
 
 
 # Build a makeblastdb command line
-def construct_makeblastdb_cmd(infile, outdir, blastdb_exe):
+def construct_makeblastdb_cmd(infile, outdir, blastdb_exe, engine=None):
     """Returns a tuple of (cmd_line, filestem) where cmd_line is the BLAST
     database formatting command for the passed filename, placing the result
     in outdir, with the same filestem as the input filename.
 
-    The formatting assumes that the executable is makeblastdb from BLAST+
+    The formatting assumes that the executable is makeblastdb from BLAST+,
+    unless a search engine is given.
 
     - infile - input filename
     - outdir - location to write the database
     - blastdb_exe - path toBLAST database construction executable
+    - engine - engines.SearchEngine building the database, or None
 
     >>> construct_makeblastdb_cmd('../tests/seqdata/infile1.fasta', \
 '../tests/output/', 'makeblastdb')
@@ -91,15 +288,15 @@ infile1 -out ../tests/output/infile1.fasta', 'infile1')
     filename = os.path.split(infile)[-1]  # strip directory
     filestem = os.path.splitext(filename)[0]  # strip extension
     outfname = os.path.join(outdir, filename)  # location to write db
-    cmd = "{0} -dbtype prot -in {1} -title {2} -out {3}".format(blastdb_exe,
-                                                                infile,
-                                                                filestem,
-                                                                outfname)
-    return (cmd, filestem)
+    engine = engine or engines.BlastEngine(db_exe=blastdb_exe)
+    return (engine.construct_db_cmd(infile, outfname), filestem)
 
 
 # Make list of BLAST query jobs
-def make_blastp_jobs(infiles, outdir, blastp_exe, jobprefix, dbjobs):
+def make_blastp_jobs(infiles, outdir, blastp_exe, jobprefix, dbjobs,
+                     stream=False, identity=0.8, coverage=0.8, shards=None,
+                     rbh=False, storefile=None, thresholds=None,
+                     engine=None, binary=False):
     """Returns a list of BLASTP query jobs for RBH analysis.
 
     This requires nested loops of 
@@ -109,47 +306,268 @@ def make_blastp_jobs(infiles, outdir, blastp_exe, jobprefix, dbjobs):
     - blastp_exe - path to BLASTP
     - jobprefix - a string to prefix job IDs if run on SGE scheduler
     - dbjobs - dictionary of database construction jobs, keyed by filestem
+    - stream - if True, reduce BLASTP output to best hits as it is written
+    - identity - minimum fractional identity of best hits (stream only)
+    - coverage - minimum fractional query coverage of best hits (stream only)
+    - shards - dictionary of lists of query shard files, keyed by input file
+    - rbh - if True, follow each pair's query jobs with a job calling its
+      reciprocal best hits (see make_rbh_job())
+    - storefile - path to a results store, or None (rbh only)
+    - thresholds - list of (identity, coverage) tuples to sweep, or None
+      (rbh only)
+    - engine - engines.SearchEngine running the searches (default: BLAST+)
+    - binary - if True, write search output as binary hit tables
 
+    >>> from .jobs import Job
+    >>> dbjobs = {'infile%d' % idx: Job('dbjob%d' % idx, 'true') for idx in \
+range(1, 4)}
     >>> joblist = make_blastp_jobs(['../tests/seqdata/infile1.fasta', \
 '../tests/seqdata/infile2.fasta', '../tests/seqdata/infile3.fasta'], \
-'../tests/output/', 'makeblastdb', 'RBH_BLAST', {'infile1': 'dbjob1', \
-'infile2': 'dbjob2', 'infile3': 'dbjob3'})
+'../tests/output/', 'makeblastdb', 'RBH_BLAST', dbjobs)
     >>> [j.name for j in joblist]
     ['RBH_BLAST_query_000001_fwd', 'RBH_BLAST_query_000001_rev', \
 'RBH_BLAST_query_000002_fwd', 'RBH_BLAST_query_000002_rev', \
 'RBH_BLAST_query_000003_fwd', 'RBH_BLAST_query_000003_rev']
-    >>> joblist[0].dependencies
+    >>> [j.name for j in joblist[0].dependencies]
     ['dbjob2']
     """
-    # Create list of BLASTP jobs
-    joblist = []
+    return list(iter_blastp_jobs(infiles, outdir, blastp_exe, jobprefix,
+                                 dbjobs, stream, identity, coverage, shards,
+                                 rbh, storefile, thresholds, engine,
+                                 binary))
+
+
+# Generate BLAST query jobs, as they are needed
+def iter_blastp_jobs(infiles, outdir, blastp_exe, jobprefix, dbjobs,
+                     stream=False, identity=0.8, coverage=0.8, shards=None,
+                     rbh=False, storefile=None, thresholds=None,
+                     engine=None, binary=False):
+    """Yields the BLASTP query jobs returned by make_blastp_jobs(), in the
+    same order. Arguments are as for make_blastp_jobs().
+    """
     jobnum = 0
     for idx, infile1 in enumerate(infiles):
-        fname1 = os.path.split(infile1)[-1]  # strip directory
-        fstem1 = os.path.splitext(fname1)[0]  # strip extension
-        dbname1 = os.path.join(outdir, fname1)
         for infile2 in infiles[idx+1:]:
             jobnum += 1
-            fname2 = os.path.split(infile2)[-1]  # strip directory
-            fstem2 = os.path.splitext(fname2)[0]  # strip extension
-            dbname2 = os.path.join(outdir, fname2)
-            cmd1 = construct_blastp_cmd(infile1, dbname2, outdir, blastp_exe)
-            cmd2 = construct_blastp_cmd(infile2, dbname1, outdir, blastp_exe)
-            job1 = jobs.Job("%s_query_%06d_fwd" % (jobprefix, jobnum), cmd1)
-            job2 = jobs.Job("%s_query_%06d_rev" % (jobprefix, jobnum), cmd2)
-            job1.add_dependency(dbjobs[fstem2]) # add dependency on db job
-            job2.add_dependency(dbjobs[fstem1])
-            joblist.extend([job1, job2])
+            finaljobs = []
+            for direction, qfile, dbfile in (('fwd', infile1, infile2),
+                                             ('rev', infile2, infile1)):
+                name = "%s_query_%06d_%s" % (jobprefix, jobnum, direction)
+                dbstem = os.path.splitext(os.path.split(dbfile)[-1])[0]
+                joblist = make_query_jobs(name, qfile, dbfile, outdir,
+                                          blastp_exe, dbjobs[dbstem],
+                                          stream, identity, coverage,
+                                          shards.get(qfile) if shards
+                                          else None, engine=engine,
+                                          binary=binary)
+                finaljobs.append(joblist[-1])
+                yield from joblist
+            if rbh:
+                yield make_rbh_job("%s_rbh_%06d" % (jobprefix, jobnum),
+                                   infile1, infile2, outdir, finaljobs[0],
+                                   finaljobs[1], stream, identity, coverage,
+                                   storefile, thresholds, binary)
+
+
+# Make a job calling reciprocal best hits for a pair of input files
+def make_rbh_job(name, infile1, infile2, outdir, fwdjob, revjob,
+                 stream=False, identity=0.8, coverage=0.8, storefile=None,
+                 thresholds=None, binary=False):
+    """Returns a Job calling reciprocal best hits for the passed pair of
+    input files, depending on the jobs that search each against the other,
+    so that it runs as soon as both have finished.
+
+    - name - name of the job
+    - infile1 - path to the first input FASTA file
+    - infile2 - path to the second input FASTA file
+    - outdir - path to directory for BLAST output
+    - fwdjob - job writing the output of infile1 queries against infile2
+    - revjob - job writing the output of infile2 queries against infile1
+    - stream - if True, the query output is streamed best-hit tables
+    - identity - minimum fractional identity of best hits
+    - coverage - minimum fractional query coverage of best hits
+    - storefile - path to a results store, or None
+    - thresholds - list of (identity, coverage) tuples at which reciprocal
+      best hits are also called, and written to a sweep table (see
+      get_sweep_outfile()), or None
+    - binary - if True, the query output is binary hit tables
+
+    The job also writes the best hits in each direction to the files named
+    by get_besthits_outfiles(), from which they can be added to the results
+    store by the submitting process, where the job runs on another host and
+    storefile is None.
+
+    >>> from .jobs import Job
+    >>> job = make_rbh_job('rbh1', '../tests/seqdata/infile1.fasta', \
+'../tests/seqdata/infile2.fasta', '../tests/output', Job('fwd', 'true'), \
+Job('rev', 'true'))
+    >>> job.outputs, [j.name for j in job.dependencies]
+    (['../tests/output/infile1_rbbh_infile2.tab', \
+'../tests/output/infile1_rbbh_infile2.fwdbest.tab', \
+'../tests/output/infile1_rbbh_infile2.revbest.tab'], ['fwd', 'rev'])
+    """
+    stem1 = os.path.splitext(os.path.split(infile1)[-1])[0]
+    stem2 = os.path.splitext(os.path.split(infile2)[-1])[0]
+    fwdfile = get_blastp_outfile(stem1, stem2, outdir, stream, binary)
+    revfile = get_blastp_outfile(stem2, stem1, outdir, stream, binary)
+    rbhfile = get_rbh_outfile(stem1, stem2, outdir)
+    bestfiles = get_besthits_outfiles(stem1, stem2, outdir)
+    sweepfile = None
+    if thresholds:
+        sweepfile = get_sweep_outfile(stem1, stem2, outdir)
+    job = jobs.Job(name, functools.partial(construct_rbh_cmd, fwdfile,
+                                           revfile, rbhfile, identity,
+                                           coverage, storefile,
+                                           (stem1, stem2), sweepfile,
+                                           thresholds, bestfiles))
+    job.inputs = [fwdfile, revfile]
+    job.outputs = [rbhfile] + list(bestfiles)
+    if sweepfile is not None:
+        job.outputs.append(sweepfile)
+    job.add_dependency(fwdjob)
+    job.add_dependency(revjob)
+    return job
+
+
+# Make a dependency graph of jobs searching unique sequences against themselves
+def make_dedup_jobs(uniquefile, ngenomes, outdir,
+                    blastp_exe=BLASTP_DEFAULT, blastdb_exe=BLASTDB_DEFAULT,
+                    jobprefix="PYRBBH_%s" % str(int(time.time())),
+                    shard_size=None, engine=None, binary=False,
+                    targets_per_genome=ALLVSALL_TARGETS_PER_GENOME):
+    """Returns a list of Job objects that search the unique representative
+    sequences in uniquefile (see dedup.write_unique_fasta()) against a
+    database built from the same file.
+
+    - uniquefile - path to FASTA file of unique representative sequences
+    - ngenomes - number of input genomes the representatives are drawn from
+    - outdir - path to directory for BLAST databases/output
+    - blastp_exe - path to BLASTP executable
+    - blastdb_exe - path to BLAST database formatting executable
+    - jobprefix - a string to prefix job IDs if run on SGE scheduler
+    - shard_size - if given, split the query file into shards of at most
+      this many residues, each searched by its own job
+    - engine - engines.SearchEngine running the searches (default: BLAST+)
+    - binary - if True, write search output as a binary hit table
+    - targets_per_genome - number of subject sequences reported for each
+      query, per input genome
+
+    Every identical copy of a sequence is searched only once. Full BLASTP
+    output is written to 'ustem_vs_ustem.tab' (or '.hits'), reporting up to
+    targets_per_genome subject sequences per genome, so that the best hit
+    in each genome can be expanded back to every member of each
+    representative when reciprocal best hits are called. As in all-vs-all
+    mode, a best hit ranking below that many hits is missed (see
+    ALLVSALL_TARGETS_PER_GENOME).
+    """
+    ustem = os.path.splitext(os.path.split(uniquefile)[-1])[0]
+    dbjob = make_blastdb_jobs([uniquefile], outdir, blastdb_exe, jobprefix,
+                              engine)[ustem]
+    shardfiles = None
+    if shard_size:
+        sharddir = os.path.join(outdir, SHARD_DIRNAME)
+        os.makedirs(sharddir, exist_ok=True)
+        shardfiles = io.split_fasta(uniquefile, sharddir, shard_size)
+    queryjobs = make_query_jobs("%s_query_unique" % jobprefix, uniquefile,
+                                uniquefile, outdir, blastp_exe, dbjob,
+                                shardfiles=shardfiles,
+                                max_targets=targets_per_genome * ngenomes,
+                                engine=engine, binary=binary)
+    return [dbjob] + queryjobs
+
+
+# Make the jobs for a single BLASTP query, sharded or not
+def make_query_jobs(name, qfile, dbfile, outdir, blastp_exe, dbjob,
+                    stream=False, identity=0.8, coverage=0.8, shardfiles=None,
+                    max_targets=None, engine=None, binary=False):
+    """Returns a list of jobs that query the sequences in qfile against the
+    database built from dbfile.
+
+    - name - name of the job (or of the final merge job, if sharded)
+    - qfile - path to query FASTA file
+    - dbfile - path to FASTA file from which the database is built
+    - outdir - path to directory for BLAST databases/output
+    - blastp_exe - path to BLASTP
+    - dbjob - database construction job the queries depend on
+    - stream - if True, reduce BLASTP output to best hits as it is written
+    - identity - minimum fractional identity of best hits (stream only)
+    - coverage - minimum fractional query coverage of best hits (stream only)
+    - shardfiles - list of paths to shards of qfile, or None
+    - max_targets - maximum number of database sequences to report, or None
+      for the BLASTP default
+    - engine - engines.SearchEngine running the searches (default: BLAST+)
+    - binary - if True, write search output as binary hit tables
+
+    If qfile has been split into more than one shard, each shard is searched
+    by its own job, depending on dbjob, and a final merge job named name,
+    depending on all shard jobs, combines their output into the file that
+    an unsharded query would write.
+
+    Command lines are built when the jobs are run, not when they are made.
+    """
+    engine = engine or engines.BlastEngine(blastp_exe)
+    fname = os.path.split(dbfile)[-1]
+    dbname = os.path.join(outdir, fname)
+    qstem = os.path.splitext(os.path.split(qfile)[-1])[0]
+    dbstem = os.path.splitext(fname)[0]
+    outfile = get_blastp_outfile(qstem, dbstem, outdir, stream, binary)
+    if not shardfiles or len(shardfiles) < 2:
+        shardfiles = [qfile]
+    joblist = []
+    for sidx, shardfile in enumerate(shardfiles):
+        shardout = outdir if shardfile == qfile else \
+                   os.path.dirname(shardfile)
+        cmd = functools.partial(construct_blastp_cmd, shardfile, dbname,
+                                shardout, blastp_exe, stream, identity,
+                                coverage, max_targets, engine, binary)
+        shardstem = os.path.splitext(os.path.split(shardfile)[-1])[0]
+        job = jobs.Job(name if len(shardfiles) == 1 else
+                       "%s_%04d" % (name, sidx), cmd)
+        job.executable = engine.search_exe
+        job.thread_option = engine.thread_option
+        job.inputs = [shardfile, dbfile]
+        job.outputs = [get_blastp_outfile(shardstem, dbstem, shardout,
+                                          stream, binary)]
+        job.add_dependency(dbjob)  # add dependency on db job
+        joblist.append(job)
+    if len(joblist) > 1:
+        shardouts = [job.outputs[0] for job in joblist]
+        job = jobs.Job(name, functools.partial(construct_merge_cmd,
+                                               shardouts, outfile, stream,
+                                               identity, coverage, binary))
+        job.inputs = [qfile, dbfile]
+        job.outputs = [outfile]
+        for shardjob in joblist:
+            job.add_dependency(shardjob)
+        joblist.append(job)
     return joblist
 
 
 # Make a BLASTP query command line
-def construct_blastp_cmd(qfile, dbname, outdir, blastp_exe):
+def construct_blastp_cmd(qfile, dbname, outdir, blastp_exe,
+                         stream=False, identity=0.8, coverage=0.8,
+                         max_targets=None, engine=None, binary=False):
     """Returns a single BLASTP command, using the input qfile against the
     database dbname, writing results to outdir, using the executable in
     blastp_exe.
 
-    Output filename is formatted 'qstem_vs_dbstem.out'
+    Output filename is formatted 'qstem_vs_dbstem.tab'
+
+    If stream is True, BLASTP writes to stdout, and the command is wrapped
+    by the pyrbbh.besthits reducer, which keeps only the best hit for each
+    query that passes the identity and coverage thresholds. The reduced
+    table is written, gzip-compressed, to 'qstem_vs_dbstem.best.tab.gz'.
+
+    If max_targets is given, BLASTP reports at most that many database
+    sequences for each query.
+
+    If a search engine is given, its search command is used in place of
+    BLASTP, writing the same columns.
+
+    If binary is True, output is written as a binary hit table, to
+    'qstem_vs_dbstem.hits' (or '.best.hits' if streamed): the search writes
+    to stdout, and is wrapped by the pyrbbh.hittable converter, if not by
+    the reducer.
 
     The BLASTP command writes a tabular format output file. The formatting
     string returns the following information in columns:
@@ -171,13 +589,264 @@ def construct_blastp_cmd(qfile, dbname, outdir, blastp_exe):
 
     >>> construct_blastp_cmd('../tests/seqdata/infile1.fasta', \
 '../tests/output/infile2.fasta', '../tests/output', 'blastp')
-    'blastp -out ../tests/output/infile1_vs_infile2.tab -query \
-../tests/seqdata/infile1.fasta -db ../tests/output/infile2.fasta -outfmt 6'
+    "blastp -out ../tests/output/infile1_vs_infile2.tab -query \
+../tests/seqdata/infile1.fasta -db ../tests/output/infile2.fasta -outfmt \
+'6 qseqid sseqid qlen slen bitscore length nident pident qcovhsp qcovs \
+qstart qend sstart send'"
     """
     qstem = os.path.splitext(os.path.split(qfile)[-1])[0]
     dbstem = os.path.splitext(os.path.split(dbname)[-1])[0]
-    prefix = os.path.join(outdir, '%s_vs_%s' % (qstem, dbstem))
-    formatstr = "'6 qseqid sseqid qlen slen bitscore length nident pident \
-qcovhsp qcovs qstart qend sstart send'"
-    cmd = "{0} -out {1}.tab -query {2} -db {3} -outfmt {4}"
-    return cmd.format(blastp_exe, prefix, qfile, dbname, formatstr)
+    outfile = get_blastp_outfile(qstem, dbstem, outdir, stream, binary)
+    engine = engine or engines.BlastEngine(blastp_exe)
+    if stream or binary:
+        cmd = engine.construct_search_cmd(qfile, dbname, BLASTP_COLUMNS,
+                                          max_targets=max_targets)
+        if stream:
+            return construct_besthits_cmd(cmd, outfile, identity, coverage)
+        return construct_hittable_cmd(cmd, outfile)
+    return engine.construct_search_cmd(qfile, dbname, BLASTP_COLUMNS,
+                                       outfile, max_targets)
+
+
+# Make a BLASTP command line searching the combined database
+def construct_allvsall_cmd(qfile, dbname, outdir, blastp_exe, genomefile,
+                           max_targets, identity=0.8, coverage=0.8,
+                           engine=None, binary=False):
+    """Returns a single BLASTP command searching the input qfile against the
+    combined, genome-tagged database dbname, under the pyrbbh.besthits
+    reducer, which splits the best hits by subject genome and writes them to
+    outdir.
+
+    - qfile - path to query FASTA file
+    - dbname - path to combined database
+    - outdir - path to directory for best-hit tables
+    - blastp_exe - path to BLASTP
+    - genomefile - path to list of genome filestems in the combined database
+    - max_targets - maximum number of database sequences to report
+    - identity - minimum fractional identity of best hits
+    - coverage - minimum fractional query coverage of best hits
+    - engine - engines.SearchEngine running the search (default: BLAST+)
+    - binary - if True, write best-hit tables as binary hit tables
+
+    >>> cmd = construct_allvsall_cmd('../tests/seqdata/infile1.fasta', \
+'../tests/output/pyrbbh_all.fasta', '../tests/output', 'blastp', \
+'../tests/output/pyrbbh_all.genomes', 15)
+    >>> print(cmd.split(' -m ', 1)[-1]) #doctest: +ELLIPSIS
+    pyrbbh.besthits -o ../tests/output --pid 0.8 --cov 0.8 \
+--split ../tests/output/pyrbbh_all.genomes --query infile1 -- blastp \
+-query ../tests/seqdata/infile1.fasta -db ../tests/output/pyrbbh_all.fasta \
+-max_target_seqs 15 -outfmt '6 qseqid ...'
+    """
+    qstem = os.path.splitext(os.path.split(qfile)[-1])[0]
+    engine = engine or engines.BlastEngine(blastp_exe)
+    cmd = engine.construct_search_cmd(qfile, dbname, BLASTP_COLUMNS,
+                                      max_targets=max_targets)
+    options = "--split %s --query %s" % (genomefile, qstem)
+    if binary:
+        options = "%s --binary" % options
+    return construct_besthits_cmd(cmd, outdir, identity, coverage, options)
+
+
+# Returns the path to which a BLASTP query writes its output
+def get_blastp_outfile(qstem, dbstem, outdir, stream=False, binary=False):
+    """Returns the path to the output file of a BLASTP query of the sequences
+    with filestem qstem, against the database with filestem dbstem.
+
+    - qstem - filestem of the query sequence file
+    - dbstem - filestem of the database sequence file
+    - outdir - path to directory for BLAST output
+    - stream - if True, the output is a streamed best-hit table
+    - binary - if True, the output is a binary hit table
+
+    >>> get_blastp_outfile('infile1', 'infile2', '../tests/output')
+    '../tests/output/infile1_vs_infile2.tab'
+    >>> get_blastp_outfile('infile1', 'infile2', '../tests/output', True, \
+True)
+    '../tests/output/infile1_vs_infile2.best.hits'
+    """
+    if binary:
+        ext = BESTHITS_HITTABLE_EXT if stream else HITTABLE_EXT
+    else:
+        ext = BESTHITS_EXT if stream else BLASTP_EXT
+    return os.path.join(outdir, '%s_vs_%s%s' % (qstem, dbstem, ext))
+
+
+# Returns the path to which reciprocal best hits of a pair are written
+def get_rbh_outfile(stem1, stem2, outdir):
+    """Returns the path to the reciprocal best hit output file for the pair
+    of sequence files with filestems stem1 and stem2.
+
+    - stem1 - filestem of the first sequence file
+    - stem2 - filestem of the second sequence file
+    - outdir - path to directory for output
+
+    >>> get_rbh_outfile('infile1', 'infile2', '../tests/output')
+    '../tests/output/infile1_rbbh_infile2.tab'
+    """
+    return os.path.join(outdir, '%s_rbbh_%s.tab' % (stem1, stem2))
+
+
+# Returns the paths to which the best hits of a pair are written
+def get_besthits_outfiles(stem1, stem2, outdir):
+    """Returns a tuple of the paths to the tables of best hits of the
+    sequence file with filestem stem1 against that with filestem stem2, and
+    of stem2 against stem1, written when calling their reciprocal best hits.
+
+    - stem1 - filestem of the first sequence file
+    - stem2 - filestem of the second sequence file
+    - outdir - path to directory for output
+
+    >>> get_besthits_outfiles('infile1', 'infile2', '../tests/output')
+    ('../tests/output/infile1_rbbh_infile2.fwdbest.tab', \
+'../tests/output/infile1_rbbh_infile2.revbest.tab')
+    """
+    return tuple(os.path.join(outdir, '%s_rbbh_%s.%sbest.tab' %
+                              (stem1, stem2, direction)) for direction in
+                 ('fwd', 'rev'))
+
+
+# Returns the path to which a threshold sweep of a pair is written
+def get_sweep_outfile(stem1, stem2, outdir):
+    """Returns the path to the sweep table of reciprocal best hits at each
+    of a grid of thresholds, for the pair of sequence files with filestems
+    stem1 and stem2.
+
+    - stem1 - filestem of the first sequence file
+    - stem2 - filestem of the second sequence file
+    - outdir - path to directory for output
+
+    >>> get_sweep_outfile('infile1', 'infile2', '../tests/output')
+    '../tests/output/infile1_rbbh_infile2.sweep.tab'
+    """
+    return os.path.join(outdir, '%s_rbbh_%s.sweep.tab' % (stem1, stem2))
+
+
+# Build a command line merging the output of query shards
+def construct_merge_cmd(shardouts, outfile, stream=False, identity=0.8,
+                        coverage=0.8, binary=False):
+    """Returns a command line that combines the BLASTP output of each query
+    shard into the single output file of the unsharded query.
+
+    - shardouts - list of paths to shard BLASTP output files
+    - outfile - path to combined output file
+    - stream - if True, shard outputs are best-hit tables to be re-reduced
+    - identity - minimum fractional identity of best hits (stream only)
+    - coverage - minimum fractional query coverage of best hits (stream only)
+    - binary - if True, shard outputs are binary hit tables
+
+    Full BLASTP output is concatenated, via a temporary file, so that a
+    partial output file is never left behind. Binary hit tables are
+    concatenated by the pyrbbh.hittable converter; as each query is in
+    only one shard, streamed best-hit tables need not be reduced again.
+
+    >>> construct_merge_cmd(['s0.tab', 's1.tab'], 'q_vs_d.tab')
+    'cat s0.tab s1.tab > q_vs_d.tab.tmp && mv q_vs_d.tab.tmp q_vs_d.tab'
+    """
+    if binary:
+        return construct_helper_cmd('hittable', "-o %s -i %s" %
+                                    (outfile, ' '.join(shardouts)))
+    if stream:
+        return construct_besthits_cmd("gzip -dc %s" % ' '.join(shardouts),
+                                      outfile, identity, coverage)
+    return "cat {0} > {1}.tmp && mv {1}.tmp {1}".format(' '.join(shardouts),
+                                                         outfile)
+
+
+# Wrap a BLASTP command writing to stdout with the best-hit reducer
+def construct_besthits_cmd(cmd, outfile, identity, coverage, options=None):
+    """Returns a command line that runs the passed BLASTP command under the
+    pyrbbh.besthits reducer, writing the best hit for each query to outfile.
+
+    - cmd - BLASTP command writing tabular output to stdout
+    - outfile - path to best-hit output file
+    - identity - minimum fractional percentage identity of a best hit
+    - coverage - minimum fractional query coverage of a best hit
+    - options - string of further options to the reducer
+
+    >>> construct_besthits_cmd('blastp -query q.fasta -db d.fasta', \
+'q_vs_d.best.tab.gz', 0.8, 0.8) #doctest: +ELLIPSIS
+    '... -m pyrbbh.besthits -o q_vs_d.best.tab.gz --pid 0.8 --cov 0.8 -- \
+blastp -query q.fasta -db d.fasta'
+    """
+    reducer = "-o %s --pid %s --cov %s" % (outfile, identity, coverage)
+    if options:
+        reducer = "%s %s" % (reducer, options)
+    return construct_helper_cmd('besthits', "%s -- %s" % (reducer, cmd))
+
+
+# Wrap a BLASTP command writing to stdout with the binary hit table converter
+def construct_hittable_cmd(cmd, outfile):
+    """Returns a command line that runs the passed BLASTP command under the
+    pyrbbh.hittable converter, writing its output to outfile as a binary
+    hit table.
+
+    - cmd - BLASTP command writing tabular output to stdout
+    - outfile - path to binary hit table
+
+    >>> construct_hittable_cmd('blastp -query q.fasta -db d.fasta', \
+'q_vs_d.hits') #doctest: +ELLIPSIS
+    '... -m pyrbbh.hittable -o q_vs_d.hits -- blastp -query q.fasta -db \
+d.fasta'
+    """
+    return construct_helper_cmd('hittable', "-o %s -- %s" % (outfile, cmd))
+
+
+# Make a command line calling reciprocal best hits for a pair of files
+def construct_rbh_cmd(fwdfile, revfile, rbhfile, identity=0.8, coverage=0.8,
+                      storefile=None, genomes=None, sweepfile=None,
+                      thresholds=None, bestfiles=None):
+    """Returns a command line that calls reciprocal best hits from the passed
+    forward and reverse BLASTP output files with pyrbbh.rbh, writing them
+    to rbhfile.
+
+    - fwdfile - path to BLASTP output of genome 1 queries against genome 2
+    - revfile - path to BLASTP output of genome 2 queries against genome 1
+    - rbhfile - path to reciprocal best hit output file
+    - identity - minimum fractional percentage identity of a hit
+    - coverage - minimum fractional query coverage of a hit
+    - storefile - path to a results store the pair's results are added to,
+      or None
+    - genomes - tuple of filestems (genome 1, genome 2), naming the pair in
+      the results store
+    - sweepfile - path to sweep table, or None
+    - thresholds - list of (identity, coverage) tuples to sweep
+    - bestfiles - tuple of paths (forward, reverse) to which the best hits
+      in each direction are written, or None
+
+    >>> construct_rbh_cmd('a_vs_b.tab', 'b_vs_a.tab', 'a_rbbh_b.tab', 0.8, \
+0.8, 'res.sqlite', ('a', 'b')) #doctest: +ELLIPSIS
+    '... -m pyrbbh.rbh a_vs_b.tab b_vs_a.tab -o a_rbbh_b.tab --pid 0.8 \
+--cov 0.8 --store res.sqlite --genomes a b'
+    """
+    options = "-o %s --pid %s --cov %s" % (rbhfile, identity, coverage)
+    if bestfiles is not None:
+        options = "%s --best %s %s" % ((options,) + tuple(bestfiles))
+    if storefile is not None:
+        options = "%s --store %s --genomes %s %s" % ((options, storefile) +
+                                                    tuple(genomes))
+    if sweepfile is not None:
+        options = "%s --sweep %s %s" % (options, sweepfile,
+                                        ' '.join("%s,%s" % point for point in
+                                                 thresholds))
+    return construct_helper_cmd('rbh', "%s %s %s" % (fwdfile, revfile,
+                                                     options))
+
+
+# Make a command line running a pyrbbh helper module
+def construct_helper_cmd(module, args):
+    """Returns a command line running the named module of the pyrbbh package
+    as a script, with the passed arguments, starting with HELPER_PREFIX.
+
+    - module - name of the module within the pyrbbh package
+    - args - string of arguments to the module
+
+    The directory holding the pyrbbh package is put on the module path, so
+    that the command runs in any working directory: an SGE task, a work
+    queue worker, or a job of an exported plan.
+
+    >>> construct_helper_cmd('rbh', \
+'a_vs_b.tab b_vs_a.tab') #doctest: +ELLIPSIS
+    'PYTHONPATH=...${PYTHONPATH:+:$PYTHONPATH} ... -m pyrbbh.rbh a_vs_b.tab \
+b_vs_a.tab'
+    """
+    return "%s%s %s" % (HELPER_PREFIX, module, args)
@@ -0,0 +1,196 @@
+# Copyright 2015-2016 The James Hutton Institute
+# Author: Leighton Pritchard
+#
+# cache.py
+#
+# This code is part of the pyrbbh package, and is governed by its licence.
+# Please see the LICENSE file that should have been included as part of this
+# package.
+
+"""Module to record completed jobs, so that reruns only do new work.
+
+Each Job is keyed by a content hash of its input files, the version of the
+executable it runs, and its command line. When a Job completes, a stamp
+file named for that key is written to a cache directory in the output
+directory. On a rerun, any Job with a stamp whose output files are all
+still present is skipped, unless a Job it depends on has to be rerun.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import subprocess
+import weakref
+
+from . import jobs
+
+# Name of the cache directory, within the output directory
+CACHE_DIRNAME = '.pyrbbh_cache'
+
+# Argument reporting the version of an executable not run by the search
+# engine (BLAST+ style)
+VERSION_OPTION_DEFAULT = '-version'
+
+
+# The JobCache class records completed Jobs in an output directory
+class JobCache:
+    """Objects in this class record completed Jobs as stamp files, keyed by a
+    hash of the Job's inputs, executable version and command line.
+    """
+    def __init__(self, outdir, engine=None):
+        """Instantiates a JobCache object.
+
+        - outdir         Path to the output directory holding the cache
+        - engine         engines.SearchEngine run by the Jobs, whose version
+                         option is used to ask its executables' versions
+
+        >>> from .engines import DiamondEngine
+        >>> JobCache('out', DiamondEngine()).version_options
+        {'diamond': 'version'}
+        """
+        self.cachedir = os.path.join(outdir, CACHE_DIRNAME)
+        self.version_options = {}        # executable -> version argument
+        if engine is not None:
+            for exe in (engine.search_exe, engine.db_exe):
+                self.version_options[exe] = engine.version_option
+        self._filehashes = {}            # (path, size, mtime) -> hash
+        self._versions = {}              # executable -> version string
+
+    def hash_file(self, filename):
+        """Returns the SHA-256 hex digest of the passed file's contents.
+        Digests are remembered, so each file is read at most once, unless it
+        changes.
+
+        - filename       Path to file
+        """
+        stat = os.stat(filename)
+        memokey = (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+        if memokey not in self._filehashes:
+            digest = hashlib.sha256()
+            with open(filename, 'rb') as fh:
+                for block in iter(lambda: fh.read(1 << 20), b''):
+                    digest.update(block)
+            self._filehashes[memokey] = digest.hexdigest()
+        return self._filehashes[memokey]
+
+    def get_version(self, exe):
+        """Returns the version string reported by the passed executable,
+        or an empty string if it cannot be run.
+
+        - exe            Path to executable
+
+        The version is asked for with the search engine's version option
+        if exe is one of its executables, or VERSION_OPTION_DEFAULT
+        otherwise. Some tools (e.g. VSEARCH) report it on stderr, which is
+        read with stdout.
+        """
+        if exe not in self._versions:
+            option = self.version_options.get(exe, VERSION_OPTION_DEFAULT)
+            try:
+                self._versions[exe] = subprocess.check_output(
+                    [exe, option], stderr=subprocess.STDOUT,
+                    universal_newlines=True).strip()
+            except (OSError, subprocess.CalledProcessError):
+                self._versions[exe] = ''
+        return self._versions[exe]
+
+    def key(self, job):
+        """Returns the cache key for the passed Job.
+
+        - job            Job object
+        """
+        digest = hashlib.sha256()
+        for fname in job.inputs:
+            digest.update(self.hash_file(fname).encode())
+        if job.executable is not None:
+            digest.update(self.get_version(job.executable).encode())
+        digest.update(job.command.encode())
+        return digest.hexdigest()
+
+    def stamp_path(self, job):
+        """Returns the path to the stamp file for the passed Job.
+
+        - job            Job object
+        """
+        return os.path.join(self.cachedir, self.key(job))
+
+    def is_complete(self, job):
+        """Returns True if the passed Job has a stamp in the cache, and every
+        one of its output patterns matches at least one file.
+
+        - job            Job object
+        """
+        if not os.path.isfile(self.stamp_path(job)):
+            return False
+        return all(glob.glob(pattern) for pattern in job.outputs)
+
+    def record(self, job):
+        """Writes a stamp to the cache recording that the passed Job has
+        completed.
+
+        - job            Job object
+        """
+        os.makedirs(self.cachedir, exist_ok=True)
+        with open(self.stamp_path(job), 'w') as fh:
+            json.dump({'name': job.name, 'command': job.command,
+                       'inputs': job.inputs, 'outputs': job.outputs}, fh)
+
+
+# Remove Jobs with cached results from a job dependency graph
+def remove_completed(jobgraph, cache, logger=None):
+    """Returns a list of the Jobs in jobgraph that must be run, removing
+    those already completed according to the passed JobCache.
+
+    - jobgraph - dependency graph of Job objects as list of Jobs
+    - cache - JobCache object
+    - logger - logger object
+
+    Jobs are visited in dependency order. A Job is only skipped if it is
+    complete and none of the Jobs it depends on is to be rerun. Remaining
+    Jobs have their dependencies on skipped Jobs removed.
+    """
+    tracker = jobs.JobTracker(jobgraph)
+    skipped = set()
+    while tracker.has_ready:
+        for job in tracker.pop_ready():
+            if all(dep in skipped for dep in job.dependencies) and \
+               cache.is_complete(job):
+                skipped.add(job)
+            tracker.complete(job)
+    joblist = [job for job in jobgraph if job not in skipped]
+    for job in joblist:
+        for dep in [dep for dep in job.dependencies if dep in skipped]:
+            job.remove_dependency(dep)
+    if logger:
+        logger.info("Skipping %d jobs with cached results" % len(skipped))
+    return joblist
+
+
+# Skip Jobs with cached results as they are generated
+def skip_completed(jobiter, cache, logger=None):
+    """Yields the Jobs from the iterable jobiter that must be run, skipping
+    those already completed according to the passed JobCache.
+
+    - jobiter - iterable of Job objects, each after the Jobs it depends on
+    - cache - JobCache object
+    - logger - logger object
+
+    As for remove_completed(), a Job is only skipped if it is complete and
+    none of the Jobs it depends on is to be rerun, and Jobs that are yielded
+    have their dependencies on skipped Jobs removed. Skipped Jobs are only
+    remembered while other Jobs refer to them.
+    """
+    skipped = weakref.WeakSet()
+    count = 0
+    for job in jobiter:
+        if all(dep in skipped for dep in job.dependencies) and \
+           cache.is_complete(job):
+            skipped.add(job)
+            count += 1
+            continue
+        for dep in [dep for dep in job.dependencies if dep in skipped]:
+            job.remove_dependency(dep)
+        yield job
+    if logger:
+        logger.info("Skipped %d jobs with cached results" % count)
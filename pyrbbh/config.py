@@ -9,9 +9,48 @@
 
 """Configuration settings for the pyrbbh package."""
 
+import os
+import sys
+
 # BLAST executables
 BLASTDB_DEFAULT = "makeblastdb"
 BLASTP_DEFAULT = "blastp"
 
+# Other search executables
+DIAMOND_DEFAULT = "diamond"
+VSEARCH_DEFAULT = "vsearch"
+
+# Python interpreter used to run pyrbbh helper modules within jobs, and the
+# directory holding the pyrbbh package, put on the helpers' module path so
+# that they run from any working directory
+PYTHON_DEFAULT = sys.executable
+PYRBBH_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Number of times a failed job is retried, and seconds before the first
+# retry (doubling for each retry after). Most failures (bad input, a missing
+# executable) fail again on retry, so jobs are retried only on request.
+RETRIES = 0
+RETRY_BACKOFF = 30
+
 # SGE/OGE/OGS scheduler parameters
 SGE_WAIT = 0.01
+QSUB_DEFAULT = "qsub"
+QSTAT_DEFAULT = "qstat"
+SGE_ARRAY_MAX = 50000  # largest number of tasks in a single array job
+
+# Shortest and longest seconds between polls of the status of SGE tasks, and
+# the number of polls per qstat call: sentinel files are read at every poll,
+# but the whole queue is listed only every SGE_QSTAT_EVERY polls. A task is
+# taken to be lost once it is missing from SGE_LOST_LISTINGS consecutive
+# qstat listings without a sentinel, as a network filesystem may show a new
+# sentinel late.
+SGE_POLL_MIN = 5
+SGE_POLL_MAX = 60
+SGE_QSTAT_EVERY = 4
+SGE_LOST_LISTINGS = 2
+
+# Work queue parameters: default coordinator port, and seconds between
+# worker heartbeats, and of silence before a worker is taken to be lost
+QUEUE_PORT = 7460
+QUEUE_HEARTBEAT = 10
+QUEUE_TIMEOUT = 60
@@ -0,0 +1,172 @@
+# Copyright 2015-2016 The James Hutton Institute
+# Author: Leighton Pritchard
+#
+# costs.py
+#
+# This code is part of the pyrbbh package, and is governed by its licence.
+# Please see the LICENSE file that should have been included as part of this
+# package.
+
+"""Module to estimate the running time of jobs, so the longest run first.
+
+The work done by a Job is estimated from the number of residues in its
+input files: for a search, the product of query and database residues,
+and otherwise their sum. Residue counts are taken from the sequence
+indices (see seqindex) where available, and from file sizes otherwise.
+
+Each kind of Job (named for its executable and whether it is a search, as
+DIAMOND and VSEARCH build databases and search them with one executable)
+has a rate, in CPU seconds per unit of work. Rates start from rough
+defaults, and are refined from the CPU times recorded for Jobs in earlier
+runs, which are kept in a JSON file, so that estimates improve from run to
+run.
+"""
+
+import json
+import os
+
+# CPU seconds per unit of work for each kind of Job, before any timings
+DEFAULT_RATES = {'blastp:search': 4e-10, 'makeblastdb:db': 1e-6,
+                 'diamond:search': 2e-12, 'diamond:db': 1e-7,
+                 'vsearch:search': 1e-10, 'vsearch:db': 1e-7, 'other': 1e-7}
+
+# Default name of the file of timings, in the output directory
+COSTS_FILENAME = 'pyrbbh_costs.json'
+
+
+# The CostModel class estimates the running time of Jobs
+class CostModel:
+    """Objects in this class estimate the CPU time of Jobs from the size of
+    their inputs, learning rates from the timings of completed Jobs.
+    """
+    def __init__(self, indices=None):
+        """Instantiates a CostModel object.
+
+        - indices        Dictionary of seqindex.FastaIndex objects, keyed by
+                         path, giving residue counts for input files
+
+        >>> from .jobs import Job
+        >>> job = Job('myjob', 'diamond blastp')
+        >>> job.executable = '/usr/bin/diamond'
+        >>> job.inputs = ['q.fasta', 'd.fasta']
+        >>> model = CostModel()
+        >>> model.kind(job)
+        'diamond:search'
+        >>> job.inputs = ['d.fasta']
+        >>> model.kind(job)
+        'diamond:db'
+        """
+        self.indices = indices if indices is not None else {}
+        self.timings = {}                # kind -> {'work', 'seconds'}
+        self._residues = {}              # path -> residue count
+
+    def is_search(self, job):
+        """Returns True if the passed Job is a search, of a query file
+        against a database built from a second file.
+
+        - job            Job object
+        """
+        return job.executable is not None and len(job.inputs) == 2
+
+    def kind(self, job):
+        """Returns the kind of the passed Job: the name of its executable,
+        with ':search' for searches or ':db' for database builds, or 'other'.
+
+        - job            Job object
+        """
+        if job.executable is None:
+            return 'other'
+        return "%s:%s" % (os.path.split(job.executable)[-1],
+                          'search' if self.is_search(job) else 'db')
+
+    def residues(self, fname):
+        """Returns the number of residues in the passed FASTA file, from its
+        index if there is one, or estimated from its size if not.
+
+        - fname          Path to FASTA file
+        """
+        if fname not in self._residues:
+            if fname in self.indices:
+                self._residues[fname] = self.indices[fname].residues
+            elif os.path.isfile(fname):
+                self._residues[fname] = os.path.getsize(fname)
+            else:
+                return 1
+        return max(1, self._residues[fname])
+
+    def work(self, job):
+        """Returns the work done by the passed Job: the product of the
+        residues in the query and database of a search, or the total
+        residues in the inputs of other Jobs.
+
+        - job            Job object
+        """
+        residues = [self.residues(fname) for fname in job.inputs]
+        if self.is_search(job):
+            return float(residues[0] * residues[1])
+        return float(sum(residues) or 1)
+
+    def rate(self, kind):
+        """Returns the CPU seconds per unit of work for the passed kind of Job,
+        from recorded timings if there are any, or the default otherwise.
+
+        - kind           Kind of Job, as returned by CostModel.kind()
+
+        >>> model = CostModel()
+        >>> model.timings['blastp:search'] = {'work': 1e12, 'seconds': 500.0}
+        >>> (model.rate('blastp:search'),
+        ...  model.rate('unknown') == model.rate('other'))
+        (5e-10, True)
+        """
+        timing = self.timings.get(kind)
+        if timing and timing['work'] > 0 and timing['seconds'] > 0:
+            return timing['seconds'] / timing['work']
+        return DEFAULT_RATES.get(kind, DEFAULT_RATES['other'])
+
+    def estimate(self, job):
+        """Returns the estimated CPU time of the passed Job, in seconds.
+
+        - job            Job object
+        """
+        return self.work(job) * self.rate(self.kind(job))
+
+    def update(self, jobgraph):
+        """Adds the timings of the successfully completed Jobs in the passed
+        dependency graph to those the model learns rates from. A Job's CPU
+        time is used where it was recorded, and otherwise its wall time
+        multiplied by the cores it was allocated.
+
+        - jobgraph       Iterable of Job objects
+        """
+        for job in jobgraph:
+            stats = job.stats
+            if stats.get('exit_code') != 0:
+                continue
+            seconds = stats.get('cpu_time')
+            if seconds is None and stats.get('wall_time') is not None:
+                seconds = stats['wall_time'] * stats.get('threads', 1)
+            if seconds is None:
+                continue
+            timing = self.timings.setdefault(self.kind(job),
+                                             {'work': 0.0, 'seconds': 0.0})
+            timing['work'] += self.work(job)
+            timing['seconds'] += seconds
+
+    def load(self, filename):
+        """Reads timings recorded by an earlier run from the passed file, if
+        it exists.
+
+        - filename       Path to JSON file of timings
+        """
+        if os.path.isfile(filename):
+            with open(filename) as fh:
+                self.timings = json.load(fh)
+
+    def save(self, filename):
+        """Writes the model's timings to the passed file.
+
+        - filename       Path to JSON file of timings
+        """
+        with open(filename + '.tmp', 'w') as ofh:
+            json.dump(self.timings, ofh, indent=2)
+        os.replace(filename + '.tmp', filename)
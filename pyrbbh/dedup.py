@@ -0,0 +1,194 @@
+# Copyright 2015-2016 The James Hutton Institute
+# Author: Leighton Pritchard
+#
+# dedup.py
+#
+# This code is part of the pyrbbh package, and is governed by its licence.
+# Please see the LICENSE file that should have been included as part of this
+# package.
+
+"""Module to search only one copy of each identical sequence.
+
+Every sequence in every input file is hashed, and one representative of
+each distinct sequence is written to a single FASTA file, which is searched
+against itself. A mapping table records the genome and ID of each member of
+each representative. When reciprocal best hits are called, the best hit of
+each representative in each genome is found, and expanded back to every
+member, giving the hits that pairwise searches of the input files would.
+
+Where a genome holds several identical copies of a sequence, all are equally
+good hits; the first in its input file is taken as the best hit, so that
+each query has a single best hit in each genome.
+"""
+
+import hashlib
+import os
+
+import pandas as pd
+from Bio import SeqIO
+
+from .rbh import best_hits, read_hits, reciprocal_best_hits
+
+# Filestem of the representative sequence file and mapping table
+DEDUP_STEM = 'pyrbbh_unique'
+
+# Prefix for representative sequence IDs
+REP_PREFIX = 'U'
+
+
+# Write one representative of each distinct sequence to a FASTA file
+def write_unique_fasta(infiles, fastafile, mapfile):
+    """Writes one copy of each distinct sequence in the passed FASTA files to
+    fastafile, and a tab-separated table with columns 'rep', 'genome' and
+    'seqid' mapping each input sequence to its representative, to mapfile.
+    Returns a tuple of (number of sequences, number of representatives).
+
+    - infiles - list of paths to input FASTA files
+    - fastafile - path to FASTA file of representative sequences
+    - mapfile - path to mapping table
+
+    Sequences are compared case-insensitively, by SHA-1 digest.
+    Representatives are numbered in order of first appearance, with IDs
+    REP_PREFIX followed by nine digits.
+    """
+    reps = {}  # digest -> representative ID
+    count = 0
+    with open(fastafile, 'w') as ofh, open(mapfile, 'w') as mfh:
+        mfh.write("rep\tgenome\tseqid\n")
+        for fname in infiles:
+            stem = os.path.splitext(os.path.split(fname)[-1])[0]
+            for record in SeqIO.parse(fname, 'fasta'):
+                seq = str(record.seq).upper()
+                digest = hashlib.sha1(seq.encode()).digest()
+                if digest not in reps:
+                    reps[digest] = "%s%09d" % (REP_PREFIX, len(reps))
+                    ofh.write(">%s\n%s\n" % (reps[digest], seq))
+                mfh.write("%s\t%s\t%s\n" % (reps[digest], stem, record.id))
+                count += 1
+    return count, len(reps)
+
+
+# Deduplicate the input files, writing to the output directory
+def deduplicate(infiles, outdir, logger=None):
+    """Returns a tuple of paths (representative FASTA file, mapping table)
+    for the passed input files, written to outdir as
+    '<DEDUP_STEM>.fasta' and '<DEDUP_STEM>.map'.
+
+    - infiles - list of paths to input FASTA files
+    - outdir - path to output directory
+    - logger - logger object
+    """
+    fastafile = os.path.join(outdir, DEDUP_STEM + '.fasta')
+    mapfile = os.path.join(outdir, DEDUP_STEM + '.map')
+    count, nreps = write_unique_fasta(infiles, fastafile, mapfile)
+    if logger:
+        logger.info("%d sequences have %d distinct representatives" %
+                    (count, nreps))
+    return fastafile, mapfile
+
+
+# Load a mapping table of representatives to members
+def read_mapping(mapfile):
+    """Returns a dataframe of the mapping table in mapfile, with columns
+    'rep', 'genome' and 'seqid'.
+
+    - mapfile - path to mapping table
+    """
+    return pd.read_csv(mapfile, sep='\t', dtype=str)
+
+
+# Find the best hit of each representative in each genome
+def best_hits_by_genome(hits, mapping, identity=0.8, coverage=0.8):
+    """Returns a dataframe of the best hit of each query representative in
+    each genome, from the passed dataframe of representative-against-
+    representative HSPs.
+
+    - hits - dataframe of HSPs, as returned by rbh.read_hits()
+    - mapping - dataframe mapping representatives to members
+    - identity - minimum fractional percentage identity of a hit
+    - coverage - minimum fractional query coverage of a hit
+
+    Subject representatives are replaced by their first member in each
+    genome in which they occur, in the 'sseqid' column, with the genome in
+    an extra 'sgenome' column.
+    """
+    firsts = mapping.drop_duplicates(['rep', 'genome'])
+    firsts = firsts.rename(columns={'rep': 'sseqid', 'genome': 'sgenome',
+                                    'seqid': 'smember'})
+    passed = best_hits(hits, identity, coverage, keys=('qseqid', 'sseqid'))
+    best = passed.merge(firsts, on='sseqid')
+    best = best.sort_values('bitscore', ascending=False, kind='mergesort')
+    best = best.drop_duplicates(['qseqid', 'sgenome'])
+    return best.assign(sseqid=best['smember']).drop(columns='smember')
+
+
+# Expand best hits of representatives to best hits of members
+def expand_best_hits(best, mapping, qgenome, sgenome):
+    """Returns a dataframe of the best hit in genome sgenome of each sequence
+    in genome qgenome, as for rbh.best_hits() on a pairwise search.
+
+    - best - dataframe of best hits, as returned by best_hits_by_genome()
+    - mapping - dataframe mapping representatives to members
+    - qgenome - filestem of the query genome
+    - sgenome - filestem of the subject genome
+    """
+    members = mapping.loc[mapping['genome'] == qgenome, ['rep', 'seqid']]
+    subjects = best[best['sgenome'] == sgenome]
+    expanded = members.merge(subjects, left_on='rep', right_on='qseqid')
+    expanded = expanded.assign(qseqid=expanded['seqid'])
+    return expanded.drop(columns=['rep', 'seqid', 'sgenome'])
+
+
+# Call best hits for each pair of genomes from one search
+def iter_best_hits(hitsfile, mapfile, infiles, identity=0.8, coverage=0.8):
+    """Yields a tuple of dataframes (forward best hits, reverse best hits)
+    for each pair of input files, in the order of rbh.get_rbh_pairs(), as
+    rbh.call_best_hits() would return for pairwise searches, from the BLASTP
+    output of the representative sequences searched against themselves.
+
+    - hitsfile - path to BLASTP output of representatives
+    - mapfile - path to mapping table
+    - infiles - list of paths to input FASTA files
+    - identity - minimum fractional percentage identity of a hit
+    - coverage - minimum fractional query coverage of a hit
+    """
+    mapping = read_mapping(mapfile)
+    best = best_hits_by_genome(read_hits(hitsfile), mapping, identity,
+                               coverage)
+    stems = [os.path.splitext(os.path.split(fname)[-1])[0] for fname in
+             infiles]
+    for idx, stem1 in enumerate(stems):
+        for stem2 in stems[idx+1:]:
+            yield (expand_best_hits(best, mapping, stem1, stem2),
+                   expand_best_hits(best, mapping, stem2, stem1))
+
+
+# Call reciprocal best hits at a grid of thresholds from one search
+def iter_sweep(hitsfile, mapfile, infiles, thresholds):
+    """Yields a dataframe of reciprocal best hits at each of the passed
+    (identity, coverage) thresholds for each pair of input files, in the
+    order of rbh.get_rbh_pairs(), as rbh.sweep_rbh() would return for
+    pairwise searches. The BLASTP output is read once.
+
+    - hitsfile - path to BLASTP output of representatives
+    - mapfile - path to mapping table
+    - infiles - list of paths to input FASTA files
+    - thresholds - list of (identity, coverage) tuples of fractional minima
+    """
+    mapping = read_mapping(mapfile)
+    hits = read_hits(hitsfile)
+    bests = [best_hits_by_genome(hits, mapping, identity, coverage) for
+             identity, coverage in thresholds]
+    stems = [os.path.splitext(os.path.split(fname)[-1])[0] for fname in
+             infiles]
+    for idx, stem1 in enumerate(stems):
+        for stem2 in stems[idx+1:]:
+            sets = []
+            for (identity, coverage), best in zip(thresholds, bests):
+                rbhits = reciprocal_best_hits(
+                    expand_best_hits(best, mapping, stem1, stem2),
+                    expand_best_hits(best, mapping, stem2, stem1))
+                rbhits.insert(0, 'coverage', coverage)
+                rbhits.insert(0, 'identity', identity)
+                sets.append(rbhits)
+            yield pd.concat(sets, ignore_index=True)
@@ -0,0 +1,268 @@
+# Copyright 2015-2016 The James Hutton Institute
+# Author: Leighton Pritchard
+#
+# engines.py
+#
+# This code is part of the pyrbbh package, and is governed by its licence.
+# Please see the LICENSE file that should have been included as part of this
+# package.
+
+"""Module describing the sequence search tools pyrbbh can run.
+
+Each search engine knows how to build a database from a FASTA file, how to
+search query sequences against that database, and which of its output
+fields to write for each column of a normalised hit table (see
+blast.BLASTP_COLUMNS), so that every engine writes hit tables in the same
+tabular format, and everything downstream of the searches is shared.
+
+- BlastEngine - BLAST+ blastp and makeblastdb (the default)
+- DiamondEngine - DIAMOND blastp and makedb, much faster than BLASTP for
+  large protein sets, and reporting query coverage per HSP only
+- VsearchEngine - VSEARCH global alignment of nucleotide sequences, which
+  reports raw alignment scores in place of bitscores
+"""
+
+import os
+
+from .config import (BLASTP_DEFAULT, BLASTDB_DEFAULT, DIAMOND_DEFAULT,
+                     VSEARCH_DEFAULT)
+
+
+# The SearchEngine class is the interface to a sequence search tool
+class SearchEngine:
+    """Objects in this class build the command lines to make a database,
+    and to search it, with a sequence search tool.
+
+    Subclasses set name, FIELDS, the default executables, and the thread
+    and version options, and implement construct_db_cmd() and
+    construct_search_cmd().
+    """
+    name = None
+    FIELDS = {}                          # hit table column -> output field
+    SEARCH_DEFAULT = None                # default search executable
+    DB_DEFAULT = None                    # default database executable
+    DB_SUFFIXES = ('',)                  # suffixes of database files
+    thread_option = None                 # option setting number of threads
+    version_option = None                # argument reporting the version
+
+    def __init__(self, search_exe=None, db_exe=None):
+        """Instantiates a SearchEngine object.
+
+        - search_exe     Path to search executable (default: SEARCH_DEFAULT)
+        - db_exe         Path to database executable (default: DB_DEFAULT)
+        """
+        self.search_exe = search_exe or self.SEARCH_DEFAULT
+        self.db_exe = db_exe or self.DB_DEFAULT
+
+    def fields(self, columns):
+        """Returns a list of the output fields written for the passed hit
+        table columns, in the same order.
+
+        - columns        Sequence of normalised hit table column names
+
+        >>> DiamondEngine().fields(('qseqid', 'qcovs'))
+        ['qseqid', 'qcovhsp']
+        """
+        return [self.FIELDS.get(col, col) for col in columns]
+
+    def get_db_outputs(self, dbname):
+        """Returns a list of path patterns matching the files of the database
+        dbname.
+
+        - dbname         Path to database, as passed to construct_db_cmd()
+        """
+        return [dbname + suffix for suffix in self.DB_SUFFIXES]
+
+    def construct_db_cmd(self, infile, dbname):
+        """Returns the command line building the database dbname from the
+        FASTA file infile.
+
+        - infile         Path to FASTA file
+        - dbname         Path to database
+        """
+        raise NotImplementedError
+
+    def construct_search_cmd(self, qfile, dbname, columns, outfile=None,
+                             max_targets=None):
+        """Returns the command line searching the sequences in qfile against
+        the database dbname, writing the passed hit table columns as
+        tab-separated text.
+
+        - qfile          Path to query FASTA file
+        - dbname         Path to database
+        - columns        Sequence of normalised hit table column names
+        - outfile        Path to output file, or None to write to stdout
+        - max_targets    Maximum number of database sequences to report for
+                         each query, or None for the engine default
+        """
+        raise NotImplementedError
+
+
+# BLAST+ blastp and makeblastdb
+class BlastEngine(SearchEngine):
+    """BLAST+ protein searches with blastp, against databases built with
+    makeblastdb. Output fields are named as the hit table columns.
+    """
+    name = 'blast'
+    SEARCH_DEFAULT = BLASTP_DEFAULT
+    DB_DEFAULT = BLASTDB_DEFAULT
+    DB_SUFFIXES = ('.p*',)
+    thread_option = '-num_threads'
+    version_option = '-version'
+
+    def construct_db_cmd(self, infile, dbname):
+        """Returns the makeblastdb command line building the protein
+        database dbname from infile, titled with the filestem of dbname.
+
+        - infile         Path to FASTA file
+        - dbname         Path to database
+
+        >>> BlastEngine().construct_db_cmd('in/a.fasta', 'out/a.fasta')
+        'makeblastdb -dbtype prot -in in/a.fasta -title a -out out/a.fasta'
+        """
+        stem = os.path.splitext(os.path.split(dbname)[-1])[0]
+        return "{0} -dbtype prot -in {1} -title {2} -out {3}".format(
+            self.db_exe, infile, stem, dbname)
+
+    def construct_search_cmd(self, qfile, dbname, columns, outfile=None,
+                             max_targets=None):
+        """Returns the blastp command line searching qfile against dbname.
+        Arguments are as for SearchEngine.construct_search_cmd().
+
+        >>> BlastEngine().construct_search_cmd('q.fasta', 'd.fasta', \
+('qseqid', 'sseqid'), 'q_vs_d.tab')
+        "blastp -out q_vs_d.tab -query q.fasta -db d.fasta -outfmt \
+'6 qseqid sseqid'"
+        """
+        formatstr = "'6 %s'" % ' '.join(self.fields(columns))
+        targets = ""
+        if max_targets is not None:
+            targets = " -max_target_seqs %d" % max_targets
+        if outfile is None:
+            cmd = "{0} -query {1} -db {2}{3} -outfmt {4}"
+            return cmd.format(self.search_exe, qfile, dbname, targets,
+                              formatstr)
+        cmd = "{0} -out {1} -query {2} -db {3}{4} -outfmt {5}"
+        return cmd.format(self.search_exe, outfile, qfile, dbname, targets,
+                          formatstr)
+
+
+# DIAMOND blastp and makedb
+class DiamondEngine(SearchEngine):
+    """DIAMOND protein searches, against databases built with diamond
+    makedb. DIAMOND does not report query coverage per subject, so query
+    coverage per HSP is written in its place.
+    """
+    name = 'diamond'
+    FIELDS = {'qcovs': 'qcovhsp'}
+    SEARCH_DEFAULT = DIAMOND_DEFAULT
+    DB_DEFAULT = DIAMOND_DEFAULT
+    DB_SUFFIXES = ('.dmnd',)
+    thread_option = '--threads'
+    version_option = 'version'
+
+    def construct_db_cmd(self, infile, dbname):
+        """Returns the diamond makedb command line building the database
+        dbname (written as dbname.dmnd) from infile.
+
+        - infile         Path to FASTA file
+        - dbname         Path to database
+
+        >>> DiamondEngine().construct_db_cmd('in/a.fasta', 'out/a.fasta')
+        'diamond makedb --in in/a.fasta --db out/a.fasta'
+        """
+        return "{0} makedb --in {1} --db {2}".format(self.db_exe, infile,
+                                                     dbname)
+
+    def construct_search_cmd(self, qfile, dbname, columns, outfile=None,
+                             max_targets=None):
+        """Returns the diamond blastp command line searching qfile against
+        dbname. Arguments are as for SearchEngine.construct_search_cmd().
+
+        >>> DiamondEngine().construct_search_cmd('q.fasta', 'd.fasta', \
+('qseqid', 'qcovs'), max_targets=5)
+        'diamond blastp --query q.fasta --db d.fasta --max-target-seqs 5 \
+--outfmt 6 qseqid qcovhsp'
+        """
+        cmd = "{0} blastp --query {1} --db {2}".format(self.search_exe, qfile,
+                                                       dbname)
+        if outfile is not None:
+            cmd = "%s --out %s" % (cmd, outfile)
+        if max_targets is not None:
+            cmd = "%s --max-target-seqs %d" % (cmd, max_targets)
+        return "%s --outfmt 6 %s" % (cmd, ' '.join(self.fields(columns)))
+
+
+# VSEARCH global alignment
+class VsearchEngine(SearchEngine):
+    """VSEARCH global alignment searches of nucleotide sequences, against
+    databases built with vsearch --makeudb_usearch. VSEARCH does not
+    compute bitscores for nucleotide alignments, so the raw alignment score
+    is written in their place, and best hits are chosen by it.
+    """
+    name = 'vsearch'
+    FIELDS = {'qseqid': 'query', 'sseqid': 'target', 'qlen': 'ql',
+              'slen': 'tl', 'bitscore': 'raw', 'length': 'alnlen',
+              'nident': 'ids', 'pident': 'id', 'qcovhsp': 'qcov',
+              'qcovs': 'qcov', 'qstart': 'qlo', 'qend': 'qhi',
+              'sstart': 'tlo', 'send': 'thi'}
+    SEARCH_DEFAULT = VSEARCH_DEFAULT
+    DB_DEFAULT = VSEARCH_DEFAULT
+    DB_SUFFIXES = ('.udb',)
+    thread_option = '--threads'
+    version_option = '--version'
+
+    # Lowest identity of an alignment reported by VSEARCH, and number of
+    # targets reported per query when none is given
+    MIN_IDENTITY = 0.3
+    MAX_ACCEPTS = 5
+
+    def construct_db_cmd(self, infile, dbname):
+        """Returns the vsearch command line building the UDB database
+        dbname.udb from infile.
+
+        - infile         Path to FASTA file
+        - dbname         Path to database
+
+        >>> VsearchEngine().construct_db_cmd('in/a.fasta', 'out/a.fasta')
+        'vsearch --makeudb_usearch in/a.fasta --output out/a.fasta.udb'
+        """
+        return "{0} --makeudb_usearch {1} --output {2}.udb".format(
+            self.db_exe, infile, dbname)
+
+    def construct_search_cmd(self, qfile, dbname, columns, outfile=None,
+                             max_targets=None):
+        """Returns the vsearch --usearch_global command line searching qfile
+        against dbname.udb. Arguments are as for
+        SearchEngine.construct_search_cmd().
+
+        >>> VsearchEngine().construct_search_cmd('q.fasta', 'd.fasta', \
+('qseqid', 'bitscore'), 'q_vs_d.tab')
+        'vsearch --usearch_global q.fasta --db d.fasta.udb --id 0.3 \
+--maxaccepts 5 --userout q_vs_d.tab --userfields query+raw'
+        """
+        cmd = "{0} --usearch_global {1} --db {2}.udb --id {3} " \
+              "--maxaccepts {4} --userout {5} --userfields {6}"
+        return cmd.format(self.search_exe, qfile, dbname, self.MIN_IDENTITY,
+                          max_targets or self.MAX_ACCEPTS,
+                          outfile or '/dev/stdout',
+                          '+'.join(self.fields(columns)))
+
+
+# Search engines, by name
+ENGINES = {engine.name: engine for engine in (BlastEngine, DiamondEngine,
+                                              VsearchEngine)}
+
+
+# Return a search engine by name
+def get_engine(name, search_exe=None, db_exe=None):
+    """Returns a SearchEngine object for the named engine.
+
+    - name - engine name, a key of ENGINES
+    - search_exe - path to search executable (default: the engine's)
+    - db_exe - path to database executable (default: the engine's)
+
+    >>> get_engine('diamond').search_exe
+    'diamond'
+    """
+    return ENGINES[name](search_exe, db_exe)
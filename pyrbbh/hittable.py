@@ -0,0 +1,422 @@
+# Copyright 2015-2016 The James Hutton Institute
+# Author: Leighton Pritchard
+#
+# hittable.py
+#
+# This code is part of the pyrbbh package, and is governed by its licence.
+# Please see the LICENSE file that should have been included as part of this
+# package.
+
+"""Module to store BLASTP hit tables in a compact, columnar binary format.
+
+Tabular BLASTP output is text, which is parsed again by every job that
+reads it. A binary hit table holds the same columns (see
+blast.BLASTP_COLUMNS) in a single file, from which each column can be
+memory-mapped and used without parsing or copying:
+
+- numeric columns are stored as little-endian typed arrays, of the data
+  types in blast.HIT_DTYPES
+- sequence ID columns are interned: each distinct ID is stored once, in a
+  table of names, and the column holds a 32-bit integer code for each row,
+  indexing that table
+
+The file begins with an 8-byte magic string, the length of a JSON header
+as an unsigned 64-bit integer, and the header itself, which gives the
+number of rows, and the data type, byte offset and size of each block.
+Blocks follow the header, each starting on a 64-byte boundary.
+
+Search output is converted as it is written, CHUNKSIZE HSPs at a time, by
+running this module as a wrapper around a search command that writes
+tabular output to stdout:
+
+    python -m pyrbbh.hittable -o OUTFILE -- blastp ...
+
+and existing hit tables, text or binary, are converted and concatenated
+with:
+
+    python -m pyrbbh.hittable -o OUTFILE -i INFILE [INFILE ...]
+
+The exit code of the wrapped command is returned, and output is only
+written if it succeeds.
+"""
+
+import argparse
+import io
+import json
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from .blast import BLASTP_COLUMNS, HIT_DTYPES, HITTABLE_EXT
+
+# Magic string and format version identifying a binary hit table
+MAGIC = b'PYRBBHIT'
+VERSION = 1
+
+# Struct format of the header length, and the byte boundary on which each
+# block starts
+LENGTH_FORMAT = '<Q'
+ALIGN = 64
+
+# Columns holding sequence IDs, stored as codes into a table of names
+ID_COLUMNS = ('qseqid', 'sseqid')
+CODE_DTYPE = '<i4'
+
+# Number of HSPs to read from text output at a time
+CHUNKSIZE = 100000
+
+
+# Return the data type in which a hit table column is stored
+def column_dtype(col):
+    """Returns the NumPy dtype in which the named hit table column is
+    stored: integer codes for sequence ID columns, and the little-endian
+    form of its data type in blast.HIT_DTYPES otherwise.
+
+    - col - name of a column in blast.BLASTP_COLUMNS
+
+    >>> column_dtype('qseqid').str, column_dtype('bitscore').str
+    ('<i4', '<f8')
+    """
+    if col in ID_COLUMNS:
+        return np.dtype(CODE_DTYPE)
+    return np.dtype(HIT_DTYPES[col]).newbyteorder('<')
+
+
+# Round a byte offset up to the next block boundary
+def align(offset):
+    """Returns offset rounded up to a multiple of ALIGN.
+
+    - offset - byte offset
+
+    >>> align(0), align(1), align(64)
+    (0, 64, 64)
+    """
+    return -(-offset // ALIGN) * ALIGN
+
+
+# Create an empty dataframe of HSPs
+def empty_hits():
+    """Returns an empty dataframe with the columns and data types of a
+    BLASTP hit table.
+    """
+    return pd.DataFrame({col: pd.Series(dtype=HIT_DTYPES[col]) for col in
+                         BLASTP_COLUMNS})
+
+
+# Load BLASTP tabular text output into a dataframe
+def read_text_hits(source):
+    """Returns a dataframe of the HSPs in the passed BLASTP tabular text
+    output, with columns named as in blast.BLASTP_COLUMNS.
+
+    - source - path to BLASTP tabular output (may be compressed), or a
+      file-like object yielding it
+
+    Empty output produces an empty dataframe with the expected columns.
+    """
+    try:
+        return pd.read_csv(source, sep='\t', header=None,
+                           names=BLASTP_COLUMNS, dtype=HIT_DTYPES)
+    except pd.errors.EmptyDataError:
+        return empty_hits()
+
+
+# Load BLASTP tabular text output as a sequence of dataframes
+def read_text_chunks(source, chunksize=CHUNKSIZE):
+    """Yields dataframes of up to chunksize HSPs at a time from the passed
+    BLASTP tabular text output, with columns named as in
+    blast.BLASTP_COLUMNS.
+
+    - source - path to BLASTP tabular output (may be compressed), or a
+      file-like object yielding it
+    - chunksize - number of HSPs to read at a time
+
+    Empty output yields no dataframes.
+    """
+    try:
+        reader = pd.read_csv(source, sep='\t', header=None,
+                             names=BLASTP_COLUMNS, dtype=HIT_DTYPES,
+                             chunksize=chunksize)
+    except pd.errors.EmptyDataError:
+        return
+    with reader:
+        yield from reader
+
+
+# The HitWriter class writes a binary hit table a chunk of HSPs at a time
+class HitWriter:
+    """Objects in this class write a binary hit table from dataframes of
+    HSPs passed to them in turn, so that a table need not be held in memory
+    to be written. Each column is appended to its own anonymous temporary
+    file as HSPs are written, and the columns are copied into the hit table
+    when it is closed; only the distinct sequence IDs are held in memory.
+    """
+    def __init__(self, filename):
+        """Instantiates a HitWriter object.
+
+        - filename       Path to output file
+        """
+        self.filename = filename
+        self.rows = 0
+        self._codes = {col: {} for col in ID_COLUMNS}  # ID -> code
+        outdir = os.path.dirname(os.path.abspath(filename))
+        self._columns = {col: tempfile.TemporaryFile(dir=outdir) for col in
+                         BLASTP_COLUMNS}
+
+    def write(self, hits):
+        """Appends the passed HSPs to the table.
+
+        - hits           Dataframe of HSPs, with (at least) the columns in
+                         blast.BLASTP_COLUMNS
+
+        Sequence IDs are interned in order of first appearance, so that
+        rows keep their order, and missing IDs are stored as code -1.
+        """
+        for col in BLASTP_COLUMNS:
+            if col in ID_COLUMNS:
+                codes, names = pd.factorize(hits[col])
+                table = self._codes[col]
+                lookup = np.array([table.setdefault(name, len(table)) for
+                                   name in names] + [-1], dtype=CODE_DTYPE)
+                data = lookup[codes]     # code -1 (missing) takes the last
+            else:
+                data = np.ascontiguousarray(hits[col].to_numpy(
+                    dtype=column_dtype(col)))
+            self._columns[col].write(data.tobytes())
+        self.rows += len(hits)
+
+    def close(self):
+        """Writes the hit table, from the HSPs written so far. Output is
+        written to a temporary file and moved into place, so that a partial
+        table is never left behind.
+        """
+        header = {'version': VERSION, 'rows': self.rows, 'columns': {},
+                  'names': {}}
+        blocks = []                      # (header entry, file), in order
+        for col in BLASTP_COLUMNS:
+            if col in ID_COLUMNS:
+                names = list(self._codes[col])
+                header['names'][col] = {'count': len(names)}
+                blocks.append((header['names'][col],
+                               io.BytesIO('\n'.join(names).encode('utf-8'))))
+            header['columns'][col] = {'dtype': column_dtype(col).str}
+            blocks.append((header['columns'][col], self._columns[col]))
+        offset = 0
+        for entry, fh in blocks:
+            size = fh.seek(0, os.SEEK_END)
+            entry.update(offset=offset, size=size)
+            offset = align(offset + size)
+        headerbytes = json.dumps(header).encode('utf-8')
+        start = align(len(MAGIC) + struct.calcsize(LENGTH_FORMAT) +
+                      len(headerbytes))
+        tmpname = "%s.tmp" % self.filename
+        with open(tmpname, 'wb') as ofh:
+            ofh.write(MAGIC)
+            ofh.write(struct.pack(LENGTH_FORMAT, len(headerbytes)))
+            ofh.write(headerbytes)
+            for entry, fh in blocks:
+                ofh.seek(start + entry['offset'])
+                fh.seek(0)
+                shutil.copyfileobj(fh, ofh)
+        os.replace(tmpname, self.filename)
+        self.discard()
+
+    def discard(self):
+        """Removes the temporary column files, without writing the table."""
+        for fh in self._columns.values():
+            fh.close()
+
+
+# Write a dataframe of HSPs as a binary hit table
+def write_hits(hits, filename):
+    """Writes the passed dataframe of HSPs to filename as a binary hit
+    table (see HitWriter).
+
+    - hits - dataframe of HSPs, with (at least) the columns in
+      blast.BLASTP_COLUMNS
+    - filename - path to output file
+    """
+    writer = HitWriter(filename)
+    try:
+        writer.write(hits)
+        writer.close()
+    finally:
+        writer.discard()
+
+
+# The HitTable class gives memory-mapped access to a binary hit table
+class HitTable:
+    """Objects in this class read a binary hit table written by
+    write_hits(). The file is memory-mapped, so each numeric column and
+    each array of ID codes is a read-only view of the file, paged in only
+    as it is used, and shared between processes reading the same table.
+    """
+    def __init__(self, filename):
+        """Instantiates a HitTable object.
+
+        - filename       Path to binary hit table
+        """
+        self.filename = filename
+        lengthsize = struct.calcsize(LENGTH_FORMAT)
+        with open(filename, 'rb') as fh:
+            if fh.read(len(MAGIC)) != MAGIC:
+                raise ValueError("%s is not a binary hit table" % filename)
+            (length,) = struct.unpack(LENGTH_FORMAT, fh.read(lengthsize))
+            self.header = json.loads(fh.read(length).decode('utf-8'))
+        if self.header['version'] != VERSION:
+            raise ValueError("%s has unsupported hit table version %s" %
+                             (filename, self.header['version']))
+        self._start = align(len(MAGIC) + lengthsize + length)
+        self._buffer = np.memmap(filename, mode='r')
+        self._names = {}
+
+    def __len__(self):
+        """Returns the number of HSPs in the table."""
+        return self.header['rows']
+
+    def __block(self, entry, dtype):
+        """Returns a view of the block described by the passed header entry,
+        as an array of the passed dtype.
+        """
+        start = self._start + entry['offset']
+        return np.asarray(self._buffer[start:start +
+                                       entry['size']]).view(dtype)
+
+    def column(self, col):
+        """Returns the named column, as a read-only array mapped from the
+        file. Sequence ID columns are returned as their integer codes (see
+        names()).
+
+        - col            Name of a column in blast.BLASTP_COLUMNS
+        """
+        entry = self.header['columns'][col]
+        return self.__block(entry, entry['dtype'])
+
+    def names(self, col):
+        """Returns the table of distinct sequence IDs in the named ID
+        column, indexed by its codes, as a pandas array.
+
+        - col            Name of a column in ID_COLUMNS
+        """
+        if col not in self._names:
+            entry = self.header['names'][col]
+            blob = self.__block(entry, np.uint8).tobytes().decode('utf-8')
+            self._names[col] = pd.array(blob.split('\n') if entry['count']
+                                        else [], dtype=HIT_DTYPES[col])
+        return self._names[col]
+
+    def to_frame(self, columns=BLASTP_COLUMNS):
+        """Returns a dataframe of the named columns. Numeric columns of the
+        returned dataframe share memory with the file, as each is passed to
+        pandas as its own block, uncopied; pandas may copy them when the
+        dataframe is modified or consolidated. Sequence IDs are looked up
+        from their codes.
+
+        - columns        Sequence of column names
+        """
+        data = {}
+        for col in columns:
+            if col in ID_COLUMNS:
+                data[col] = self.names(col).take(self.column(col),
+                                                 allow_fill=True)
+            else:
+                data[col] = self.column(col)
+        return pd.DataFrame(data, columns=list(columns), copy=False)
+
+
+# Open a binary hit table
+def read_hits(filename):
+    """Returns a HitTable reading the passed binary hit table.
+
+    - filename - path to binary hit table
+    """
+    return HitTable(filename)
+
+
+# Read hit tables of either format, and write them as one binary table
+def convert_hits(infiles, outfile):
+    """Writes the HSPs in each of the passed hit tables, in order, to the
+    binary hit table outfile.
+
+    - infiles - list of paths to hit tables: binary, if ending in .hits, or
+      BLASTP tabular text output otherwise
+    - outfile - path to output file
+
+    Text input is read CHUNKSIZE HSPs at a time.
+    """
+    writer = HitWriter(outfile)
+    try:
+        for fname in infiles:
+            if fname.endswith(HITTABLE_EXT):
+                writer.write(read_hits(fname).to_frame())
+            else:
+                for hits in read_text_chunks(fname):
+                    writer.write(hits)
+        writer.close()
+    finally:
+        writer.discard()
+
+
+# Run a search command, writing its output as a binary hit table
+def run_converted(cmd, outfile):
+    """Runs the passed command, writing the BLASTP tabular output it writes
+    to stdout to outfile as a binary hit table. Returns the command's exit
+    code; output is only written if the command succeeds.
+
+    - cmd - the search command to run, as a list of arguments
+    - outfile - path to output file
+
+    Output is read and converted CHUNKSIZE HSPs at a time, so memory use
+    is bounded by the chunk size and the number of distinct sequence IDs,
+    not by the number of HSPs.
+    """
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    writer = HitWriter(outfile)
+    try:
+        for hits in read_text_chunks(proc.stdout):
+            writer.write(hits)
+        proc.stdout.close()
+        retval = proc.wait()
+        if retval == 0:
+            writer.close()
+    finally:
+        writer.discard()
+    return retval
+
+
+# Process command-line arguments
+def parse_cmdline(args):
+    """Parse command-line arguments for the converter.
+
+    - args - list of command-line arguments
+    """
+    parser = argparse.ArgumentParser(prog="python -m pyrbbh.hittable",
+                                     description="Write BLASTP output as "
+                                                 "a binary hit table")
+    parser.add_argument('-o', '--outfile', dest='outfile',
+                        action='store', required=True,
+                        help='Path to binary hit table')
+    parser.add_argument('-i', '--infiles', dest='infiles',
+                        action='store', nargs='+', default=None,
+                        help='Paths to hit tables to convert')
+    parser.add_argument('cmd', nargs=argparse.REMAINDER,
+                        help='Search command writing tabular output to stdout')
+    parsed = parser.parse_args(args)
+    if parsed.cmd and parsed.cmd[0] == '--':
+        parsed.cmd = parsed.cmd[1:]
+    if (parsed.infiles is None) == (not parsed.cmd):
+        parser.error("give either input files or a search command")
+    return parsed
+
+
+if __name__ == "__main__":
+    args = parse_cmdline(sys.argv[1:])
+    if args.infiles is not None:
+        convert_hits(args.infiles, args.outfile)
+        sys.exit(0)
+    sys.exit(run_converted(args.cmd, args.outfile))
@@ -14,7 +14,10 @@ import os
 from Bio import SeqIO
 
 
-FASTA_EXTS = ('.fasta', '.faa', '.fas', 'fa')
+FASTA_EXTS = ('.fasta', '.faa', '.fas', '.fa')
+
+# Separates genome filestem from sequence ID in a combined FASTA file
+GENOME_TAG_SEP = '::'
 
 # Returns a list of FASTA files in a directory
 def get_fasta_files(dirname):
@@ -27,10 +30,112 @@ def get_fasta_files(dirname):
 
 # Returns a list of files in a directory, filtered by extension
 def get_files_by_ext(dirname, *exts):
-    """Returns list of paths to files with extensions in *exts.
+    """Returns sorted list of paths to files with extensions in *exts.
 
     - dirname - path to directory
     - *exts - file extensions to filter on
     """
-    fnames = [f for f in os.listdir(dirname) if os.path.splitext(f)[-1] in exts]
+    fnames = sorted(f for f in os.listdir(dirname) if
+                    os.path.splitext(f)[-1] in exts)
     return [os.path.join(dirname, f) for f in fnames]
+
+
+# Split a FASTA file into shards of a maximum number of residues
+def split_fasta(infile, outdir, max_residues, index=None):
+    """Returns list of paths to FASTA files written to outdir, that together
+    hold the sequences in infile, split into shards of at most max_residues
+    residues each.
+
+    - infile - path to input FASTA file
+    - outdir - path to directory for shard files
+    - max_residues - maximum total sequence length of a shard
+    - index - seqindex.FastaIndex of infile, or None
+
+    Sequences are kept in input order. A single sequence longer than
+    max_residues is placed in a shard of its own. Shards are named
+    '<stem>_shard<NNNN>.fasta', after the input file. If an index is
+    passed, shard boundaries are found from its sequence lengths, and each
+    shard's records are copied unchanged from infile, without parsing.
+    """
+    stem = os.path.splitext(os.path.split(infile)[-1])[0]
+    if index is not None:
+        return __split_indexed(index, outdir, stem, max_residues)
+    shards, records, residues = [], [], 0
+    for record in SeqIO.parse(infile, 'fasta'):
+        if records and residues + len(record) > max_residues:
+            shards.append(__write_shard(records, outdir, stem, len(shards)))
+            records, residues = [], 0
+        records.append(record)
+        residues += len(record)
+    if records or not shards:
+        shards.append(__write_shard(records, outdir, stem, len(shards)))
+    return shards
+
+
+# Split an indexed FASTA file into shards by copying runs of records
+def __split_indexed(index, outdir, stem, max_residues):
+    """Returns list of paths to shard files written to outdir, each holding a
+    run of records from the passed index's FASTA file of at most
+    max_residues residues (or a single longer record); see split_fasta().
+
+    - index - seqindex.FastaIndex of the input file
+    - outdir - path to directory for shard files
+    - stem - filestem of the unsplit input file
+    - max_residues - maximum total sequence length of a shard
+    """
+    bounds, residues = [0], 0
+    for row, length in enumerate(index.lengths.tolist()):
+        if row > bounds[-1] and residues + length > max_residues:
+            bounds.append(row)
+            residues = 0
+        residues += length
+    bounds.append(len(index))
+    shards = []
+    for idx, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:])):
+        outfname = os.path.join(outdir, "%s_shard%04d.fasta" % (stem, idx))
+        with open(outfname, 'wb') as ofh:
+            ofh.write(index.read_records(start, stop))
+        shards.append(outfname)
+    return shards
+
+
+# Write a single FASTA shard
+def __write_shard(records, outdir, stem, idx):
+    """Writes the passed SeqRecords to a numbered shard file in outdir, and
+    returns its path.
+
+    - records - list of SeqRecords
+    - outdir - path to directory for shard files
+    - stem - filestem of the unsplit input file
+    - idx - index of this shard
+    """
+    outfname = os.path.join(outdir, "%s_shard%04d.fasta" % (stem, idx))
+    SeqIO.write(records, outfname, 'fasta')
+    return outfname
+
+
+# Write a single FASTA file of genome-tagged sequences from all inputs
+def write_combined_fasta(infiles, outfile, genomefile):
+    """Writes the sequences from all passed FASTA files to the single FASTA
+    file outfile, with each sequence ID prefixed by the filestem of its
+    input file and GENOME_TAG_SEP. The filestems are written, one per line,
+    to genomefile. Returns the list of filestems.
+
+    - infiles - list of paths to input FASTA files
+    - outfile - path to combined FASTA file
+    - genomefile - path to list of genome filestems
+
+    Sequence descriptions are dropped, so that the tagged ID is the only
+    identifier BLAST reports.
+    """
+    stems = [os.path.splitext(os.path.split(fname)[-1])[0] for fname in
+             infiles]
+    with open(outfile, 'w') as ofh:
+        for stem, fname in zip(stems, infiles):
+            for record in SeqIO.parse(fname, 'fasta'):
+                record.id = "%s%s%s" % (stem, GENOME_TAG_SEP, record.id)
+                record.description = ''
+                SeqIO.write(record, ofh, 'fasta')
+    with open(genomefile, 'w') as ofh:
+        ofh.write(''.join("%s\n" % stem for stem in stems))
+    return stems
@@ -7,7 +7,11 @@
 # Please see the LICENSE file that should have been included as part of
 # this package.
 
+import collections
+import heapq
+
 from .config import SGE_WAIT
+from .monitor import JobMonitor
 
 
 # The Job class describes a single command-line job, with dependencies (jobs
@@ -15,12 +19,21 @@ from .config import SGE_WAIT
 class Job:
     """Objects in this class represent individual jobs to be run, with a list
     of dependencies (jobs that must be run first).
+
+    Jobs do not hold references to the jobs that depend on them, so that a
+    Job can be discarded once it has run, when jobs are generated as they
+    are needed, rather than built as a complete graph.
     """
+    __slots__ = ('name', 'queue', '_command', 'scriptPath', 'dependencies',
+                 'submitted', 'executable', 'inputs', 'outputs',
+                 'thread_option', 'stats', '__weakref__')
+
     def __init__(self, name, command, queue=None):
         """Instantiates a Job object.
 
         - name           String describing the job (uniquely)
-        - command        String, the valid shell command to run the job
+        - command        String, the valid shell command to run the job, or
+                         a function with no arguments returning it
         - queue          String, the SGE queue under which the job shall run
 
         >>> job = Job('myjob', 'ls -l')
@@ -43,13 +56,41 @@ class Job:
         self.name = name                 # Unique name for the job
         self.queue = queue               # The SGE queue to run the job under
         self.command = command           # Command line to run for this job
-        self.script = command
         self.scriptPath = None           # Will hold path to the script file
         self.dependencies = []           # List of jobs that must be submitted
                                          # before this job may be submitted
-        self.children = []               # List of jobs that depend on this job
         self.submitted = False           # Flag indicating whether the job has
                                          # already been submitted
+        self.executable = None           # Executable whose version the
+                                         # job's output depends on
+        self.inputs = []                 # Input files the job reads
+        self.outputs = []                # Glob patterns for output files
+        self.thread_option = None        # Command-line option setting the
+                                         # number of threads, if supported
+        self.stats = {}                  # Resource use recorded when run
+
+    @property
+    def command(self):
+        """The command line to run the job. If the Job was given a function
+        in place of a command string, the command line is built by calling
+        it, each time it is needed, rather than being held in memory.
+
+        >>> job = Job('myjob', lambda: 'ls -l')
+        >>> job.command
+        'ls -l'
+        """
+        if callable(self._command):
+            return self._command()
+        return self._command
+
+    @command.setter
+    def command(self, command):
+        self._command = command
+
+    @property
+    def script(self):
+        """The command line to run the job (as Job.command)."""
+        return self.command
 
     def add_dependency(self, job):
         """Add the passed job to the dependency list for this Job.  This
@@ -58,20 +99,268 @@ class Job:
         - job     Job to be added to the Job's dependency list
         """
         self.dependencies.append(job)
-        job.children.append(self)
 
     def remove_dependency(self, job):
         """Remove the passed job from this Job's dependency list
 
         - job     Job to be removed from the Job's dependency list
         """
-        job.children.remove(self)
         self.dependencies.remove(job)
 
-    def wait(self, interval=SGE_WAIT):
-        """Wait until the job finishes."""
-        finished = False
-        while not finished:
-            time.sleep(interval)
-            interval = min(2 * interval, 60)
-            finished = os.system("qstat -j %s > /dev/null" % (self.name))
+    def get_command(self, threads=1):
+        """Returns the command line to run the job with the passed number of
+        threads. The thread count is only added if the job's command
+        supports it.
+
+        - threads        Number of threads (cores) allocated to the job
+
+        >>> job = Job('myjob', 'blastp -query q.fasta')
+        >>> job.get_command(4)
+        'blastp -query q.fasta'
+        >>> job.thread_option = '-num_threads'
+        >>> job.get_command(4)
+        'blastp -query q.fasta -num_threads 4'
+        """
+        if self.thread_option is None:
+            return self.command
+        return "%s %s %d" % (self.command, self.thread_option, threads)
+
+    def wait(self, interval=SGE_WAIT, statusdir=None):
+        """Wait until the job finishes, returning its exit code if a
+        sentinel file was written to statusdir, or None otherwise.
+
+        - interval       Initial polling interval in seconds (raised to
+                         config.SGE_POLL_MIN if shorter)
+        - statusdir      Path to directory of job sentinel files, or None
+
+        To wait on many jobs, use a single monitor.JobMonitor instead.
+        """
+        jobmonitor = JobMonitor(statusdir, interval=interval)
+        jobmonitor.watch(self.name)
+        return jobmonitor.wait()[self.name]
+
+
+# The JobTracker class follows progress through a Job dependency graph
+class JobTracker:
+    """Objects in this class track which Jobs in a dependency graph are ready
+    to run, as the Jobs they depend on complete.
+
+    Each Job is visited once when it is added to count its outstanding
+    dependencies, and is listed against each of them. Completing a Job
+    decrements that count for each Job listed against it, so tracking costs
+    time linear in the number of jobs and dependency edges, however many
+    paths lead to a job. Only Jobs that have not yet completed are held, so
+    Jobs may be added as they are generated, and memory grows with the
+    number of Jobs in flight rather than the size of the whole graph.
+    """
+    def __init__(self, jobgraph=(), priority=None):
+        """Instantiates a JobTracker object.
+
+        - jobgraph       List of Job objects making up the dependency graph
+        - priority       Function returning a number for each Job; if given,
+                         ready Jobs are returned highest first, rather than
+                         in the order they became ready
+
+        Dependencies on Jobs that are not in jobgraph are taken to be
+        satisfied.
+
+        >>> job = Job('myjob', 'ls -l')
+        >>> djob = Job('required', 'cd .')
+        >>> job.add_dependency(djob)
+        >>> tracker = JobTracker([job, djob])
+        >>> [j.name for j in tracker.pop_ready()]
+        ['required']
+        >>> [j.name for j in tracker.complete(djob)]
+        ['myjob']
+        >>> tracker.finished
+        False
+        """
+        self._outstanding = {}           # Job -> count of unfinished deps
+        self._waiting = {}               # Job -> Jobs waiting on it
+        self._priority = priority
+        if priority is None:
+            self._ready = collections.deque()  # Jobs with no unfinished deps
+        else:
+            self._ready = []             # heap of (-priority, count, Job)
+        self._queued = 0                 # count of Jobs ever made ready
+        self._failed = set()             # Jobs failed, or blocked by failure
+        for job in jobgraph:
+            self._outstanding[job] = 0
+        for job in jobgraph:
+            self.__count_dependencies(job)
+
+    def __count_dependencies(self, job):
+        """Count the passed Job's outstanding dependencies, list it against
+        each of them, and queue it if it is ready to run.
+
+        - job            Job to be counted
+        """
+        for dep in job.dependencies:
+            if dep in self._outstanding:
+                self._outstanding[job] += 1
+                self._waiting.setdefault(dep, []).append(job)
+        if self._outstanding[job] == 0:
+            self.__queue(job)
+
+    def __queue(self, job):
+        """Add the passed Job to the ready queue.
+
+        - job            Job that is ready to run
+        """
+        if self._priority is None:
+            self._ready.append(job)
+        else:
+            heapq.heappush(self._ready, (-self._priority(job), self._queued,
+                                         job))
+        self._queued += 1
+
+    def add(self, job):
+        """Add the passed Job to the tracked graph, returning True if it is
+        ready to run, and False otherwise. Returns None, and does not track
+        the Job, if a Job it depends on has failed.
+
+        - job            Job to be added
+
+        Jobs must be added after the Jobs they depend on, so that any
+        dependency not being tracked can be taken to have completed.
+
+        >>> djob = Job('required', 'cd .')
+        >>> job = Job('myjob', 'ls -l')
+        >>> job.add_dependency(djob)
+        >>> tracker = JobTracker()
+        >>> tracker.add(djob), tracker.add(job)
+        (True, False)
+        """
+        if any(dep in self._failed for dep in job.dependencies):
+            self._failed.add(job)
+            return None
+        self._outstanding[job] = 0
+        self.__count_dependencies(job)
+        return self._outstanding[job] == 0
+
+    def pop_ready(self, count=None):
+        """Returns a list of up to count Jobs that are ready to run, removing
+        them from the ready queue. All ready Jobs are returned if count is
+        None.
+
+        - count          Maximum number of Jobs to return
+
+        >>> jobgraph = [Job('j%d' % idx, 'true') for idx in range(3)]
+        >>> tracker = JobTracker(jobgraph,
+        ...                      priority=lambda job: int(job.name[1]))
+        >>> [j.name for j in tracker.pop_ready()]
+        ['j2', 'j1', 'j0']
+        """
+        if count is None:
+            count = len(self._ready)
+        count = min(count, len(self._ready))
+        if self._priority is None:
+            return [self._ready.popleft() for idx in range(count)]
+        return [heapq.heappop(self._ready)[-1] for idx in range(count)]
+
+    def requeue(self, job):
+        """Return the passed Job, taken with pop_ready() but never finished
+        (e.g. lost with the host running it), to the ready queue.
+
+        - job            Job to be run again
+
+        >>> tracker = JobTracker([Job('myjob', 'ls -l')])
+        >>> job = tracker.pop_ready()[0]
+        >>> tracker.requeue(job)
+        >>> [j.name for j in tracker.pop_ready()]
+        ['myjob']
+        """
+        self.__queue(job)
+
+    def complete(self, job):
+        """Mark the passed Job as complete, and return a list of the Jobs
+        depending on it that have become ready to run as a result.
+
+        - job            Job that has completed
+        """
+        del self._outstanding[job]
+        newly_ready = []
+        for child in self._waiting.pop(job, []):
+            if child not in self._outstanding:
+                continue  # child was blocked by another failure
+            self._outstanding[child] -= 1
+            if self._outstanding[child] == 0:
+                newly_ready.append(child)
+                self.__queue(child)
+        return newly_ready
+
+    def fail(self, job):
+        """Mark the passed Job as failed, and return a list of the Jobs that
+        depend on it, directly or indirectly, and so cannot be run. These
+        Jobs are no longer tracked, and nor are any added later that depend
+        on them.
+
+        - job            Job that has failed
+
+        >>> djob = Job('required', 'cd .')
+        >>> job = Job('myjob', 'ls -l')
+        >>> job.add_dependency(djob)
+        >>> tracker = JobTracker([djob, job])
+        >>> [j.name for j in tracker.fail(djob)]
+        ['myjob']
+        >>> tracker.finished
+        True
+        """
+        blocked = []
+        failing = [job]
+        while failing:
+            failed = failing.pop()
+            self._failed.add(failed)
+            self._outstanding.pop(failed, None)
+            for child in self._waiting.pop(failed, []):
+                if child not in self._failed:
+                    self._failed.add(child)
+                    blocked.append(child)
+                    failing.append(child)
+        return blocked
+
+    @property
+    def ready_count(self):
+        """Number of Jobs ready to run."""
+        return len(self._ready)
+
+    @property
+    def has_ready(self):
+        """True if any Jobs are ready to run."""
+        return len(self._ready) > 0
+
+    @property
+    def pending_count(self):
+        """Number of tracked Jobs that have not completed."""
+        return len(self._outstanding)
+
+    @property
+    def finished(self):
+        """True if every tracked Job has completed or failed."""
+        return len(self._outstanding) == 0
+
+
+# Decide how many cores to give a job, from those available
+def allocate_threads(job, free, waiting):
+    """Returns the number of cores to allocate to the passed Job, given the
+    number of free cores and the number of Jobs (including this one) that
+    are waiting to run.
+
+    - job - Job object about to be started
+    - free - number of cores not in use by running Jobs
+    - waiting - number of Jobs ready to run, including this one
+
+    Jobs that cannot use more than one thread get a single core. While there
+    are at least as many waiting Jobs as free cores, each Job gets one core;
+    as the queue runs low, the free cores are shared between the remaining
+    Jobs, so that long-running tail Jobs are given more threads. The
+    allocation never exceeds the free cores.
+
+    >>> job = Job('myjob', 'blastp -query q.fasta')
+    >>> job.thread_option = '-num_threads'
+    >>> allocate_threads(job, 8, 20), allocate_threads(job, 8, 3)
+    (1, 2)
+    """
+    if job.thread_option is None or free < 1:
+        return 1
+    return max(1, free // max(1, waiting))
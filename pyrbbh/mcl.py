@@ -0,0 +1,258 @@
+# Copyright 2015-2016 The James Hutton Institute
+# Author: Leighton Pritchard
+#
+# mcl.py
+#
+# This code is part of the pyrbbh package, and is governed by its licence.
+# Please see the LICENSE file that should have been included as part of this
+# package.
+
+"""Module to cluster sequences by Markov clustering (MCL) of best hits.
+
+Best hits in every direction between every pair of genomes (see
+store.ResultStore.hit_graph()) are taken as a weighted, undirected graph,
+held as a SciPy CSR sparse matrix, with one row per sequence. The matrix
+is made stochastic, and expansion (matrix squaring), inflation (raising
+entries to a power and renormalising) and pruning (discarding small
+entries, and all but the largest in each row) are repeated until it no
+longer changes. Sequences are then clustered by the connected components
+of what remains.
+
+The matrix is kept row-stochastic, rather than column-stochastic as in
+van Dongen's description, which is the same process on the transpose, so
+that inflation and pruning work along CSR rows. Expansion multiplies
+blocks of rows in separate threads; SciPy releases the GIL for sparse
+matrix products, so these run in parallel. Pruning bounds the entries in
+each row, so the matrix stays as sparse as the graph.
+"""
+
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.sparse as sp
+
+from scipy.sparse.csgraph import connected_components
+
+# Default MCL parameters: inflation, smallest entry kept on pruning, most
+# entries kept per row on pruning, and iteration limit
+INFLATION = 2.0
+PRUNE_THRESHOLD = 1e-4
+MAX_ENTRIES = 500
+MAX_ITERATIONS = 100
+
+# Largest change in any entry between iterations, at convergence
+TOLERANCE = 1e-6
+
+# Rows multiplied by each thread in expansion
+BLOCK_ROWS = 10000
+
+
+# Build a symmetric sparse graph from edge arrays
+def build_graph(rows, cols, weights, nnodes):
+    """Returns a symmetric CSR matrix of nnodes x nnodes, weighting each edge
+    between two nodes by the larger of the weights in either direction,
+    with a self-loop on every node weighted as its heaviest edge.
+
+    - rows - array of edge source node indices
+    - cols - array of edge target node indices
+    - weights - array of edge weights (e.g. bitscores)
+    - nnodes - number of nodes
+
+    Nodes without edges have a self-loop of weight 1, so that every row of
+    the matrix can be normalised.
+
+    >>> graph = build_graph([0, 1], [1, 0], [10.0, 20.0], 3)
+    >>> graph.toarray().tolist()
+    [[20.0, 20.0, 0.0], [20.0, 20.0, 0.0], [0.0, 0.0, 1.0]]
+    """
+    graph = sp.csr_matrix((np.asarray(weights, dtype=np.float64),
+                           (np.asarray(rows), np.asarray(cols))),
+                          shape=(nnodes, nnodes))
+    graph.sum_duplicates()
+    graph = graph.maximum(graph.T).tocsr()
+    graph.setdiag(0)
+    graph.eliminate_zeros()
+    loops = graph.max(axis=1).toarray().ravel()
+    loops[loops == 0] = 1.0
+    return (graph + sp.diags(loops, format='csr')).tocsr()
+
+
+# Normalise the rows of a sparse matrix to sum to one
+def normalise(matrix):
+    """Returns the passed CSR matrix with each row scaled to sum to one.
+
+    - matrix - CSR matrix with no empty rows
+    """
+    sums = np.asarray(matrix.sum(axis=1)).ravel()
+    sums[sums == 0] = 1.0
+    return sp.diags(1.0 / sums, format='csr') @ matrix
+
+
+# Square a sparse matrix, multiplying blocks of rows in parallel
+def expand(matrix, threads=None, block_rows=BLOCK_ROWS):
+    """Returns the square of the passed CSR matrix, multiplying blocks of
+    block_rows rows by the whole matrix, in up to threads threads.
+
+    - matrix - CSR matrix
+    - threads - number of threads (default: number of CPUs)
+    - block_rows - number of rows in each block
+
+    >>> matrix = sp.csr_matrix(np.array([[0.5, 0.5], [0.0, 1.0]]))
+    >>> expand(matrix, 2, 1).toarray().tolist()
+    [[0.25, 0.75], [0.0, 1.0]]
+    """
+    threads = threads or os.cpu_count() or 1
+    nrows = matrix.shape[0]
+    if threads == 1 or nrows <= block_rows:
+        return (matrix @ matrix).tocsr()
+    starts = range(0, nrows, block_rows)
+    with ThreadPoolExecutor(threads) as executor:
+        blocks = list(executor.map(lambda start: matrix[start:start +
+                                                        block_rows] @ matrix,
+                                   starts))
+    return sp.vstack(blocks, format='csr')
+
+
+# Raise entries to a power and renormalise rows
+def inflate(matrix, inflation=INFLATION):
+    """Returns the passed CSR matrix with each entry raised to the power
+    inflation, and each row renormalised.
+
+    - matrix - CSR matrix
+    - inflation - inflation exponent
+    """
+    matrix = matrix.copy()
+    matrix.data **= inflation
+    return normalise(matrix)
+
+
+# Drop small entries, keeping at most max_entries in each row
+def prune(matrix, threshold=PRUNE_THRESHOLD, max_entries=MAX_ENTRIES):
+    """Returns the passed CSR matrix with entries below threshold, and all
+    but the max_entries largest entries in each row, removed, and each row
+    renormalised. The largest entry in each row is always kept.
+
+    - matrix - row-stochastic CSR matrix
+    - threshold - smallest entry kept
+    - max_entries - most entries kept in each row
+
+    >>> matrix = sp.csr_matrix(np.array([[0.6, 0.3, 0.1], [0.2, 0.3, 0.5]]))
+    >>> prune(matrix, 0.15, 2).toarray().round(3).tolist()
+    [[0.667, 0.333, 0.0], [0.0, 0.375, 0.625]]
+    """
+    matrix = matrix.tocoo()
+    # Rank entries within each row, largest first
+    order = np.lexsort((-matrix.data, matrix.row))
+    row, col, data = matrix.row[order], matrix.col[order], matrix.data[order]
+    starts = np.flatnonzero(np.r_[True, row[1:] != row[:-1]])
+    counts = np.diff(np.r_[starts, len(row)])
+    rank = np.arange(len(row)) - np.repeat(starts, counts)
+    keep = (rank == 0) | ((rank < max_entries) & (data >= threshold))
+    pruned = sp.csr_matrix((data[keep], (row[keep], col[keep])),
+                           shape=matrix.shape)
+    return normalise(pruned)
+
+
+# Run MCL to convergence on a graph
+def mcl(graph, inflation=INFLATION, threshold=PRUNE_THRESHOLD,
+        max_entries=MAX_ENTRIES, max_iterations=MAX_ITERATIONS,
+        threads=None, logger=None):
+    """Returns the limit of the MCL process on the passed graph, as a CSR
+    matrix.
+
+    - graph - symmetric CSR matrix, as returned by build_graph()
+    - inflation - inflation exponent; higher values give smaller clusters
+    - threshold - smallest entry kept on pruning
+    - max_entries - most entries kept in each row on pruning
+    - max_iterations - most rounds of expansion and inflation
+    - threads - number of threads for expansion (default: number of CPUs)
+    - logger - logger object
+    """
+    matrix = prune(normalise(graph), threshold, max_entries)
+    for iteration in range(1, max_iterations + 1):
+        expanded = prune(inflate(expand(matrix, threads), inflation),
+                         threshold, max_entries)
+        change = abs(expanded - matrix).max() if expanded.nnz else 0
+        matrix = expanded
+        if logger:
+            logger.info("MCL iteration %d: %d entries, change %.3g" %
+                        (iteration, matrix.nnz, change))
+        if change < TOLERANCE:
+            break
+    else:
+        if logger:
+            logger.warning("MCL did not converge in %d iterations" %
+                           max_iterations)
+    return matrix
+
+
+# Assign nodes to clusters from the limit of the MCL process
+def get_clusters(matrix):
+    """Returns an array giving the cluster number of each node, from the
+    connected components of the passed MCL limit matrix. Clusters are
+    numbered from zero, largest first.
+
+    - matrix - CSR matrix, as returned by mcl()
+
+    >>> matrix = sp.csr_matrix(np.array([[0.0, 1.0, 0.0], [0.0, 1.0, 0.0], \
+[0.0, 0.0, 1.0]]))
+    >>> get_clusters(matrix).tolist()
+    [0, 0, 1]
+    """
+    ncomponents, labels = connected_components(matrix, directed=True,
+                                               connection='weak')
+    sizes = np.bincount(labels, minlength=ncomponents)
+    order = np.argsort(-sizes, kind='stable')
+    ranks = np.empty(ncomponents, dtype=np.int64)
+    ranks[order] = np.arange(ncomponents)
+    return ranks[labels]
+
+
+# Write cluster membership to file
+def write_clusters(nodes, labels, filename):
+    """Writes a tab-separated table with columns 'cluster', 'genome' and
+    'seqid', one row per sequence, sorted by cluster, to filename. Returns
+    the number of clusters.
+
+    - nodes - dataframe with columns 'genome' and 'seqid', one row per node
+    - labels - array of cluster numbers, as returned by get_clusters()
+    - filename - path to output file
+    """
+    clusters = nodes[['genome', 'seqid']].assign(cluster=labels)
+    clusters = clusters.sort_values('cluster', kind='mergesort')
+    tmpname = "%s.tmp" % filename
+    clusters[['cluster', 'genome', 'seqid']].to_csv(tmpname, sep='\t',
+                                                    index=False)
+    os.replace(tmpname, filename)
+    return int(labels.max()) + 1 if len(labels) else 0
+
+
+# Cluster the sequences of the input files from their best hits
+def cluster_best_hits(store, nodes, filename, inflation=INFLATION,
+                      threshold=PRUNE_THRESHOLD, max_entries=MAX_ENTRIES,
+                      max_iterations=MAX_ITERATIONS, threads=None,
+                      logger=None):
+    """Clusters every sequence in nodes by MCL of the best hits in the
+    results store, writing cluster membership to filename (see
+    write_clusters()). Returns the number of clusters.
+
+    - store - store.ResultStore holding best hits
+    - nodes - dataframe with columns 'genome' and 'seqid', one row per
+      sequence to be clustered
+    - filename - path to output file
+    - inflation, threshold, max_entries, max_iterations, threads - as for
+      mcl()
+    - logger - logger object
+
+    Sequences without best hits are clustered alone.
+    """
+    rows, cols, weights = store.hit_graph(nodes)
+    if logger:
+        logger.info("Built graph of %d sequences and %d best hits" %
+                    (len(nodes), len(weights)))
+    graph = build_graph(rows, cols, weights, len(nodes))
+    limit = mcl(graph, inflation, threshold, max_entries, max_iterations,
+                threads, logger)
+    return write_clusters(nodes, get_clusters(limit), filename)
@@ -0,0 +1,159 @@
+# Copyright 2015-2016 The James Hutton Institute
+# Author: Leighton Pritchard
+#
+# monitor.py
+#
+# This code is part of the pyrbbh package, and is governed by its licence.
+# Please see the LICENSE file that should have been included as part of this
+# package.
+
+"""Code to monitor the state of many scheduler jobs at once.
+
+Rather than polling the scheduler separately for each job, a JobMonitor
+makes a single scan of a directory of sentinel files per polling interval,
+and, every few intervals, a single qstat call listing every queued job. Job
+wrappers write a sentinel file, named for the job and holding its exit
+code, as their last action. A job is complete when its sentinel appears;
+if its scheduler job is missing from consecutive queue listings without
+writing a sentinel, it is reported as lost.
+
+Polls are never less than SGE_POLL_MIN seconds apart, so that following
+many jobs does not load the scheduler or the filesystem.
+"""
+
+import os
+import subprocess
+import time
+import xml.etree.ElementTree as ET
+
+from .config import (QSTAT_DEFAULT, SGE_LOST_LISTINGS, SGE_POLL_MAX,
+                     SGE_POLL_MIN, SGE_QSTAT_EVERY)
+
+
+# The JobMonitor class tracks completion of many scheduler jobs
+class JobMonitor:
+    """Objects in this class watch for the completion of scheduler jobs,
+    checking the state of all outstanding jobs in one pass per interval.
+    """
+    def __init__(self, statusdir=None, qstat_exe=QSTAT_DEFAULT,
+                 interval=None, maxinterval=SGE_POLL_MAX,
+                 qstat_every=SGE_QSTAT_EVERY, lost_listings=SGE_LOST_LISTINGS):
+        """Instantiates a JobMonitor object.
+
+        - statusdir      Path to directory of sentinel files, or None
+        - qstat_exe      Path to qstat executable
+        - interval       Initial polling interval in seconds, raised to
+                         SGE_POLL_MIN if shorter, or None for SGE_POLL_MIN
+        - maxinterval    Longest polling interval in seconds
+        - qstat_every    Number of polls per qstat call
+        - lost_listings  Number of consecutive qstat listings from which a
+                         job must be missing, with no sentinel, to be lost
+
+        The polling interval doubles while no job completes, up to
+        maxinterval, and drops back to interval when one does.
+        """
+        self.statusdir = statusdir
+        self.qstat_exe = qstat_exe
+        self.interval = max(SGE_POLL_MIN if interval is None else interval,
+                            SGE_POLL_MIN)
+        self.maxinterval = max(maxinterval, self.interval)
+        self.qstat_every = qstat_every
+        self.lost_listings = lost_listings
+        self._watched = {}               # sentinel name -> scheduler job name
+        self._missing = {}               # sentinel name -> listings missed
+        self._polls = 0                  # count of polls made
+
+    def watch(self, name, schedname=None):
+        """Start watching for completion of the named job.
+
+        - name           Name of the job's sentinel file
+        - schedname      Name of the scheduler job that runs the job (e.g.
+                         the array job holding a task), if not name
+        """
+        self._watched[name] = name if schedname is None else schedname
+
+    @property
+    def outstanding(self):
+        """Number of watched jobs that have not completed."""
+        return len(self._watched)
+
+    def get_queued(self):
+        """Returns the set of job names known to the scheduler, from a single
+        qstat call, or None if the scheduler could not be queried. An
+        OSError is raised if qstat cannot be run at all.
+        """
+        try:
+            output = subprocess.check_output([self.qstat_exe, '-xml'],
+                                             stderr=subprocess.DEVNULL)
+            return set(elem.text for elem in
+                       ET.fromstring(output).iter('JB_name'))
+        except (subprocess.CalledProcessError, ET.ParseError):
+            return None  # treat as transient; try again next interval
+
+    def get_sentinels(self):
+        """Returns a dictionary of exit codes, keyed by sentinel name, for all
+        sentinel files in the status directory.
+        """
+        if self.statusdir is None or not os.path.isdir(self.statusdir):
+            return {}
+        sentinels = {}
+        for fname in os.listdir(self.statusdir):
+            if fname in self._watched:
+                with open(os.path.join(self.statusdir, fname)) as fh:
+                    sentinels[fname] = int(fh.read().strip() or 1)
+        return sentinels
+
+    def poll(self):
+        """Returns a list of (name, exit code) tuples for watched jobs that
+        have completed since the last poll, and stops watching them. Jobs
+        that have been missing from lost_listings consecutive listings of
+        the scheduler queue without writing a sentinel are reported with an
+        exit code of None.
+
+        The queue is listed on the first poll and every qstat_every polls
+        after; other polls only read the sentinels.
+        """
+        # The queue is read before the sentinels: a job that has left the
+        # queue has already written its sentinel, if it is going to.
+        queued = None
+        if self._polls % self.qstat_every == 0:
+            queued = self.get_queued()
+        self._polls += 1
+        sentinels = self.get_sentinels()
+        events = []
+        for name, schedname in list(self._watched.items()):
+            if name in sentinels:
+                events.append((name, sentinels[name]))
+            elif queued is None:
+                continue
+            elif schedname in queued:
+                self._missing.pop(name, None)
+                continue
+            else:
+                self._missing[name] = self._missing.get(name, 0) + 1
+                if self._missing[name] < self.lost_listings:
+                    continue
+                events.append((name, None))
+            del self._watched[name]
+            self._missing.pop(name, None)
+        return events
+
+    def wait(self, callback=None):
+        """Waits until all watched jobs have completed, returning a dictionary
+        of their exit codes keyed by name.
+
+        - callback       Function called with (name, exit code) as each job
+                         completes
+        """
+        retvals = {}
+        interval = self.interval
+        while self._watched:
+            time.sleep(interval)
+            events = self.poll()
+            interval = self.interval if events else \
+                       min(2 * interval, self.maxinterval)
+            for name, retval in events:
+                retvals[name] = retval
+                if callback is not None:
+                    callback(name, retval)
+        return retvals
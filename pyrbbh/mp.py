@@ -7,15 +7,41 @@
 # Please see the LICENSE file that should have been included as part of
 # this package.
 
-"""Code to aid the parallelisation of tasks with multiprocessing."""
+"""Code to aid the parallelisation of tasks on the local machine."""
 
-import multiprocessing
-import subprocess
-import sys
-
-CUMRETVAL = 0
+from . import aio, jobs
 
 # Create sets of jobs at distinct levels of a dependency tree
+def create_jobsets(jobgraph, logger=None):
+    """Returns lists of Job objects at distinct levels of a job dependency
+    tree.
+
+    - jobgraph - dependency graph of Job objects as list of Jobs
+    - logger - logger object
+
+    Each Job is placed at the level of the longest path to it from a job with
+    no dependencies, so that every Job's dependencies are found at earlier
+    levels. Levels are assigned in a single topological pass over the graph,
+    visiting each Job and dependency edge once.
+    """
+    if logger:
+        logger.info("Subdividing job dependency tree by depth")
+    tracker = jobs.JobTracker(jobgraph)
+    depths = {}
+    jobsets = []
+    while tracker.has_ready:
+        for job in tracker.pop_ready():
+            depth = max([depths[dep] + 1 for dep in job.dependencies
+                         if dep in depths] or [0])
+            depths[job] = depth
+            if len(jobsets) < depth + 1:
+                jobsets.append([])
+            jobsets[depth].append(job)
+            tracker.complete(job)
+    return jobsets
+
+
+# Create sets of commands at distinct levels of a dependency tree
 def create_cmdsets(jobgraph, logger=None):
     """Returns sets of commands at distinct levels of a job dependency tree.
 
@@ -30,73 +56,30 @@ def create_cmdsets(jobgraph, logger=None):
     j0 <- j2 <- j5
     j3 <- j4
 
-    should return two sets of jobs: (j0, j3), (j1, j2, j4), (j5), such that
+    should return three sets of jobs: (j0, j3), (j1, j2, j4), (j5), such that
     the first set returned can be executed, and the dependencies of the
     second set will be satisfied and, when the second set is executed, the 
     dependencies of the third set will be satisfied, and so on.
     """
-    if logger:
-        logger.info("Subdividing job dependency tree by depth")
-    jobsets = []
-    for job in [j for j in jobgraph if len(j.dependencies) == 0]:
-        jobsets = __populate_jobsets(job, jobsets, depth=0)
-    return jobsets
-
-
-# Recursive function to split dependency tree into levels
-def __populate_jobsets(job, jobsets, depth):
-    """Populates jobsets in create_jobsets().
-
-    - job - a Job object
-    - jobsets - the current set of Job objects
-    - depth - current depth in dependency graph
-
-    A recursive function creating lists of sets containing items at distinct
-    depths of a dependency tree.
-    """
-    if len(jobsets) < depth+1:
-        jobsets.append(set())
-    jobsets[depth].add(job.command)
-    if len(job.children) == 0:
-        return jobsets
-    for j in job.children:
-        jobsets = __populate_jobsets(j, jobsets, depth+1)
-    return jobsets
+    return [set(job.command for job in jobset) for jobset in
+            create_jobsets(jobgraph, logger)]
 
 
-# Run a set of jobs with multiprocessing, returning sum of error values
-def mp_run_cmdset(cmdset, logger=None):
-    """Distribute the set of command-lines in cmdset with multiprocessing,
-    returning sum of error values.
+# Run a set of commands, returning the exit value of each
+def mp_run_cmdset(cmdset, cores=None, logger=None):
+    """Run the set of command-lines in cmdset as local subprocesses,
+    returning a dictionary of exit values keyed by command-line.
 
-    - jobset - set of command-lines to be run in an asynchronous pool
+    - cmdset - set of command-lines to be run
+    - cores - maximum number of commands to run at once (defaults to CPU
+      count)
     - logger - logger object
-    
-    Runs the passed set of commands in an asynchronous pool. Collects function 
-    exit values with a callback. Returns the sum of collected function
-    exit values.
-    """
-    global CUMRETVAL  # tracks return value sum
-
-    # Run jobs
-    pool = multiprocessing.Pool()
-    completed = []
-    pool_outputs = [pool.apply_async(subprocess.call,
-                                     (str(cline), ),
-                                     {'stderr': subprocess.PIPE,
-                                      'shell': sys.platform != "win32"},
-                                     callback = __status_callback)
-                    for cline in cmdset]
-    pool.close()
-    pool.join()
-    return CUMRETVAL
-
-
-# Callback function for multiprocessing runs
-def __status_callback(val):
-    """Basic callback to collect exit code
 
-    - val - exit code from command
+    The commands are run with aio.run_dependency_graph(), as Jobs with no
+    dependencies, so that each exit value is reported individually.
     """
-    global CUMRETVAL
-    CUMRETVAL += val
+    joblist = [jobs.Job("cmd_%06d" % idx, cline) for idx, cline in
+               enumerate(sorted(cmdset))]
+    retvals = aio.run_dependency_graph(joblist, cores, logger=logger,
+                                       keep_going=True)
+    return {job.command: retvals[job.name] for job in joblist}
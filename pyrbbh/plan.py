@@ -0,0 +1,295 @@
+# Copyright 2015-2016 The James Hutton Institute
+# Author: Leighton Pritchard
+#
+# plan.py
+#
+# This code is part of the pyrbbh package, and is governed by its licence.
+# Please see the LICENSE file that should have been included as part of this
+# package.
+
+"""Module to export a job dependency graph for external workflow executors.
+
+Rather than running the graph, each Job is written out with its command
+line, the Jobs it depends on, and its input and output files, in one of
+three formats:
+
+- json - a JSON document listing every Job, for any executor or script
+- make - a Makefile, so that make -j runs independent Jobs in parallel
+- snakemake - a Snakemake workflow (Snakefile)
+
+Some Jobs' outputs are glob patterns (e.g. the files of a BLAST database),
+which neither make nor Snakemake can take as targets. In the Makefile and
+Snakefile, each Job instead touches a stamp file, named for the Job, when
+it succeeds, and depends on the stamp files of the Jobs it depends on.
+Each Job's stdout and stderr are written to '<job name>.out' and
+'<job name>.err' in a log directory, as when pyrbbh runs the graph.
+
+Jobs that can use more than one thread are given THREADS threads, a make
+variable or Snakemake config value that defaults to one. Jobs running
+pyrbbh's own helper modules (see blast.construct_helper_cmd()) do so with
+the Python interpreter PYRBBH_PYTHON, and the pyrbbh package found in
+PYRBBH_PATH, rather than the interpreter and package that wrote the plan,
+so that the plan can be run on other hosts; these are make variables, or
+the Snakemake config values 'python' and 'pyrbbh_path'.
+
+Jobs are written as they are drawn from the graph, so a graph generated
+as it is needed (see blast.iter_blast_jobs()) is never held in memory;
+only the paths of stamp files are kept, for the default target.
+Paths are written as they appear in the Jobs' command lines, so the
+exported workflow must be run from the directory the plan was made in.
+"""
+
+import json
+import os
+import re
+
+from .blast import HELPER_PREFIX
+from .config import PYRBBH_PATH
+
+# Subdirectory of the output directory for Job stamp files
+STAMP_DIRNAME = '.pyrbbh_plan'
+
+# Default filenames of the exported workflow, in the output directory, by
+# format
+PLAN_FILENAMES = {'json': 'pyrbbh_plan.json', 'make': 'Makefile',
+                  'snakemake': 'Snakefile'}
+
+# Characters not allowed in a Snakemake rule name
+RULE_NAME_INVALID = re.compile(r'\W')
+
+# Default Python interpreter running pyrbbh's helper modules in a plan
+HELPER_PYTHON = 'python3'
+
+# Helper module invocations in a Makefile and a Snakefile, taking the
+# interpreter and the package path from variables (see HELPER_PREFIX)
+MAKE_HELPER = ("PYTHONPATH='$(PYRBBH_PATH)'$${PYTHONPATH:+:$$PYTHONPATH} "
+               "$(PYRBBH_PYTHON) -m pyrbbh.")
+SNAKEMAKE_HELPER = ("PYTHONPATH={PYRBBH_PATH:q}"
+                    "${{PYTHONPATH:+:$PYTHONPATH}} {PYRBBH_PYTHON} -m pyrbbh.")
+
+
+# Return the path to the stamp file a Job touches when it succeeds
+def get_stamp_path(job, outdir):
+    """Returns the path to the stamp file written when the passed Job
+    succeeds, in the exported Makefile or Snakefile.
+
+    - job - Job object
+    - outdir - path to the output directory
+
+    >>> from .jobs import Job
+    >>> get_stamp_path(Job('myjob', 'ls -l'), 'out')
+    'out/.pyrbbh_plan/myjob.done'
+    """
+    return os.path.join(outdir, STAMP_DIRNAME, "%s.done" % job.name)
+
+
+# Build the record of a Job written to a JSON plan
+def get_job_record(job, costs=None):
+    """Returns a dictionary describing the passed Job, for a JSON plan.
+
+    - job - Job object
+    - costs - function returning the estimated CPU time of a Job, or None
+
+    The command line is given without a thread count; if the Job can use
+    more than one thread, 'thread_option' names the option to append, with
+    the number of threads, as jobs.Job.get_command() does.
+
+    >>> from .jobs import Job
+    >>> job = Job('myjob', 'blastp -query q.fasta')
+    >>> job.thread_option = '-num_threads'
+    >>> job.add_dependency(Job('dbjob', 'makeblastdb'))
+    >>> record = get_job_record(job)
+    >>> record['command'], record['thread_option'], record['dependencies']
+    ('blastp -query q.fasta', '-num_threads', ['dbjob'])
+    """
+    record = {'name': job.name, 'command': job.command,
+              'thread_option': job.thread_option,
+              'dependencies': [dep.name for dep in job.dependencies],
+              'inputs': job.inputs, 'outputs': job.outputs,
+              'executable': job.executable}
+    if costs is not None:
+        record['estimate'] = costs(job)
+    return record
+
+
+# Write a job dependency graph as a JSON document
+def write_json(jobgraph, fh, outdir, costs=None):
+    """Writes the passed job dependency graph to the open file fh as a JSON
+    document, with the working directory, the log directory, and a list of
+    Job records (see get_job_record()), each after the Jobs it depends on.
+    Returns the number of Jobs written.
+
+    - jobgraph - iterable of Job objects, each after the Jobs it depends on
+    - fh - open file to write to
+    - outdir - path to the output directory
+    - costs - function returning the estimated CPU time of a Job, or None
+    """
+    fh.write('{"workdir": %s, "logdir": %s, "jobs": [' %
+             (json.dumps(os.getcwd()),
+              json.dumps(os.path.join(outdir, 'logs'))))
+    count = 0
+    for job in jobgraph:
+        fh.write('%s\n%s' % (',' if count else '',
+                             json.dumps(get_job_record(job, costs))))
+        count += 1
+    fh.write('\n]}\n')
+    return count
+
+
+# Build the shell command run for a Job by make or Snakemake
+def get_shell_command(job, outdir, threads, escape=None, helper=None):
+    """Returns the shell command that runs the passed Job with the passed
+    thread count, logging its stdout and stderr.
+
+    - job - Job object
+    - outdir - path to the output directory
+    - threads - string giving the number of threads, in the executor's
+      syntax
+    - escape - function escaping characters special to the executor in
+      the command line and log paths, or None
+    - helper - string replacing blast.HELPER_PREFIX, in the executor's
+      syntax, or None
+
+    >>> from .jobs import Job
+    >>> job = Job('myjob', 'blastp -query q.fasta')
+    >>> job.thread_option = '-num_threads'
+    >>> get_shell_command(job, 'out', '$(THREADS)')
+    'blastp -query q.fasta -num_threads $(THREADS) > out/logs/myjob.out \
+2> out/logs/myjob.err'
+    """
+    escape = escape or (lambda text: text)
+    cmd = escape(job.command)
+    if helper is not None:
+        cmd = cmd.replace(escape(HELPER_PREFIX), helper)
+    if job.thread_option is not None:
+        cmd = "%s %s %s" % (cmd, job.thread_option, threads)
+    logstem = escape(os.path.join(outdir, 'logs', job.name))
+    return "%s > %s.out 2> %s.err" % (cmd, logstem, logstem)
+
+
+# Write a job dependency graph as a Makefile
+def write_makefile(jobgraph, fh, outdir, costs=None):
+    """Writes the passed job dependency graph to the open file fh as a
+    Makefile, with one rule per Job, making its stamp file (see
+    get_stamp_path()) from the stamp files of the Jobs it depends on, and a
+    default 'all' target depending on every Job. Returns the number of Jobs
+    written.
+
+    - jobgraph - iterable of Job objects, each after the Jobs it depends on
+    - fh - open file to write to
+    - outdir - path to the output directory
+    - costs - not used in Makefiles
+
+    A Job that fails leaves no stamp file, so rerunning make runs only the
+    Jobs that failed or did not run. The prerequisites of 'all' are listed
+    in a single rule, at the end, as make slows quadratically when they are
+    added one rule at a time.
+    """
+    fh.write("# Written by pyrbbh.py plan; run from %s with:\n" %
+             os.getcwd())
+    fh.write("#     make -f <this file> -j <jobs> [THREADS=<threads>]\n" +
+             "#         [PYRBBH_PYTHON=<python>] " +
+             "[PYRBBH_PATH=<directory holding pyrbbh>]\n")
+    fh.write("THREADS ?= 1\nPYRBBH_PYTHON ?= %s\nPYRBBH_PATH ?= %s\n" %
+             (HELPER_PYTHON, PYRBBH_PATH.replace('$', '$$')))
+    fh.write("\n.PHONY: all\nall:\n")
+    stamps = []
+    for job in jobgraph:
+        stamp = get_stamp_path(job, outdir)
+        fh.write("\n%s:%s\n\t%s\n\ttouch $@\n" %
+                 (stamp, ''.join(' %s' % get_stamp_path(dep, outdir) for
+                                 dep in job.dependencies),
+                  get_shell_command(job, outdir, '$(THREADS)',
+                                    lambda text: text.replace('$', '$$'),
+                                    MAKE_HELPER)))
+        stamps.append(stamp)
+    fh.write("\nall:%s\n" % ''.join(" \\\n    %s" % stamp for stamp in
+                                     stamps))
+    return len(stamps)
+
+
+# Write a job dependency graph as a Snakemake workflow
+def write_snakefile(jobgraph, fh, outdir, costs=None):
+    """Writes the passed job dependency graph to the open file fh as a
+    Snakemake workflow, with one rule per Job, making its stamp file (see
+    get_stamp_path()) from the stamp files of the Jobs it depends on, and a
+    default 'all' rule depending on every Job. Returns the number of Jobs
+    written.
+
+    - jobgraph - iterable of Job objects, each after the Jobs it depends on
+    - fh - open file to write to
+    - outdir - path to the output directory
+    - costs - function returning the estimated CPU time of a Job, or None;
+      if given, each rule's estimate (in seconds) is set as its 'runtime'
+      resource, in minutes
+
+    Rules are named for their Jobs. The 'all' rule's inputs are listed as
+    the rules are written, and read by an input function once the whole
+    workflow has been parsed.
+    """
+    fh.write("# Written by pyrbbh.py plan; run with:\n")
+    fh.write("#     snakemake -s <this file> --cores <cores> " +
+             "[--config threads=<threads>\n#         python=<python> " +
+             "pyrbbh_path=<directory holding pyrbbh>]\n")
+    fh.write("workdir: %s\n\n" % json.dumps(os.getcwd()))
+    fh.write("THREADS = int(config.get('threads', 1))\n")
+    fh.write("PYRBBH_PYTHON = config.get('python', %s)\n" %
+             json.dumps(HELPER_PYTHON))
+    fh.write("PYRBBH_PATH = config.get('pyrbbh_path', %s)\n" %
+             json.dumps(PYRBBH_PATH))
+    fh.write("STAMPS = []\n\n")
+    fh.write("rule all:\n    input: lambda wildcards: STAMPS\n")
+    count = 0
+    for job in jobgraph:
+        stamp = get_stamp_path(job, outdir)
+        rule = RULE_NAME_INVALID.sub('_', job.name)
+        if not rule[:1].isalpha():
+            rule = "job_%s" % rule
+        fh.write("\nSTAMPS.append(%s)\n\nrule %s:\n" % (json.dumps(stamp),
+                                                          rule))
+        if job.dependencies:
+            fh.write("    input: %s\n" % ', '.join(
+                json.dumps(get_stamp_path(dep, outdir)) for dep in
+                job.dependencies))
+        fh.write("    output: touch(%s)\n" % json.dumps(stamp))
+        if job.thread_option is not None:
+            fh.write("    threads: THREADS\n")
+        if costs is not None:
+            fh.write("    resources: runtime=%d\n" %
+                     max(1, -(-costs(job) // 60)))
+        fh.write("    shell: %s\n" % json.dumps(get_shell_command(
+            job, outdir, '{threads}',
+            lambda text: text.replace('{', '{{').replace('}', '}}'),
+            SNAKEMAKE_HELPER)))
+        count += 1
+    return count
+
+
+# Writers for each plan format
+PLAN_WRITERS = {'json': write_json, 'make': write_makefile,
+                'snakemake': write_snakefile}
+
+
+# Export a job dependency graph in the requested format
+def write_plan(jobgraph, filename, outdir, fmt='json', costs=None):
+    """Writes the passed job dependency graph to filename in the format
+    fmt, without running any Job, and returns the number of Jobs written.
+    The plan is written to a temporary file and moved into place, so that
+    a partial plan is never left behind.
+
+    - jobgraph - iterable of Job objects, each after the Jobs it depends on
+    - filename - path to the plan file
+    - outdir - path to the output directory
+    - fmt - plan format, a key of PLAN_WRITERS
+    - costs - function returning the estimated CPU time of a Job, or None
+
+    The log and stamp directories are created in outdir, so that the plan
+    can be run as written.
+    """
+    os.makedirs(os.path.join(outdir, 'logs'), exist_ok=True)
+    os.makedirs(os.path.join(outdir, STAMP_DIRNAME), exist_ok=True)
+    tmpname = "%s.tmp" % filename
+    with open(tmpname, 'w') as ofh:
+        count = PLAN_WRITERS[fmt](jobgraph, ofh, outdir, costs)
+    os.replace(tmpname, filename)
+    return count
@@ -0,0 +1,374 @@
+# Copyright 2015-2016 The James Hutton Institute
+# Author: Leighton Pritchard
+#
+# rbh.py
+#
+# This code is part of the pyrbbh package, and is governed by its licence.
+# Please see the LICENSE file that should have been included as part of this
+# package.
+
+"""Module to call reciprocal best hits from BLASTP tabular output.
+
+Hit tables are loaded into pandas dataframes with a single columnar read,
+and all filtering, best-hit reduction and joining is carried out with
+vectorised dataframe operations, so that files holding millions of HSPs
+are never iterated over line-by-line in Python.
+
+Reciprocal best hits for a single pair are called by running this module,
+as a job depending on the pair's BLASTP queries:
+
+    python -m pyrbbh.rbh FWDFILE REVFILE -o RBHFILE [--pid P] [--cov C] \
+        [--best FWDBEST REVBEST] [--store STOREFILE --genomes STEM1 STEM2] \
+        [--sweep SWEEPFILE P,C [P,C ...]]
+
+With --best, the best hits in each direction are written to FWDBEST and
+REVBEST, so that they can be added to the results store by the process
+that submitted the job, where the job runs on another host (see
+store.ResultStore), rather than with --store.
+
+With --sweep, reciprocal best hits are also called at each point of a grid
+of identity and coverage thresholds, from the same hit tables, read once,
+and written together to SWEEPFILE with the thresholds in two extra columns.
+"""
+
+import argparse
+import os
+import sys
+
+import pandas as pd
+
+from . import hittable
+from .blast import BLASTP_EXT, HITTABLE_EXT, get_rbh_outfile
+from .hittable import read_text_hits
+from .store import HIT_COLUMNS, ResultStore
+
+
+# Load a BLASTP tabular output file into a dataframe
+def read_hits(filename):
+    """Returns a dataframe of the HSPs in the passed BLASTP tabular output
+    file, with columns named as in blast.BLASTP_COLUMNS.
+
+    - filename - path to BLASTP tabular output (may be compressed), or to
+      a binary hit table (see hittable), if ending in .hits
+
+    An empty file produces an empty dataframe with the expected columns.
+    """
+    if filename.endswith(HITTABLE_EXT):
+        return hittable.read_hits(filename).to_frame()
+    return read_text_hits(filename)
+
+
+# Columns of a sweep table, ahead of the reciprocal best hit columns
+SWEEP_COLUMNS = ('identity', 'coverage')
+
+
+# Reduce a dataframe of HSPs to the best hit for each query
+def best_hits(hits, identity=0.8, coverage=0.8, keys=('qseqid',),
+              ranked=False):
+    """Returns a dataframe holding the single best-scoring hit for each
+    query sequence in the passed dataframe of HSPs.
+
+    - hits - dataframe of HSPs, as returned by read_hits()
+    - identity - minimum fractional percentage identity of a hit
+    - coverage - minimum fractional query coverage of a hit
+    - keys - columns identifying each group from which one hit is kept
+    - ranked - if True, hits are already sorted by descending bitscore, as
+      by rank_hits(), and are not sorted again
+
+    HSPs failing either threshold are discarded before the best hit is
+    chosen by bitscore. Ties are broken by the order of HSPs in the input.
+    """
+    passed = hits[(hits['pident'] >= 100 * identity) &
+                  (hits['qcovs'] >= 100 * coverage)]
+    if not ranked:
+        passed = rank_hits(passed)
+    return passed.drop_duplicates(list(keys)).reset_index(drop=True)
+
+
+# Sort a dataframe of HSPs by descending bitscore
+def rank_hits(hits):
+    """Returns the passed dataframe of HSPs sorted by descending bitscore,
+    keeping the input order of HSPs with equal bitscores.
+
+    - hits - dataframe of HSPs
+    """
+    return hits.sort_values('bitscore', ascending=False, kind='mergesort')
+
+
+# Join forward and reverse best hits to give reciprocal best hits
+def reciprocal_best_hits(fwdbest, revbest):
+    """Returns a dataframe of reciprocal best hits, given dataframes of best
+    hits in the forward and reverse search directions.
+
+    - fwdbest - dataframe of best hits of genome A queries against genome B
+    - revbest - dataframe of best hits of genome B queries against genome A
+
+    The returned dataframe has one row per reciprocal best hit pair, with
+    the query and subject IDs from the forward direction, and the
+    percentage identity, query coverage and bitscore from each direction.
+    """
+    cols = ['qseqid', 'sseqid', 'pident', 'qcovs', 'bitscore']
+    rev = revbest[cols].rename(columns={'qseqid': 'sseqid',
+                                        'sseqid': 'qseqid'})
+    return fwdbest[cols].merge(rev, on=['qseqid', 'sseqid'],
+                               suffixes=('_fwd', '_rev'))
+
+
+# Call reciprocal best hits from a pair of BLASTP output files
+def call_rbh(fwdfile, revfile, identity=0.8, coverage=0.8):
+    """Returns a dataframe of reciprocal best hits from the passed forward
+    and reverse BLASTP tabular output files.
+
+    - fwdfile - path to BLASTP output for genome A queries against genome B
+    - revfile - path to BLASTP output for genome B queries against genome A
+    - identity - minimum fractional percentage identity of a hit
+    - coverage - minimum fractional query coverage of a hit
+    """
+    return reciprocal_best_hits(*call_best_hits(fwdfile, revfile, identity,
+                                                coverage))
+
+
+# Call best hits in each direction from a pair of BLASTP output files
+def call_best_hits(fwdfile, revfile, identity=0.8, coverage=0.8):
+    """Returns a tuple of dataframes (forward best hits, reverse best hits)
+    from the passed forward and reverse BLASTP tabular output files.
+
+    - fwdfile - path to BLASTP output for genome A queries against genome B
+    - revfile - path to BLASTP output for genome B queries against genome A
+    - identity - minimum fractional percentage identity of a hit
+    - coverage - minimum fractional query coverage of a hit
+    """
+    return (best_hits(read_hits(fwdfile), identity, coverage),
+            best_hits(read_hits(revfile), identity, coverage))
+
+
+# Write a dataframe of reciprocal best hits to file
+def write_rbh(rbh, filename):
+    """Writes the passed dataframe of reciprocal best hits to filename as
+    tab-separated plain text, with a header line. Output is written to a
+    temporary file and moved into place, so that a partial table is never
+    left behind.
+
+    - rbh - dataframe of reciprocal best hits
+    - filename - path to output file
+    """
+    tmpname = "%s.tmp" % filename
+    rbh.to_csv(tmpname, sep='\t', index=False)
+    os.replace(tmpname, filename)
+
+
+# Call reciprocal best hits at each point of a grid of thresholds
+def sweep_rbh(fwdhits, revhits, thresholds):
+    """Returns a dataframe of the reciprocal best hits at each of the passed
+    (identity, coverage) thresholds, with the columns of
+    reciprocal_best_hits() preceded by 'identity' and 'coverage'.
+
+    - fwdhits - dataframe of HSPs of genome A queries against genome B
+    - revhits - dataframe of HSPs of genome B queries against genome A
+    - thresholds - list of (identity, coverage) tuples of fractional minima
+
+    Each table is cut to the HSPs passing the lowest thresholds, and sorted
+    by bitscore, once; each grid point is then a filter and de-duplication
+    of the sorted table.
+
+    >>> hits = pd.DataFrame({'qseqid': ['a1', 'a1'], 'sseqid': ['b1', 'b2'], \
+'pident': [85.0, 95.0], 'qcovs': [100, 100], 'bitscore': [500.0, 400.0]})
+    >>> rev = pd.DataFrame({'qseqid': ['b1', 'b2'], 'sseqid': ['a1', 'a1'], \
+'pident': [85.0, 95.0], 'qcovs': [100, 100], 'bitscore': [500.0, 400.0]})
+    >>> sweep_rbh(hits, rev, [(0.8, 0.8), (0.9, 0.8)])[['identity', \
+'qseqid', 'sseqid']].values.tolist()
+    [[0.8, 'a1', 'b1'], [0.9, 'a1', 'b2']]
+    """
+    cols = ['qseqid', 'sseqid', 'pident', 'qcovs', 'bitscore']
+    identity = min(point[0] for point in thresholds)
+    coverage = min(point[1] for point in thresholds)
+    fwd, rev = [rank_hits(hits.loc[(hits['pident'] >= 100 * identity) &
+                                   (hits['qcovs'] >= 100 * coverage), cols])
+                for hits in (fwdhits, revhits)]
+    sets = []
+    for identity, coverage in thresholds:
+        rbhits = reciprocal_best_hits(best_hits(fwd, identity, coverage,
+                                                ranked=True),
+                                      best_hits(rev, identity, coverage,
+                                                ranked=True))
+        rbhits.insert(0, 'coverage', coverage)
+        rbhits.insert(0, 'identity', identity)
+        sets.append(rbhits)
+    return pd.concat(sets, ignore_index=True)
+
+
+# Count reciprocal best hits at each point of a grid of thresholds
+def sweep_counts(sweep, thresholds):
+    """Returns a dataframe with columns 'identity', 'coverage' and 'rbh',
+    giving the number of reciprocal best hits in the passed sweep table at
+    each of the passed thresholds, including those with none.
+
+    - sweep - dataframe of reciprocal best hits, as returned by sweep_rbh()
+    - thresholds - list of (identity, coverage) tuples of fractional minima
+    """
+    grid = pd.DataFrame(list(thresholds), columns=list(SWEEP_COLUMNS))
+    counts = sweep.groupby(list(SWEEP_COLUMNS)).size().rename('rbh')
+    counts = grid.merge(counts.reset_index(), on=list(SWEEP_COLUMNS),
+                        how='left')
+    return counts.fillna({'rbh': 0}).astype({'rbh': 'int64'})
+
+
+# Load a table of best hits or reciprocal best hits written by write_rbh()
+def read_rbh(filename):
+    """Returns a dataframe of the table of best hits or reciprocal best hits
+    in filename, as written by write_rbh().
+
+    - filename - path to table
+    """
+    return pd.read_csv(filename, sep='\t', dtype={'qseqid': str,
+                                                  'sseqid': str})
+
+
+# Load a sweep table written by call_pair()
+def read_sweep(filename):
+    """Returns a dataframe of the sweep table in filename.
+
+    - filename - path to sweep table
+    """
+    return pd.read_csv(filename, sep='\t', dtype={'qseqid': str,
+                                                  'sseqid': str})
+
+
+# Call and write reciprocal best hits for one pair of genomes
+def call_pair(fwdfile, revfile, rbhfile, identity=0.8, coverage=0.8,
+              storefile=None, genomes=None, sweepfile=None, thresholds=None,
+              bestfiles=None):
+    """Calls reciprocal best hits from the passed forward and reverse BLASTP
+    output files and writes them to rbhfile, first adding them, with the
+    best hits in each direction, to the results store in storefile, if
+    given. Returns the dataframe of reciprocal best hits.
+
+    - fwdfile - path to BLASTP output for genome A queries against genome B
+    - revfile - path to BLASTP output for genome B queries against genome A
+    - rbhfile - path to output file
+    - identity - minimum fractional percentage identity of a hit
+    - coverage - minimum fractional query coverage of a hit
+    - storefile - path to results store, or None
+    - genomes - tuple of filestems (genome A, genome B), naming the pair in
+      the results store
+    - sweepfile - path to which reciprocal best hits at each point of
+      thresholds are written (see sweep_rbh()), or None
+    - thresholds - list of (identity, coverage) tuples of fractional minima
+    - bestfiles - tuple of paths (forward, reverse) to which the best hits
+      in each direction are written, with the columns kept in the results
+      store, or None
+
+    Each hit table is read once. The output file is written last, so that
+    it exists only once the pair is complete.
+    """
+    fwdhits, revhits = read_hits(fwdfile), read_hits(revfile)
+    if sweepfile is not None:
+        write_rbh(sweep_rbh(fwdhits, revhits, thresholds), sweepfile)
+    fwdbest = best_hits(fwdhits, identity, coverage)
+    revbest = best_hits(revhits, identity, coverage)
+    rbhits = reciprocal_best_hits(fwdbest, revbest)
+    if bestfiles is not None:
+        for best, bestfile in zip((fwdbest, revbest), bestfiles):
+            write_rbh(best[list(HIT_COLUMNS)], bestfile)
+    if storefile is not None:
+        store = ResultStore(storefile)
+        try:
+            store.add_pair(genomes[0], genomes[1], fwdbest, revbest, rbhits)
+        finally:
+            store.close()
+    write_rbh(rbhits, rbhfile)
+    return rbhits
+
+
+# Returns forward, reverse and output file paths for each pair of inputs
+def get_rbh_pairs(infiles, outdir, ext=BLASTP_EXT):
+    """Returns a list of (fwdfile, revfile, rbhfile) tuples, describing the
+    BLASTP output files for each pairwise comparison of input files, and
+    the file to which reciprocal best hits are to be written.
+
+    Pairs are generated in the same order as the query jobs from
+    blast.make_blastp_jobs().
+
+    - infiles - a list of paths to input FASTA files
+    - outdir - path to directory for BLAST output
+    - ext - filename extension of BLASTP output files
+
+    >>> get_rbh_pairs(['../tests/seqdata/infile1.fasta', \
+'../tests/seqdata/infile2.fasta'], '../tests/output')
+    [('../tests/output/infile1_vs_infile2.tab', \
+'../tests/output/infile2_vs_infile1.tab', \
+'../tests/output/infile1_rbbh_infile2.tab')]
+    """
+    stems = [os.path.splitext(os.path.split(fname)[-1])[0] for fname in
+             infiles]
+    pairs = []
+    for idx, stem1 in enumerate(stems):
+        for stem2 in stems[idx+1:]:
+            fwdfile = os.path.join(outdir, '%s_vs_%s%s' % (stem1, stem2, ext))
+            revfile = os.path.join(outdir, '%s_vs_%s%s' % (stem2, stem1, ext))
+            rbhfile = get_rbh_outfile(stem1, stem2, outdir)
+            pairs.append((fwdfile, revfile, rbhfile))
+    return pairs
+
+
+# Process command-line arguments
+def parse_cmdline(args):
+    """Parse command-line arguments for RBH calling.
+
+    - args - list of command-line arguments
+    """
+    parser = argparse.ArgumentParser(prog="python -m pyrbbh.rbh",
+                                     description="Call reciprocal best hits "
+                                                 "for a pair of genomes")
+    parser.add_argument('fwdfile', action='store',
+                        help='Path to BLASTP output, genome A against B')
+    parser.add_argument('revfile', action='store',
+                        help='Path to BLASTP output, genome B against A')
+    parser.add_argument('-o', '--outfile', dest='outfile',
+                        action='store', required=True,
+                        help='Path to reciprocal best hit output file')
+    parser.add_argument('-p', '--pid', dest='identity',
+                        action='store', default=0.8, type=float,
+                        help='Percentage identity threshold')
+    parser.add_argument('-c', '--cov', dest='coverage',
+                        action='store', default=0.8, type=float,
+                        help='Percentage coverage threshold')
+    parser.add_argument('--best', dest='bestfiles', nargs=2,
+                        action='store', default=None,
+                        metavar=('FWDBEST', 'REVBEST'),
+                        help='Paths to write best hits in each direction to')
+    parser.add_argument('--store', dest='storefile',
+                        action='store', default=None,
+                        help='Path to results store to add the pair to')
+    parser.add_argument('--genomes', dest='genomes', nargs=2,
+                        action='store', default=None,
+                        help='Filestems of genomes A and B (with --store)')
+    parser.add_argument('--sweep', dest='sweep', nargs='+',
+                        action='store', default=None,
+                        metavar='SWEEPFILE P,C',
+                        help='Path to sweep table, then identity,coverage ' +
+                        'thresholds to sweep')
+    parsed = parser.parse_args(args)
+    if (parsed.storefile is None) != (parsed.genomes is None):
+        parser.error("--store and --genomes must be given together")
+    parsed.sweepfile, parsed.thresholds = None, None
+    if parsed.sweep is not None:
+        if len(parsed.sweep) < 2:
+            parser.error("--sweep needs a file and at least one threshold")
+        try:
+            parsed.thresholds = [tuple(float(val) for val in
+                                       point.split(',')) for
+                                 point in parsed.sweep[1:]]
+        except ValueError:
+            parser.error("--sweep thresholds must be IDENTITY,COVERAGE")
+        if any(len(point) != 2 for point in parsed.thresholds):
+            parser.error("--sweep thresholds must be IDENTITY,COVERAGE")
+        parsed.sweepfile = parsed.sweep[0]
+    return parsed
+
+
+if __name__ == "__main__":
+    args = parse_cmdline(sys.argv[1:])
+    call_pair(args.fwdfile, args.revfile, args.outfile, args.identity,
+              args.coverage, args.storefile, args.genomes, args.sweepfile,
+              args.thresholds, args.bestfiles)
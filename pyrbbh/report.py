@@ -0,0 +1,187 @@
+# Copyright 2015-2016 The James Hutton Institute
+# Author: Leighton Pritchard
+#
+# report.py
+#
+# This code is part of the pyrbbh package, and is governed by its licence.
+# Please see the LICENSE file that should have been included as part of this
+# package.
+
+"""Module to write machine-readable reports of resource use in a run.
+
+The report records, for every Job in the dependency graph, its level in the
+graph, the genomes it reads, its status (done, failed, or blocked by a
+failure), its exit code and number of attempts, the worker it ran on (work
+queue only), the cores it was allocated, its queue wait, estimated CPU
+time, wall time, CPU time and peak RSS (where the scheduler records them in
+the Job's stats), and the total size of its output files.
+Per-job records are written as CSV, and as JSON together with summaries
+for each level of the graph and for each input genome. The report of a
+resumed run is merged into the earlier run's, so that Jobs skipped as
+complete keep their records.
+"""
+
+import csv
+import glob
+import json
+import os
+import re
+
+from . import mp
+
+# Columns of the per-job report, in order
+REPORT_FIELDS = ('name', 'level', 'genomes', 'status', 'exit_code',
+                 'attempts', 'host', 'threads', 'queue_wait', 'estimate',
+                 'wall_time', 'cpu_time', 'max_rss', 'output_bytes',
+                 'command')
+
+# Suffix added to the filestem of query shards, removed to find the genome
+SHARD_SUFFIX = re.compile(r'_shard\d+$')
+
+
+# Return the filestems of the genomes a Job reads
+def get_genomes(job, infiles=None):
+    """Returns a list of the filestems of the input FASTA files read by the
+    passed Job, with any query shard suffix removed.
+
+    - job - Job object
+    - infiles - list of paths to the input FASTA files of the run, or None
+
+    If infiles is given, only filestems of those files are returned, so
+    that hit tables and the combined (--allvsall) and unique (--dedup)
+    FASTA files are not taken for genomes.
+
+    >>> from .jobs import Job
+    >>> job = Job('myjob', 'blastp')
+    >>> job.inputs = ['shards/infile1_shard0002.fasta', 'infile2.fasta']
+    >>> get_genomes(job)
+    ['infile1', 'infile2']
+    >>> job.inputs = ['infile1.fasta', 'out/pyrbbh_all.fasta']
+    >>> get_genomes(job, ['in/infile1.fasta', 'in/infile2.fasta'])
+    ['infile1']
+    """
+    stems = [SHARD_SUFFIX.sub('', os.path.splitext(os.path.basename(
+        fname))[0]) for fname in job.inputs]
+    if infiles is None:
+        return stems
+    genomes = set(os.path.splitext(os.path.basename(fname))[0] for fname in
+                  infiles)
+    return [stem for stem in stems if stem in genomes]
+
+
+# Return the total size of a Job's output files
+def get_output_bytes(job):
+    """Returns the total size in bytes of the files matching the passed
+    Job's output patterns.
+
+    - job - Job object
+    """
+    return sum(os.path.getsize(fname) for pattern in job.outputs for fname in
+               glob.glob(pattern))
+
+
+# Build a report record for each Job in a dependency graph
+def get_job_records(jobgraph, infiles=None):
+    """Returns a list of dictionaries, one per Job in the passed dependency
+    graph, with keys from REPORT_FIELDS.
+
+    - jobgraph - dependency graph of Job objects as list of Jobs
+    - infiles - list of paths to the input FASTA files, or None (see
+      get_genomes())
+
+    Fields not recorded for a Job are None.
+    """
+    records = []
+    for level, jobset in enumerate(mp.create_jobsets(jobgraph)):
+        for job in jobset:
+            record = {field: job.stats.get(field) for field in REPORT_FIELDS}
+            record.update({'name': job.name, 'level': level,
+                           'genomes': ' '.join(get_genomes(job, infiles)),
+                           'output_bytes': get_output_bytes(job),
+                           'command': job.command})
+            records.append(record)
+    return records
+
+
+# Read the job records of an earlier report
+def read_job_records(outstem):
+    """Returns the list of per-Job records in the JSON report
+    '<outstem>.json', or an empty list if there is no report.
+
+    - outstem - path and filestem for the report files
+    """
+    if not os.path.isfile(outstem + '.json'):
+        return []
+    with open(outstem + '.json') as fh:
+        return json.load(fh)['jobs']
+
+
+# Summarise job records by a grouping key
+def summarise(records, keyfunc):
+    """Returns a dictionary of summaries of the passed job records, keyed by
+    the values returned by keyfunc for each record (a list of keys, as a
+    record may belong to more than one group).
+
+    - records - list of job record dictionaries
+    - keyfunc - function returning a list of group keys for a record
+
+    Each summary holds the number of jobs, failed jobs and jobs blocked by
+    failures, the total wall time, CPU time and output size, and the
+    largest queue wait and peak RSS.
+    """
+    summaries = {}
+    for record in records:
+        for key in keyfunc(record):
+            summary = summaries.setdefault(key, {'jobs': 0, 'failed': 0,
+                                                 'blocked': 0,
+                                                 'wall_time': 0.0,
+                                                 'cpu_time': 0.0,
+                                                 'output_bytes': 0,
+                                                 'queue_wait': 0.0,
+                                                 'max_rss': 0})
+            summary['jobs'] += 1
+            summary['failed'] += 1 if record['exit_code'] else 0
+            summary['blocked'] += 1 if record['status'] == 'blocked' else 0
+            for field in ('wall_time', 'cpu_time', 'output_bytes'):
+                summary[field] += record[field] or 0
+            for field in ('queue_wait', 'max_rss'):
+                summary[field] = max(summary[field], record[field] or 0)
+    return summaries
+
+
+# Write JSON and CSV run reports
+def write_report(jobgraph, outstem, infiles=None, merge=False):
+    """Writes a report of resource use by the Jobs in the passed dependency
+    graph to '<outstem>.csv' (one row per Job) and '<outstem>.json' (per-Job
+    records, and summaries per level and per genome), returning the number
+    of Jobs reported.
+
+    - jobgraph - dependency graph of Job objects as list of Jobs
+    - outstem - path and filestem for the report files
+    - infiles - list of paths to the input FASTA files, to which Jobs are
+      attributed in the per-genome summary, or None
+    - merge - if True, keep the records of an earlier report for Jobs not
+      in jobgraph
+
+    When resuming a run, jobgraph holds only the Jobs that were rerun, so
+    the earlier report is merged rather than replaced. Records are matched
+    by command line, as job names carry a per-run prefix, and a Job is only
+    skipped if its command is unchanged.
+    """
+    records = get_job_records(jobgraph, infiles)
+    if merge:
+        commands = set(record['command'] for record in records)
+        records.extend(record for record in read_job_records(outstem) if
+                       record['command'] not in commands)
+    with open(outstem + '.csv', 'w', newline='') as ofh:
+        writer = csv.DictWriter(ofh, fieldnames=REPORT_FIELDS)
+        writer.writeheader()
+        writer.writerows(records)
+    with open(outstem + '.json', 'w') as ofh:
+        json.dump({'jobs': records,
+                   'levels': summarise(records,
+                                       lambda rec: [str(rec['level'])]),
+                   'genomes': summarise(records,
+                                        lambda rec: rec['genomes'].split())},
+                  ofh, indent=2)
+    return len(records)
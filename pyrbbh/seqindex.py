@@ -0,0 +1,221 @@
+# Copyright 2015-2016 The James Hutton Institute
+# Author: Leighton Pritchard
+#
+# seqindex.py
+#
+# This code is part of the pyrbbh package, and is governed by its licence.
+# Please see the LICENSE file that should have been included as part of this
+# package.
+
+"""Module to index the sequences in FASTA files.
+
+Each input FASTA file is scanned once, and an index recording the ID,
+length, and byte offset and size of every sequence record is written as a
+NumPy .npy file, which can be memory-mapped, in an index directory within
+the output directory. A JSON file alongside records the size and
+modification time of the FASTA file, so that the index is reused until the
+FASTA file changes.
+
+The index gives sequence counts, lengths and residue totals without
+re-reading the FASTA file, and random access to individual sequences and
+to runs of consecutive records.
+"""
+
+import json
+import os
+
+import numpy as np
+
+# Subdirectory of the output directory holding sequence indices
+INDEX_DIRNAME = '.pyrbbh_index'
+
+
+# Return the NumPy dtype of an index with IDs of the passed width
+def index_dtype(idwidth):
+    """Returns the NumPy structured dtype of a sequence index holding IDs of
+    up to idwidth bytes.
+
+    - idwidth - maximum length of a sequence ID in bytes
+    """
+    return np.dtype([('id', 'S%d' % max(1, idwidth)), ('length', '<i8'),
+                     ('offset', '<i8'), ('size', '<i8')])
+
+
+# Scan a FASTA file, returning its sequence index
+def build_index(fastafile):
+    """Returns a NumPy structured array with one row per sequence record in
+    fastafile, holding the sequence ID (the first word of the header), the
+    sequence length, and the byte offset and size of the record.
+
+    - fastafile - path to FASTA file
+    """
+    ids, lengths, offsets = [], [], []
+    offset = 0
+    with open(fastafile, 'rb') as fh:
+        for line in fh:
+            if line.startswith(b'>'):
+                ids.append(line[1:].split(None, 1)[0] if line[1:].strip()
+                           else b'')
+                lengths.append(0)
+                offsets.append(offset)
+            elif lengths:
+                lengths[-1] += len(line.strip())
+            offset += len(line)
+    index = np.zeros(len(ids), dtype=index_dtype(max([len(seqid) for seqid
+                                                      in ids] or [1])))
+    index['id'] = ids
+    index['length'] = lengths
+    index['offset'] = offsets
+    index['size'] = np.diff(np.append(offsets, offset))
+    return index
+
+
+# The FastaIndex class gives indexed access to a FASTA file
+class FastaIndex:
+    """Objects in this class give access to sequence metadata, and to the
+    sequences themselves, of an indexed FASTA file.
+    """
+    def __init__(self, fastafile, records):
+        """Instantiates a FastaIndex object.
+
+        - fastafile      Path to the indexed FASTA file
+        - records        Index array, as returned by build_index()
+
+        >>> index = FastaIndex('../tests/seqdata/infile1.fasta', \
+build_index('../tests/seqdata/infile1.fasta'))
+        >>> len(index) > 0, index.residues == int(index.lengths.sum())
+        (True, True)
+        """
+        self.fastafile = fastafile
+        self.records = records
+        self._rows = None                # ID -> row number, built on use
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def ids(self):
+        """List of sequence IDs, in file order."""
+        return [seqid.decode() for seqid in self.records['id']]
+
+    @property
+    def lengths(self):
+        """Array of sequence lengths, in file order."""
+        return self.records['length']
+
+    @property
+    def residues(self):
+        """Total number of residues in the file."""
+        return int(self.records['length'].sum())
+
+    def get_lengths(self):
+        """Returns a dictionary of sequence lengths, keyed by sequence ID."""
+        return dict(zip(self.ids, self.records['length'].tolist()))
+
+    def read_records(self, start, stop):
+        """Returns the raw bytes of records start to stop - 1 of the file.
+
+        - start          Index of the first record
+        - stop           Index after the last record
+        """
+        if start >= stop:
+            return b''
+        first, last = self.records[start], self.records[stop - 1]
+        with open(self.fastafile, 'rb') as fh:
+            fh.seek(int(first['offset']))
+            return fh.read(int(last['offset'] + last['size'] -
+                               first['offset']))
+
+    def get_sequence(self, seqid):
+        """Returns the sequence with the passed ID, as a string.
+
+        - seqid          Sequence ID
+
+        >>> index = FastaIndex('../tests/seqdata/infile1.fasta', \
+build_index('../tests/seqdata/infile1.fasta'))
+        >>> len(index.get_sequence(index.ids[-1])) == int(index.lengths[-1])
+        True
+        """
+        if self._rows is None:
+            self._rows = {seqid: row for row, seqid in enumerate(self.ids)}
+        row = self._rows[seqid]
+        lines = self.read_records(row, row + 1).decode().splitlines()
+        return ''.join(line.strip() for line in lines[1:])
+
+
+# Return the paths to the index files for a FASTA file
+def get_index_paths(fastafile, indexdir):
+    """Returns a tuple of paths (index array, index metadata) for the index
+    of the passed FASTA file in indexdir.
+
+    - fastafile - path to FASTA file
+    - indexdir - path to directory holding indices
+
+    >>> get_index_paths('../tests/seqdata/infile1.fasta', 'out/.pyrbbh_index')
+    ('out/.pyrbbh_index/infile1.npy', 'out/.pyrbbh_index/infile1.json')
+    """
+    stem = os.path.join(indexdir,
+                        os.path.splitext(os.path.split(fastafile)[-1])[0])
+    return stem + '.npy', stem + '.json'
+
+
+# Return the metadata identifying a FASTA file's current contents
+def get_source_metadata(fastafile):
+    """Returns a dictionary of the absolute path, size and modification time
+    of the passed FASTA file, against which an index is checked.
+
+    - fastafile - path to FASTA file
+    """
+    stat = os.stat(fastafile)
+    return {'source': os.path.abspath(fastafile), 'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns}
+
+
+# Load the index of a FASTA file, building it if necessary
+def load_index(fastafile, indexdir, mmap=True):
+    """Returns a FastaIndex for the passed FASTA file, reading the index from
+    indexdir if it is up to date, or scanning the file and writing the index
+    to indexdir if not.
+
+    - fastafile - path to FASTA file
+    - indexdir - path to directory holding indices
+    - mmap - if True, memory-map the index array rather than reading it
+    """
+    arrayfile, metafile = get_index_paths(fastafile, indexdir)
+    metadata = get_source_metadata(fastafile)
+    if os.path.isfile(arrayfile) and os.path.isfile(metafile):
+        with open(metafile) as fh:
+            if json.load(fh) == metadata:
+                return FastaIndex(fastafile,
+                                  np.load(arrayfile,
+                                          mmap_mode='r' if mmap else None))
+    records = build_index(fastafile)
+    os.makedirs(indexdir, exist_ok=True)
+    with open(arrayfile + '.tmp', 'wb') as ofh:
+        np.save(ofh, records)
+    os.replace(arrayfile + '.tmp', arrayfile)
+    with open(metafile + '.tmp', 'w') as ofh:
+        json.dump(metadata, ofh)
+    os.replace(metafile + '.tmp', metafile)
+    return FastaIndex(fastafile, records)
+
+
+# Index each of a list of FASTA files
+def index_fasta_files(infiles, outdir, logger=None):
+    """Returns a dictionary of FastaIndex objects for the passed FASTA files,
+    keyed by path, building and caching any index that is missing or out of
+    date in the index directory within outdir.
+
+    - infiles - list of paths to FASTA files
+    - outdir - path to output directory
+    - logger - logger object
+    """
+    indexdir = os.path.join(outdir, INDEX_DIRNAME)
+    indices = {}
+    for fname in infiles:
+        indices[fname] = load_index(fname, indexdir)
+        if logger:
+            logger.info("%s: %d sequences, %d residues" %
+                        (fname, len(indices[fname]),
+                         indices[fname].residues))
+    return indices
@@ -0,0 +1,272 @@
+# Copyright 2015-2016 The James Hutton Institute
+# Author: Leighton Pritchard
+#
+# sge.py
+#
+# This code is part of the pyrbbh package, and is governed by its licence.
+# Please see the LICENSE file that should have been included as part of this
+# package.
+
+"""Code to run job dependency graphs on an SGE/OGE/OGS scheduler.
+
+Rather than submitting one job to the scheduler per command, each level of
+the job dependency graph is submitted as one or more array jobs. Each task
+of an array runs a single command, read by task ID from a file of commands
+that accompanies the array's script. Arrays at each level are held, with
+-hold_jid, until all arrays at the level before have finished, so that
+only a handful of qsub calls are needed, however many jobs there are.
+
+Each task writes its exit code to a sentinel file when it finishes, and a
+single monitor.JobMonitor follows the progress of all tasks. As -hold_jid
+releases held arrays however the arrays they wait on ended, each task first
+reads the sentinel files of the Jobs it depends on: if any of them failed,
+or left no sentinel, the task does not run its command, and its Job is
+reported as blocked, as for local runs.
+"""
+
+import os
+import subprocess
+
+from .config import QSUB_DEFAULT, QSTAT_DEFAULT, SGE_ARRAY_MAX
+from .monitor import JobMonitor
+from . import mp
+
+# Subdirectory of the output directory for SGE scripts and logs, and its
+# subdirectory for task sentinel files
+SGE_DIRNAME = 'sge'
+STATUS_DIRNAME = 'status'
+
+# Sentinel value written by a task whose Job is blocked by a failed
+# dependency (exit codes are never negative)
+BLOCKED_RETVAL = -2
+
+# Script run by each task of an array job; the sentinel file is written via
+# a temporary file so that it never appears incomplete
+ARRAY_SCRIPT = """#!/bin/sh
+#$ -S /bin/sh
+SENTINEL=%(statusdir)s/%(name)s.${SGE_TASK_ID}
+for DEP in $(sed -n "${SGE_TASK_ID}p" %(depfile)s); do
+    if [ "$(cat %(statusdir)s/$DEP 2>/dev/null)" != 0 ]; then
+        echo %(blocked)d > $SENTINEL.tmp && mv $SENTINEL.tmp $SENTINEL
+        exit 0
+    fi
+done
+CMD=$(sed -n "${SGE_TASK_ID}p" %(cmdfile)s)
+(eval "$CMD")
+RETVAL=$?
+echo $RETVAL > $SENTINEL.tmp && mv $SENTINEL.tmp $SENTINEL
+exit $RETVAL
+"""
+
+
+# Split a job dependency graph into array jobs
+def create_arrays(jobgraph, jobprefix, maxtasks=SGE_ARRAY_MAX, logger=None,
+                  costs=None):
+    """Returns a list of levels of the job dependency graph, each a list of
+    (array name, list of Jobs) tuples, with no array holding more than
+    maxtasks Jobs.
+
+    - jobgraph - dependency graph of Job objects as list of Jobs
+    - jobprefix - a string to prefix array job names
+    - maxtasks - maximum number of tasks in an array job
+    - logger - logger object
+    - costs - function returning the estimated CPU time of a Job, or None
+
+    If costs is given, the Jobs at each level are ordered longest first, as
+    the scheduler dispatches array tasks in task ID order.
+
+    >>> from .jobs import Job
+    >>> jobgraph = [Job('j%d' % idx, 'true') for idx in range(5)]
+    >>> for job in jobgraph[1:]:
+    ...     job.add_dependency(jobgraph[0])
+    >>> [[(name, len(tasks)) for name, tasks in level] for level in \
+create_arrays(jobgraph, 'RBH', 3)]
+    [[('RBH_L00_000', 1)], [('RBH_L01_000', 3), ('RBH_L01_001', 1)]]
+    """
+    levels = []
+    for depth, jobset in enumerate(mp.create_jobsets(jobgraph, logger)):
+        if costs is not None:
+            jobset.sort(key=costs, reverse=True)
+        levels.append([("%s_L%02d_%03d" % (jobprefix, depth, idx // maxtasks),
+                        jobset[idx:idx + maxtasks]) for idx in
+                       range(0, len(jobset), maxtasks)])
+    return levels
+
+
+# Write the command file and script for an array job
+def write_array_script(name, tasks, sgedir, statusdir, sentinels=None):
+    """Writes the commands for each task of an array job to a file, and the
+    sentinel names of each task's dependencies to another, and a script
+    that runs the command for the current SGE_TASK_ID, returning the path
+    to the script.
+
+    - name - name of the array job
+    - tasks - list of Jobs, one per task, in task ID order
+    - sgedir - path to directory for SGE scripts
+    - statusdir - path to directory for task sentinel files
+    - sentinels - dictionary of sentinel names of submitted Jobs, keyed by
+      Job, or None
+
+    Each task writes its exit code to the sentinel file '<name>.<task ID>'
+    in statusdir. If the sentinel of any dependency in sentinels does not
+    hold 0, the task writes BLOCKED_RETVAL without running its command.
+    """
+    sentinels = {} if sentinels is None else sentinels
+    cmdfile = os.path.join(sgedir, "%s.cmds" % name)
+    with open(cmdfile, 'w') as ofh:
+        ofh.write(''.join("%s\n" % job.get_command() for job in tasks))
+    depfile = os.path.join(sgedir, "%s.deps" % name)
+    with open(depfile, 'w') as ofh:
+        ofh.write(''.join("%s\n" % ' '.join(sentinels[dep] for dep in
+                                            job.dependencies if
+                                            dep in sentinels)
+                          for job in tasks))
+    script = os.path.join(sgedir, "%s.sh" % name)
+    with open(script, 'w') as ofh:
+        ofh.write(ARRAY_SCRIPT % {'cmdfile': os.path.abspath(cmdfile),
+                                  'depfile': os.path.abspath(depfile),
+                                  'statusdir': os.path.abspath(statusdir),
+                                  'name': name,
+                                  'blocked': BLOCKED_RETVAL})
+    for job in tasks:
+        job.scriptPath = script
+    return script
+
+
+# Remove sentinel files left by an earlier run for an array job
+def clear_sentinels(name, ntasks, statusdir):
+    """Removes any sentinel files, complete or not, for the tasks of the
+    named array job, so that files left by an earlier run using the same
+    array names are not read as this run's exit codes.
+
+    - name - name of the array job
+    - ntasks - number of tasks in the array
+    - statusdir - path to directory for task sentinel files
+    """
+    for taskid in range(1, ntasks + 1):
+        sentinel = os.path.join(statusdir, "%s.%d" % (name, taskid))
+        for fname in (sentinel, "%s.tmp" % sentinel):
+            try:
+                os.remove(fname)
+            except FileNotFoundError:
+                pass
+
+
+# Build a qsub command line for an array job
+def construct_qsub_cmd(name, script, ntasks, holds, logdir,
+                       qsub_exe=QSUB_DEFAULT, queue=None):
+    """Returns a qsub command line, as a list of arguments, submitting script
+    as an array job with ntasks tasks.
+
+    - name - name of the array job
+    - script - path to the array job script
+    - ntasks - number of tasks in the array
+    - holds - list of names of array jobs that must finish first
+    - logdir - path to directory for task stdout/stderr
+    - qsub_exe - path to qsub executable
+    - queue - SGE queue to submit to, or None
+
+    >>> construct_qsub_cmd('RBH_L01_000', 'RBH_L01_000.sh', 10, \
+['RBH_L00_000'], 'logs')
+    ['qsub', '-terse', '-V', '-cwd', '-N', 'RBH_L01_000', '-t', '1-10', \
+'-o', 'logs', '-e', 'logs', '-hold_jid', 'RBH_L00_000', 'RBH_L01_000.sh']
+    """
+    cmd = [qsub_exe, '-terse', '-V', '-cwd', '-N', name,
+           '-t', '1-%d' % ntasks, '-o', logdir, '-e', logdir]
+    if holds:
+        cmd.extend(['-hold_jid', ','.join(holds)])
+    if queue is not None:
+        cmd.extend(['-q', queue])
+    cmd.append(script)
+    return cmd
+
+
+# Run a job dependency graph as SGE array jobs
+def run_dependency_graph(jobgraph, outdir, jobprefix,
+                         qsub_exe=QSUB_DEFAULT, qstat_exe=QSTAT_DEFAULT,
+                         logger=None, callback=None, costs=None):
+    """Submits the Jobs in the passed dependency graph to SGE as array jobs,
+    waits for them to finish, and returns a dictionary of exit values keyed
+    by job name.
+
+    - jobgraph - dependency graph of Job objects as list of Jobs
+    - outdir - path to output directory, where SGE scripts/logs are written
+    - jobprefix - a string to prefix array job names
+    - qsub_exe - path to qsub executable
+    - qstat_exe - path to qstat executable
+    - logger - logger object
+    - callback - function called with (job, exit value) as each Job finishes
+    - costs - function returning the estimated CPU time of a Job, or None
+
+    The exit value of each Job is read from the sentinel file written by
+    its task; sentinels left by an earlier run with the same jobprefix are
+    removed before each array is submitted. A task that leaves the queue
+    without writing a sentinel is reported with exit value 1. If an array
+    cannot be submitted, nothing further is submitted, and the Jobs not
+    submitted are reported with exit value -1. Jobs depending on a failed
+    Job are not run, and are marked as blocked, with no exit value.
+    """
+    sgedir = os.path.join(outdir, SGE_DIRNAME)
+    statusdir = os.path.join(sgedir, STATUS_DIRNAME)
+    os.makedirs(statusdir, exist_ok=True)
+    jobmonitor = JobMonitor(statusdir, qstat_exe)
+    tasknames = {}  # sentinel name -> Job
+    sentinels = {}  # Job -> sentinel name
+    holds = []
+    for level in create_arrays(jobgraph, jobprefix, logger=logger,
+                               costs=costs):
+        names = []
+        for name, tasks in level:
+            script = write_array_script(name, tasks, sgedir, statusdir,
+                                        sentinels)
+            clear_sentinels(name, len(tasks), statusdir)
+            cmd = construct_qsub_cmd(name, script, len(tasks), holds, sgedir,
+                                     qsub_exe, tasks[0].queue)
+            if logger:
+                logger.info("Submitting %s (%d tasks): %s" %
+                            (name, len(tasks), ' '.join(cmd)))
+            if subprocess.call(cmd, stdout=subprocess.DEVNULL):
+                if logger:
+                    logger.error("Could not submit %s" % name)
+                break
+            for taskid, job in enumerate(tasks, 1):
+                job.submitted = True
+                if costs is not None:
+                    job.stats['estimate'] = costs(job)
+                tasknames["%s.%d" % (name, taskid)] = job
+                sentinels[job] = "%s.%d" % (name, taskid)
+                jobmonitor.watch("%s.%d" % (name, taskid), name)
+            names.append(name)
+        else:
+            holds = names
+            continue
+        break  # stop submitting after a failure
+
+    # Collect exit values as tasks finish
+    retvals = {job.name: -1 for job in jobgraph if not job.submitted}
+    blocked = []
+
+    def task_callback(taskname, retval):
+        """Report completion of an array task as completion of its Job."""
+        job = tasknames[taskname]
+        if retval == BLOCKED_RETVAL:
+            job.stats['status'] = 'blocked'
+            blocked.append(job)
+            return
+        if retval is None:
+            if logger:
+                logger.error("%s left the queue without finishing" % job.name)
+            retval = 1
+        retvals[job.name] = retval
+        job.stats['exit_code'] = retval
+        job.stats['status'] = 'failed' if retval else 'done'
+        if callback is not None:
+            callback(job, retval)
+
+    if logger:
+        logger.info("Waiting for %d tasks" % jobmonitor.outstanding)
+    jobmonitor.wait(task_callback)
+    if logger and blocked:
+        logger.warning("Blocked %d jobs depending on failed jobs" %
+                       len(blocked))
+    return retvals
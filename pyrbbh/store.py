@@ -0,0 +1,275 @@
+# Copyright 2015-2016 The James Hutton Institute
+# Author: Leighton Pritchard
+#
+# store.py
+#
+# This code is part of the pyrbbh package, and is governed by its licence.
+# Please see the LICENSE file that should have been included as part of this
+# package.
+
+"""Module to keep best hits and reciprocal best hits in an SQLite database.
+
+Results for each pair of genomes are added in a single transaction, as the
+pair is called, replacing any earlier results for that pair, so the store
+is filled incrementally and can be read while a run is in progress. Best
+hits and reciprocal best hits are indexed by sequence ID and by genome, so
+that, for example, all orthologues of a protein across all genomes are
+found with one indexed lookup, rather than by scanning every output file:
+
+    store = ResultStore('output/pyrbbh_results.sqlite')
+    store.orthologues('WP_000027057.1')
+
+Sequence IDs need not be unique across genomes, so lookups may be limited
+to a single genome.
+
+The store keeps SQLite's default rollback journal, rather than a write-ahead
+log, as the output directory may be on a network filesystem shared with
+other hosts, where a write-ahead log's shared memory index does not work.
+"""
+
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+# Default name of the results store, in the output directory
+STORE_FILENAME = 'pyrbbh_results.sqlite'
+
+# Columns of a best hit table kept in the store
+HIT_COLUMNS = ('qseqid', 'sseqid', 'pident', 'qcovs', 'bitscore')
+
+# Columns of a reciprocal best hit table kept in the store, as returned by
+# rbh.reciprocal_best_hits()
+RBH_COLUMNS = ('qseqid', 'sseqid', 'pident_fwd', 'qcovs_fwd', 'bitscore_fwd',
+               'pident_rev', 'qcovs_rev', 'bitscore_rev')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS genomes (id INTEGER PRIMARY KEY,
+                                    name TEXT UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS best_hits (qgenome INTEGER, qseqid TEXT,
+                                      sgenome INTEGER, sseqid TEXT,
+                                      pident REAL, qcovs REAL,
+                                      bitscore REAL);
+CREATE INDEX IF NOT EXISTS best_hits_query ON best_hits (qseqid, qgenome);
+CREATE INDEX IF NOT EXISTS best_hits_genomes ON best_hits (qgenome, sgenome);
+CREATE TABLE IF NOT EXISTS rbh (genome1 INTEGER, seqid1 TEXT,
+                                genome2 INTEGER, seqid2 TEXT,
+                                pident_fwd REAL, qcovs_fwd REAL,
+                                bitscore_fwd REAL, pident_rev REAL,
+                                qcovs_rev REAL, bitscore_rev REAL);
+CREATE INDEX IF NOT EXISTS rbh_seqid1 ON rbh (seqid1, genome1);
+CREATE INDEX IF NOT EXISTS rbh_seqid2 ON rbh (seqid2, genome2);
+CREATE INDEX IF NOT EXISTS rbh_genomes ON rbh (genome1, genome2);
+"""
+
+# Orthologues of a sequence, looked up from either side of each RBH pair
+ORTHOLOGUE_QUERY = """
+SELECT ga.name AS qgenome, r.seqid1 AS qseqid, gb.name AS sgenome,
+       r.seqid2 AS sseqid, r.pident_fwd AS pident, r.bitscore_fwd AS bitscore
+  FROM rbh r JOIN genomes ga ON r.genome1 = ga.id
+             JOIN genomes gb ON r.genome2 = gb.id
+ WHERE r.seqid1 = :seqid AND (:genome IS NULL OR ga.name = :genome)
+UNION ALL
+SELECT gb.name, r.seqid2, ga.name, r.seqid1, r.pident_rev, r.bitscore_rev
+  FROM rbh r JOIN genomes ga ON r.genome1 = ga.id
+             JOIN genomes gb ON r.genome2 = gb.id
+ WHERE r.seqid2 = :seqid AND (:genome IS NULL OR gb.name = :genome)
+"""
+
+
+# The ResultStore class holds best hits and RBH pairs in SQLite
+class ResultStore:
+    """Objects in this class add best hits and reciprocal best hits for
+    pairs of genomes to an SQLite database, and look them up.
+    """
+    def __init__(self, filename, timeout=60):
+        """Instantiates a ResultStore object, creating the database if it
+        does not exist.
+
+        - filename       Path to SQLite database file
+        - timeout        Seconds to wait for another process's write
+
+        >>> store = ResultStore(':memory:')
+        >>> store.genomes()
+        []
+        """
+        self.filename = filename
+        self._conn = sqlite3.connect(filename, timeout=timeout)
+        self._conn.executescript(SCHEMA)
+        self._genome_ids = {}            # genome name -> id
+
+    def close(self):
+        """Close the connection to the database."""
+        self._conn.close()
+
+    def genome_id(self, name):
+        """Returns the ID of the named genome, adding it if necessary.
+
+        - name           Genome filestem
+        """
+        if name not in self._genome_ids:
+            self._conn.execute("INSERT OR IGNORE INTO genomes (name) "
+                               "VALUES (?)", (name,))
+            self._genome_ids[name] = self._conn.execute(
+                "SELECT id FROM genomes WHERE name = ?", (name,)).fetchone()[0]
+        return self._genome_ids[name]
+
+    def genomes(self):
+        """Returns a sorted list of the names of genomes in the store."""
+        return [row[0] for row in
+                self._conn.execute("SELECT name FROM genomes ORDER BY name")]
+
+    def add_pair(self, genome1, genome2, fwdbest, revbest, rbhits):
+        """Replaces the results held for a pair of genomes with those passed,
+        in a single transaction.
+
+        - genome1        Filestem of the first genome
+        - genome2        Filestem of the second genome
+        - fwdbest        Dataframe of best hits of genome1 against genome2
+        - revbest        Dataframe of best hits of genome2 against genome1
+        - rbhits         Dataframe of reciprocal best hits, as returned by
+                         rbh.reciprocal_best_hits()
+
+        >>> from .rbh import reciprocal_best_hits
+        >>> hits = pd.DataFrame({'qseqid': ['a1'], 'sseqid': ['b1'], \
+'pident': [99.0], 'qcovs': [100], 'bitscore': [500.0]})
+        >>> rev = hits.rename(columns={'qseqid': 'sseqid', 'sseqid': 'qseqid'})
+        >>> rbhits = reciprocal_best_hits(hits, rev)
+        >>> store = ResultStore(':memory:')
+        >>> store.add_pair('A', 'B', hits, rev, rbhits)
+        >>> store.orthologues('b1')[['qgenome', 'sgenome', 'sseqid']].values
+        array([['B', 'A', 'a1']], dtype=object)
+        """
+        with self._conn:
+            id1, id2 = self.genome_id(genome1), self.genome_id(genome2)
+            for qid, sid in ((id1, id2), (id2, id1)):
+                self._conn.execute("DELETE FROM best_hits WHERE qgenome = ? "
+                                   "AND sgenome = ?", (qid, sid))
+            self._conn.execute("DELETE FROM rbh WHERE genome1 = ? AND "
+                               "genome2 = ?", (id1, id2))
+            for qid, sid, best in ((id1, id2, fwdbest), (id2, id1, revbest)):
+                self._conn.executemany(
+                    "INSERT INTO best_hits VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    ((qid, row[0], sid, row[1], row[2], row[3], row[4]) for
+                     row in best[list(HIT_COLUMNS)].itertuples(index=False)))
+            self._conn.executemany(
+                "INSERT INTO rbh VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                ((id1, row[0], id2) + tuple(row[1:]) for row in
+                 rbhits[list(RBH_COLUMNS)].itertuples(index=False)))
+
+    def orthologues(self, seqid, genome=None):
+        """Returns a dataframe of the reciprocal best hits of the passed
+        sequence in every other genome, with columns 'qgenome', 'qseqid',
+        'sgenome', 'sseqid', 'pident' and 'bitscore'.
+
+        - seqid          Sequence ID
+        - genome         Genome filestem, to limit the lookup to seqid in
+                         that genome, or None
+        """
+        return pd.read_sql_query(ORTHOLOGUE_QUERY, self._conn,
+                                 params={'seqid': seqid, 'genome': genome})
+
+    def best_hits(self, seqid, genome=None):
+        """Returns a dataframe of the best hits of the passed sequence in
+        every other genome, with columns 'qgenome', 'qseqid', 'sgenome',
+        'sseqid', 'pident', 'qcovs' and 'bitscore'.
+
+        - seqid          Sequence ID
+        - genome         Genome filestem, to limit the lookup to seqid in
+                         that genome, or None
+        """
+        return pd.read_sql_query(
+            "SELECT gq.name AS qgenome, h.qseqid, gs.name AS sgenome, "
+            "h.sseqid, h.pident, h.qcovs, h.bitscore FROM best_hits h "
+            "JOIN genomes gq ON h.qgenome = gq.id "
+            "JOIN genomes gs ON h.sgenome = gs.id "
+            "WHERE h.qseqid = :seqid AND (:genome IS NULL OR "
+            "gq.name = :genome)", self._conn,
+            params={'seqid': seqid, 'genome': genome})
+
+    def hit_graph(self, nodes, chunksize=1000000):
+        """Returns a tuple of NumPy arrays (rows, cols, weights) giving the
+        best hits in the store as edges between the passed sequences: the
+        row numbers in nodes of the query and subject of each best hit, and
+        its bitscore. Best hits between sequences not in nodes are left out.
+
+        - nodes          Dataframe with columns 'genome' and 'seqid', one row
+                         per sequence
+        - chunksize      Number of edges read from the database at a time
+
+        Sequence IDs are matched to row numbers within the database, so
+        only integer edges are read back. Genomes are looked up without
+        being added, so that no write lock is taken on the store; sequences
+        of genomes not in the store have no edges.
+
+        >>> from .rbh import reciprocal_best_hits
+        >>> hits = pd.DataFrame({'qseqid': ['a1'], 'sseqid': ['b1'], \
+'pident': [99.0], 'qcovs': [100], 'bitscore': [500.0]})
+        >>> store = ResultStore(':memory:')
+        >>> store.add_pair('A', 'B', hits, hits.iloc[:0], \
+reciprocal_best_hits(hits, hits.iloc[:0]))
+        >>> nodes = pd.DataFrame({'genome': ['B', 'A'], 'seqid': ['b1', 'a1']})
+        >>> [arr.tolist() for arr in store.hit_graph(nodes)]
+        [[1], [0], [500.0]]
+        """
+        genome_ids = dict(self._conn.execute("SELECT name, id FROM genomes"))
+        with self._conn:
+            self._conn.execute("DROP TABLE IF EXISTS temp.nodes")
+            self._conn.execute("CREATE TEMP TABLE nodes (idx INTEGER "
+                               "PRIMARY KEY, genome INTEGER, seqid TEXT)")
+            self._conn.executemany(
+                "INSERT INTO temp.nodes VALUES (?, ?, ?)",
+                ((idx, genome_ids.get(genome), seqid) for
+                 idx, (genome, seqid) in
+                 enumerate(nodes[['genome', 'seqid']].itertuples(
+                     index=False))))
+            self._conn.execute("CREATE INDEX temp.nodes_seqid ON nodes "
+                               "(seqid, genome)")
+        cursor = self._conn.execute(
+            "SELECT nq.idx, ns.idx, h.bitscore FROM best_hits h "
+            "JOIN temp.nodes nq ON nq.seqid = h.qseqid AND "
+            "nq.genome = h.qgenome "
+            "JOIN temp.nodes ns ON ns.seqid = h.sseqid AND "
+            "ns.genome = h.sgenome")
+        chunks = []
+        while True:
+            rows = cursor.fetchmany(chunksize)
+            if not rows:
+                break
+            chunks.append(np.array(rows, dtype=np.float64).reshape(-1, 3))
+        self._conn.execute("DROP TABLE temp.nodes")
+        edges = np.concatenate(chunks) if chunks else np.empty((0, 3))
+        return (edges[:, 0].astype(np.int64), edges[:, 1].astype(np.int64),
+                edges[:, 2])
+
+    def pair(self, genome1, genome2):
+        """Returns a dataframe of the reciprocal best hits between the passed
+        genomes, with the columns of rbh.reciprocal_best_hits(), and
+        sequence IDs of genome1 in 'qseqid'.
+
+        - genome1        Filestem of the first genome
+        - genome2        Filestem of the second genome
+        """
+        fwd = self.__read_pair(genome1, genome2)
+        if len(fwd) or genome1 == genome2:
+            return fwd
+        rev = self.__read_pair(genome2, genome1)
+        swapped = {'qseqid': 'sseqid', 'sseqid': 'qseqid'}
+        for col in ('pident', 'qcovs', 'bitscore'):
+            swapped.update({'%s_fwd' % col: '%s_rev' % col,
+                            '%s_rev' % col: '%s_fwd' % col})
+        return rev.rename(columns=swapped)[list(RBH_COLUMNS)]
+
+    def __read_pair(self, genome1, genome2):
+        """Returns a dataframe of the reciprocal best hits stored with genome1
+        as the first genome of the pair and genome2 as the second.
+
+        - genome1        Filestem of the first genome
+        - genome2        Filestem of the second genome
+        """
+        return pd.read_sql_query(
+            "SELECT seqid1 AS qseqid, seqid2 AS sseqid, %s FROM rbh r "
+            "JOIN genomes ga ON r.genome1 = ga.id "
+            "JOIN genomes gb ON r.genome2 = gb.id "
+            "WHERE ga.name = ? AND gb.name = ?" % ', '.join(RBH_COLUMNS[2:]),
+            self._conn, params=(genome1, genome2))
@@ -0,0 +1,580 @@
+# Copyright 2015-2016 The James Hutton Institute
+# Author: Leighton Pritchard
+#
+# workqueue.py
+#
+# This code is part of the pyrbbh package, and is governed by its licence.
+# Please see the LICENSE file that should have been included as part of this
+# package.
+
+"""Code to run job dependency graphs on workers across many hosts.
+
+A coordinator serves the Jobs of a dependency graph over TCP. Workers,
+started on any host with 'pyrbbh.py worker HOST:PORT', connect to it and
+say how many cores they offer. The coordinator sends each worker Jobs as
+their dependencies complete and the worker has cores free, allocating
+cores as for local runs (see jobs.allocate_threads()), and each worker
+runs its Jobs as local subprocesses (see aio.run_job()), sending back the
+exit code and resource use of each.
+
+Messages are JSON objects, one per line. A worker opens with 'hello',
+giving its name, cores and the shared token, and the coordinator replies
+'welcome', or closes the connection if the token is wrong. The coordinator
+then sends 'job' messages, and finally 'stop'; the worker sends 'result'
+for each Job, and a 'heartbeat' every QUEUE_HEARTBEAT seconds.
+
+A worker whose connection closes, or that is silent for QUEUE_TIMEOUT
+seconds, is taken to be lost, and the Jobs it was running are returned to
+the ready queue, to be sent to another worker. A Job lost with its worker
+more than MAX_LOSSES times is reported as failed, so that a Job that
+brings down its host cannot stall the run. A Job that fails is retried as
+by aio.run_dependency_graph(), returning to the ready queue after each
+delay, so that it may be retried on another worker.
+
+Workers must see the input and output files at the same paths as the
+coordinator (e.g. on a shared filesystem): each worker changes to the
+coordinator's working directory before running Jobs, and writes per-job
+logs to the coordinator's log directory.
+"""
+
+import asyncio
+import collections
+import hmac
+import json
+import multiprocessing
+import os
+import socket
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . import aio, jobs
+from .config import QUEUE_HEARTBEAT, QUEUE_PORT, QUEUE_TIMEOUT, RETRY_BACKOFF
+
+# Number of times a Job may be lost with its worker before it is failed
+MAX_LOSSES = 3
+
+# Longest message, in bytes
+LINE_LIMIT = 2 ** 20
+
+
+# Send a message over a connection
+async def send_message(writer, message):
+    """Writes the passed message to writer as a line of JSON, and waits for
+    it to be sent.
+
+    - writer - asyncio.StreamWriter
+    - message - dictionary with at least the key 'type'
+    """
+    writer.write(json.dumps(message).encode() + b'\n')
+    await writer.drain()
+
+
+# Receive a message from a connection
+async def read_message(reader):
+    """Returns the next message from reader as a dictionary, or None if the
+    connection has closed.
+
+    - reader - asyncio.StreamReader
+    """
+    line = await reader.readline()
+    if not line:
+        return None
+    return json.loads(line)
+
+
+# Split a HOST:PORT address
+def parse_address(address, port=QUEUE_PORT):
+    """Returns a tuple of (host, port) from an address 'HOST:PORT' or
+    'HOST', taking the passed default port in the latter case.
+
+    - address - coordinator address
+    - port - default port
+
+    >>> parse_address('node01:8000'), parse_address('node01')
+    (('node01', 8000), ('node01', 7460))
+    """
+    host, sep, portstr = address.rpartition(':')
+    if not sep:
+        return address, port
+    return host, int(portstr)
+
+
+# The WorkerState class holds the coordinator's view of a worker
+class WorkerState:
+    """Objects in this class record a connected worker, the cores it has
+    free, and the Jobs it is running.
+    """
+    def __init__(self, name, writer, cores):
+        """Instantiates a WorkerState object.
+
+        - name           Unique name of the worker
+        - writer         asyncio.StreamWriter for the worker's connection
+        - cores          Number of cores the worker offers
+        """
+        self.name = name
+        self.writer = writer
+        self.cores = cores
+        self.free = cores                # cores not in use by Jobs
+        self.running = {}                # job name -> (Job, cores)
+
+
+# The Coordinator class serves a job dependency graph to workers
+class Coordinator:
+    """Objects in this class send the Jobs of a dependency graph to the
+    workers connected to them, as dependencies allow, and collect their
+    exit values.
+    """
+    def __init__(self, jobgraph, token, logdir=None, logger=None,
+                 callback=None, keep_going=False, costs=None,
+                 timeout=QUEUE_TIMEOUT, retries=0, backoff=RETRY_BACKOFF):
+        """Instantiates a Coordinator object.
+
+        - jobgraph       Dependency graph of Job objects as list of Jobs
+        - token          String workers must present to be sent Jobs
+        - logdir         Path to directory for per-job log files, or None
+        - logger         Logger object
+        - callback       Function called with (job, exit value) as each Job
+                         finishes
+        - keep_going     If True, carry on running Jobs after a failure
+        - costs          Function returning the estimated CPU time of a
+                         Job, or None; if given, the longest Jobs are sent
+                         first
+        - timeout        Seconds of silence before a worker is lost
+        - retries        Most times to rerun a Job after a failure
+        - backoff        Seconds before a Job's first retry, doubling for
+                         each retry after
+        """
+        self.tracker = jobs.JobTracker(jobgraph, costs)
+        self.token = token
+        self.logdir = None if logdir is None else os.path.abspath(logdir)
+        self.logger = logger
+        self.callback = callback
+        self.keep_going = keep_going
+        self.costs = costs
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.retvals = {}
+        self.failed = False
+        self.done = False
+        self._workers = {}               # worker name -> WorkerState
+        self._handlers = set()           # tasks handling connections
+        self._connections = 0            # count of workers ever connected
+        self._losses = collections.Counter()  # job name -> times lost
+        self._attempts = collections.Counter()  # job name -> times run
+        self._retrying = 0               # count of Jobs waiting to retry
+        self._readytimes = {}            # time each Job became ready
+        self._changed = None             # asyncio.Event set on progress
+
+    @property
+    def running_count(self):
+        """Number of Jobs running on workers."""
+        return sum(len(worker.running) for worker in self._workers.values())
+
+    async def serve(self, host=None, port=QUEUE_PORT):
+        """Serves the dependency graph to workers connecting on the passed
+        address, until every Job has finished, or a Job has failed and the
+        running Jobs have finished, then tells each worker to stop.
+
+        - host           Address to listen on, or None for all interfaces
+        - port           Port to listen on
+        """
+        self._changed = asyncio.Event()
+        self._t0 = time.time()
+        server = await asyncio.start_server(self.handle_worker, host, port,
+                                            limit=LINE_LIMIT)
+        if self.logger:
+            self.logger.info("Serving jobs to workers on %s" %
+                             ", ".join("%s:%d" % sock.getsockname()[:2] for
+                                       sock in server.sockets))
+        lastreport = time.time()
+        while self.running_count or self._retrying or \
+                (self.tracker.has_ready and not self.failed):
+            try:
+                await asyncio.wait_for(self._changed.wait(),
+                                       aio.PROGRESS_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._changed.clear()
+            if self.logger and time.time() - lastreport > \
+                    aio.PROGRESS_INTERVAL:
+                lastreport = time.time()
+                self.logger.info("%d jobs finished, %d running on %d "
+                                 "workers" % (len(self.retvals),
+                                              self.running_count,
+                                              len(self._workers)))
+        self.done = True
+        for worker in list(self._workers.values()):
+            try:
+                await send_message(worker.writer, {'type': 'stop'})
+            except ConnectionError:
+                pass
+        server.close()
+        if self._handlers:
+            await asyncio.wait(self._handlers, timeout=QUEUE_HEARTBEAT)
+
+    async def handle_worker(self, reader, writer):
+        """Admits a worker connecting with the right token, sends it Jobs
+        and collects their results, until it disconnects or falls silent.
+
+        - reader         asyncio.StreamReader for the connection
+        - writer         asyncio.StreamWriter for the connection
+        """
+        self._handlers.add(asyncio.current_task())
+        peer = writer.get_extra_info('peername')
+        try:
+            hello = await asyncio.wait_for(read_message(reader), self.timeout)
+        except (asyncio.TimeoutError, ConnectionError, ValueError):
+            hello = None
+        if not isinstance(hello, dict) or hello.get('type') != 'hello' or \
+                not hmac.compare_digest(str(hello.get('token')).encode(),
+                                        self.token.encode()):
+            if self.logger:
+                self.logger.warning("Refused connection from %s" % (peer,))
+            writer.close()
+            self._handlers.discard(asyncio.current_task())
+            return
+        self._connections += 1
+        worker = WorkerState("%s#%d" % (hello.get('name'), self._connections),
+                             writer, max(1, int(hello.get('cores', 1))))
+        self._workers[worker.name] = worker
+        if self.logger:
+            self.logger.info("Worker %s joined with %d cores" %
+                             (worker.name, worker.cores))
+        try:
+            await send_message(writer, {'type': 'welcome',
+                                        'cwd': os.getcwd(),
+                                        'logdir': self.logdir,
+                                        'heartbeat': QUEUE_HEARTBEAT})
+            await self.dispatch()
+            while not self.done:
+                message = await asyncio.wait_for(read_message(reader),
+                                                 self.timeout)
+                if message is None:
+                    break
+                if message.get('type') == 'result':
+                    await self.finish(worker, message)
+        except (asyncio.TimeoutError, asyncio.CancelledError,
+                ConnectionError, ValueError, KeyError):
+            pass
+        finally:
+            await self.lose(worker)
+            writer.close()
+            self._handlers.discard(asyncio.current_task())
+
+    async def dispatch(self):
+        """Sends ready Jobs to the workers with the most free cores, until
+        no Jobs are ready or no cores are free.
+        """
+        while not self.failed and self.tracker.has_ready:
+            worker = max(self._workers.values(), key=lambda w: w.free,
+                         default=None)
+            if worker is None or worker.free < 1:
+                return
+            waiting = self.tracker.ready_count
+            job = self.tracker.pop_ready(1)[0]
+            threads = jobs.allocate_threads(job, worker.free, waiting)
+            worker.free -= threads
+            worker.running[job.name] = (job, threads)
+            job.stats['queue_wait'] = time.time() - \
+                self._readytimes.pop(job, self._t0)
+            if self.costs is not None:
+                job.stats['estimate'] = self.costs(job)
+            command = job.get_command(threads)
+            if self.logger:
+                self.logger.info("Starting %s on %s (%d cores): %s" %
+                                 (job.name, worker.name, threads, command))
+            try:
+                await send_message(worker.writer,
+                                   {'type': 'job', 'name': job.name,
+                                    'command': command, 'threads': threads})
+            except ConnectionError:
+                worker.free = 0  # Jobs are requeued when the worker is lost
+
+    async def finish(self, worker, message):
+        """Records the result of a Job reported by a worker, and releases
+        the Jobs depending on it.
+
+        - worker         WorkerState of the reporting worker
+        - message        'result' message from the worker
+        """
+        job, threads = worker.running.pop(message['name'])
+        worker.free += threads
+        retval = message['exit_code']
+        self._attempts[job.name] += 1
+        job.stats.update(message.get('stats', {}))
+        job.stats.update({'exit_code': retval, 'host': worker.name,
+                          'attempts': self._attempts[job.name]})
+        if retval and self._attempts[job.name] <= self.retries:
+            self.__schedule_retry(job, retval)
+        else:
+            self.__record(job, retval)
+        if not retval:
+            self._readytimes.update((child, time.time()) for child in
+                                    self.tracker.complete(job))
+        await self.dispatch()
+        self._changed.set()
+
+    async def lose(self, worker):
+        """Removes a disconnected worker, returning the Jobs it was running
+        to the ready queue, or failing those lost too often.
+
+        - worker         WorkerState of the lost worker
+        """
+        del self._workers[worker.name]
+        if self.done:
+            return
+        if self.logger:
+            self.logger.warning("Lost worker %s, running %d jobs" %
+                                (worker.name, len(worker.running)))
+        for job, threads in worker.running.values():
+            self._losses[job.name] += 1
+            if self._losses[job.name] > MAX_LOSSES:
+                job.stats['exit_code'] = -1
+                self.__record(job, -1)
+                continue
+            if self.logger:
+                self.logger.warning("Requeueing %s" % job.name)
+            self._readytimes[job] = time.time()
+            self.tracker.requeue(job)
+        worker.running = {}
+        await self.dispatch()
+        self._changed.set()
+
+    def __schedule_retry(self, job, retval):
+        """Return the passed failed Job to the ready queue after a delay
+        doubling with each attempt.
+
+        - job            Job that has failed
+        - retval         Exit value of the Job
+        """
+        attempt = self._attempts[job.name]
+        delay = self.backoff * 2 ** (attempt - 1)
+        if self.logger:
+            self.logger.warning("%s returned nonzero (%s); retry %d of %d in "
+                                "%.0fs" % (job.name, retval, attempt,
+                                           self.retries, delay))
+        self._retrying += 1
+        asyncio.get_running_loop().call_later(
+            delay, lambda: asyncio.ensure_future(self.__retry(job, retval)))
+
+    async def __retry(self, job, retval):
+        """Return the passed Job to the ready queue, and send it to a
+        worker if one has cores free. If another Job has failed, so that no
+        more Jobs are to be sent, the Job is recorded as failed instead.
+
+        - job            Job to be retried
+        - retval         Exit value of the Job's last attempt
+        """
+        self._retrying -= 1
+        if self.failed:
+            self.__record(job, retval)
+        elif not self.done:
+            self._readytimes[job] = time.time()
+            self.tracker.requeue(job)
+            await self.dispatch()
+        self._changed.set()
+
+    def __record(self, job, retval):
+        """Record the exit value of a finished Job, failing the Jobs that
+        depend on it if it is nonzero.
+
+        - job            Job that has finished
+        - retval         Exit value of the Job
+        """
+        self.retvals[job.name] = retval
+        job.stats['status'] = 'failed' if retval else 'done'
+        if self.callback is not None:
+            self.callback(job, retval)
+        if retval:
+            if self.logger:
+                self.logger.error("%s returned nonzero (%s)" %
+                                  (job.name, retval))
+            self.failed = self.failed or not self.keep_going
+            blocked = self.tracker.fail(job)
+            for child in blocked:
+                child.stats['status'] = 'blocked'
+            if self.logger and blocked:
+                self.logger.warning("Blocked %d jobs depending on %s" %
+                                    (len(blocked), job.name))
+
+
+# Run a job dependency graph on connected workers
+def run_dependency_graph(jobgraph, token, host=None, port=QUEUE_PORT,
+                         logdir=None, logger=None, callback=None,
+                         keep_going=False, costs=None, timeout=QUEUE_TIMEOUT,
+                         retries=0, backoff=RETRY_BACKOFF):
+    """Serves the Jobs in the passed dependency graph to workers connecting
+    on host:port, returning a dictionary of exit values keyed by job name.
+
+    - jobgraph - dependency graph of Job objects as list of Jobs
+    - token - string workers must present to be sent Jobs
+    - host - address to listen on, or None for all interfaces
+    - port - port to listen on
+    - logdir - path to directory for per-job log files, or None
+    - logger - logger object
+    - callback - function called with (job, exit value) as each Job finishes
+    - keep_going - if True, carry on running Jobs after a failure
+    - costs - function returning the estimated CPU time of a Job, or None
+    - timeout - seconds of silence before a worker is taken to be lost
+    - retries - most times to rerun a Job after a failure
+    - backoff - seconds to wait before a Job's first retry, doubling for
+      each retry after
+
+    As for aio.run_dependency_graph(), each Job is sent to a worker as soon
+    as its dependencies have completed and a worker has a core free, and if
+    a Job still returns a nonzero exit value after its retries, no further
+    Jobs are sent, unless keep_going is True, in which case only the Jobs
+    depending on it are not run, and are marked as blocked. The run waits
+    for as long as it takes workers to connect.
+    """
+    if logdir is not None:
+        os.makedirs(logdir, exist_ok=True)
+    coordinator = Coordinator(jobgraph, token, logdir, logger, callback,
+                              keep_going, costs, timeout, retries, backoff)
+    asyncio.run(coordinator.serve(host, port))
+    return coordinator.retvals
+
+
+# Run Jobs sent by a coordinator until told to stop
+def run_worker(address, token, cores=None, name=None, wait=QUEUE_TIMEOUT,
+               logger=None):
+    """Connects to the coordinator at address, and runs the Jobs it sends
+    as local subprocesses until it says to stop or is lost. Returns the
+    number of Jobs run, or None if the coordinator could not be reached or
+    refused the connection.
+
+    - address - coordinator address, 'HOST:PORT'
+    - token - string shared with the coordinator
+    - cores - number of cores to offer (defaults to CPU count)
+    - name - name reported to the coordinator (defaults to host name)
+    - wait - seconds to keep trying to connect, if the coordinator is not
+      yet listening
+    - logger - logger object
+    """
+    host, port = parse_address(address)
+    return asyncio.run(__run_worker(host, port, token,
+                                    cores or multiprocessing.cpu_count(),
+                                    name or socket.gethostname(), wait,
+                                    logger))
+
+
+# Coroutine connecting to a coordinator and running its Jobs
+async def __run_worker(host, port, token, cores, name, wait, logger):
+    """Runs Jobs from the coordinator at host:port; see run_worker().
+
+    - host - coordinator host
+    - port - coordinator port
+    - token - string shared with the coordinator
+    - cores - number of cores to offer
+    - name - name reported to the coordinator
+    - wait - seconds to keep trying to connect
+    - logger - logger object
+    """
+    deadline = time.time() + wait
+    while True:
+        try:
+            reader, writer = await asyncio.open_connection(host, port,
+                                                           limit=LINE_LIMIT)
+            break
+        except OSError:
+            if time.time() > deadline:
+                if logger:
+                    logger.error("Could not connect to %s:%d" % (host, port))
+                return None
+            await asyncio.sleep(1)
+    await send_message(writer, {'type': 'hello', 'name': name,
+                                'cores': cores, 'token': token})
+    try:
+        welcome = await read_message(reader)
+    except (ConnectionError, ValueError):
+        welcome = None
+    if welcome is None or welcome.get('type') != 'welcome':
+        if logger:
+            logger.error("Coordinator at %s:%d refused connection" %
+                         (host, port))
+        writer.close()
+        return None
+    if logger:
+        logger.info("Connected to %s:%d with %d cores" % (host, port, cores))
+    if os.path.isdir(welcome['cwd']):
+        os.chdir(welcome['cwd'])
+    elif logger:
+        logger.warning("Coordinator directory %s not found; running jobs "
+                       "in %s" % (welcome['cwd'], os.getcwd()))
+    logdir = welcome['logdir']
+    if logdir is not None:
+        os.makedirs(logdir, exist_ok=True)
+    executor = ThreadPoolExecutor(max_workers=cores)
+    heartbeat = asyncio.ensure_future(__send_heartbeats(writer,
+                                                        welcome['heartbeat']))
+    tasks = set()
+    count = 0
+    try:
+        while True:
+            try:
+                message = await read_message(reader)
+            except (ConnectionError, ValueError):
+                message = None
+            if message is None:
+                if logger:
+                    logger.warning("Lost connection to coordinator")
+                break
+            if message['type'] == 'stop':
+                break
+            if message['type'] == 'job':
+                task = asyncio.ensure_future(__run_and_report(
+                    message, writer, logdir, executor, logger))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                count += 1
+    finally:
+        heartbeat.cancel()
+        writer.close()
+        executor.shutdown(wait=False)
+    if logger:
+        logger.info("Ran %d jobs" % count)
+    return count
+
+
+# Run one Job for the coordinator, and report its result
+async def __run_and_report(message, writer, logdir, executor, logger):
+    """Runs the Job in a 'job' message, and sends its exit value and
+    resource use back to the coordinator.
+
+    - message - 'job' message from the coordinator
+    - writer - asyncio.StreamWriter for the coordinator connection
+    - logdir - path to directory for per-job log files, or None
+    - executor - concurrent.futures executor in which to wait for the Job
+    - logger - logger object
+    """
+    job = jobs.Job(message['name'], message['command'])
+    if logger:
+        logger.info("Starting %s (%d cores): %s" % (job.name,
+                                                   message['threads'],
+                                                   job.command))
+    retval = await aio.run_job(job, message['threads'], logdir, executor)
+    if logger:
+        logger.info("%s finished (%s)" % (job.name, retval))
+    try:
+        await send_message(writer, {'type': 'result', 'name': job.name,
+                                    'exit_code': retval, 'stats': job.stats})
+    except ConnectionError:
+        pass
+
+
+# Send heartbeats to the coordinator
+async def __send_heartbeats(writer, interval):
+    """Sends a heartbeat message to the coordinator every interval seconds,
+    until the connection closes.
+
+    - writer - asyncio.StreamWriter for the coordinator connection
+    - interval - seconds between heartbeats
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await send_message(writer, {'type': 'heartbeat'})
+        except ConnectionError:
+            return
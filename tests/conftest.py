@@ -0,0 +1,44 @@
+# Copyright 2015-2016 The James Hutton Institute
+# Author: Leighton Pritchard
+#
+# conftest.py
+#
+# This code is part of the pyrbbh package, and is governed by its licence.
+# Please see the LICENSE file that should have been included as part of this
+# package.
+
+"""Shared fixtures for the pyrbbh tests.
+
+External tools (qsub, qstat, search executables) are replaced by stub
+scripts written to a temporary directory, so that the tests run without a
+scheduler or search tools installed.
+"""
+
+import os
+import stat
+import sys
+
+import pytest
+
+# Put the pyrbbh package on the path, wherever the tests are run from
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+
+@pytest.fixture
+def stub(tmp_path):
+    """Returns a function writing a stub executable, run by this Python
+    interpreter, to a bin directory in tmp_path, and returning its path.
+
+    The function takes the stub's name and its Python source.
+    """
+    bindir = tmp_path / 'bin'
+    bindir.mkdir(exist_ok=True)
+
+    def write_stub(name, source):
+        path = bindir / name
+        path.write_text("#!%s\n%s" % (sys.executable, source))
+        path.chmod(path.stat().st_mode | stat.S_IXUSR)
+        return str(path)
+
+    return write_stub
@@ -0,0 +1,176 @@
+# Copyright 2015-2016 The James Hutton Institute
+# Author: Leighton Pritchard
+#
+# test_engines.py
+#
+# This code is part of the pyrbbh package, and is governed by its licence.
+# Please see the LICENSE file that should have been included as part of this
+# package.
+
+"""Tests of the DIAMOND and VSEARCH search engines, running the job graph
+for a pair of genomes against stub diamond and vsearch executables.
+
+Each stub parses the command line its engine builds, as the real tool
+would, writes the database file it names, and for a search writes one hit,
+from the first sequence of the query file to the first sequence of the
+database, with the output fields requested, in order. A stub exits with an
+error on an option or field its tool does not have.
+"""
+
+import os
+
+import pandas as pd
+import pytest
+
+from pyrbbh import aio, blast, engines, hittable, rbh
+
+# Value written by the stubs for each output field of DIAMOND and VSEARCH
+FIELD_VALUES = """
+VALUES = {'qlen': 100, 'slen': 100, 'bitscore': 200.5, 'length': 100,
+          'nident': 95, 'pident': 95.0, 'qcovhsp': 98.0, 'qstart': 1,
+          'qend': 100, 'sstart': 1, 'send': 100,
+          'ql': 100, 'tl': 100, 'raw': 200, 'alnlen': 100, 'ids': 95,
+          'id': 95.0, 'qcov': 98.0, 'qlo': 1, 'qhi': 100, 'tlo': 1,
+          'thi': 100}
+
+
+def first_id(fname):
+    with open(fname) as fh:
+        return fh.readline()[1:].split()[0]
+
+
+def write_hit(qfile, dbname, fields, outfile):
+    ids = {'qseqid': first_id(qfile), 'query': first_id(qfile),
+           'sseqid': first_id(dbname), 'target': first_id(dbname)}
+    row = '\\t'.join(str(ids[field] if field in ids else VALUES[field])
+                     for field in fields)
+    if outfile is None or outfile == '/dev/stdout':
+        print(row)
+    else:
+        with open(outfile, 'w') as ofh:
+            ofh.write(row + '\\n')
+"""
+
+DIAMOND_STUB = """
+import argparse
+import shutil
+import sys
+%s
+command = sys.argv[1]
+parser = argparse.ArgumentParser()
+parser.add_argument('--db', required=True)
+parser.add_argument('--threads', type=int)
+if command == 'makedb':
+    parser.add_argument('--in', dest='infile', required=True)
+    args = parser.parse_args(sys.argv[2:])
+    shutil.copy(args.infile, args.db + '.dmnd')
+elif command == 'blastp':
+    parser.add_argument('--query', required=True)
+    parser.add_argument('--out')
+    parser.add_argument('--max-target-seqs', type=int)
+    parser.add_argument('--outfmt', nargs='+', required=True)
+    args = parser.parse_args(sys.argv[2:])
+    assert args.outfmt[0] == '6'
+    write_hit(args.query, args.db + '.dmnd', args.outfmt[1:], args.out)
+else:
+    sys.exit(1)
+""" % FIELD_VALUES
+
+VSEARCH_STUB = """
+import argparse
+import shutil
+import sys
+%s
+parser = argparse.ArgumentParser()
+parser.add_argument('--makeudb_usearch')
+parser.add_argument('--output')
+parser.add_argument('--usearch_global')
+parser.add_argument('--db')
+parser.add_argument('--id', type=float)
+parser.add_argument('--maxaccepts', type=int)
+parser.add_argument('--userout')
+parser.add_argument('--userfields')
+parser.add_argument('--threads', type=int)
+args = parser.parse_args()
+if args.makeudb_usearch:
+    shutil.copy(args.makeudb_usearch, args.output)
+else:
+    write_hit(args.usearch_global, args.db, args.userfields.split('+'),
+              args.userout)
+""" % FIELD_VALUES
+
+
+@pytest.fixture
+def genomes(tmp_path, monkeypatch):
+    """Returns a list of paths to two single-sequence FASTA files, with the
+    working directory set to tmp_path and an output directory 'out'.
+    """
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('in')
+    os.makedirs(os.path.join('out', 'logs'))
+    infiles = []
+    for stem in ('genomeA', 'genomeB'):
+        fname = os.path.join('in', stem + '.fasta')
+        with open(fname, 'w') as ofh:
+            ofh.write(">%s_1\nMKVLAAGIVGLLLAAQ\n" % stem)
+        infiles.append(fname)
+    return infiles
+
+
+@pytest.fixture(params=['diamond', 'vsearch'])
+def engine(request, stub):
+    """Returns each search engine, running its stub executable."""
+    source = DIAMOND_STUB if request.param == 'diamond' else VSEARCH_STUB
+    exe = stub(request.param, source)
+    return engines.get_engine(request.param, exe, exe)
+
+
+def test_fields_map_every_column(engine):
+    """Each engine writes an output field for every hit table column."""
+    fields = engine.fields(blast.BLASTP_COLUMNS)
+    assert len(fields) == len(blast.BLASTP_COLUMNS)
+    if engine.name == 'diamond':
+        assert fields[blast.BLASTP_COLUMNS.index('qcovs')] == 'qcovhsp'
+    else:
+        assert '+'.join(fields).startswith('query+target+ql+tl+raw')
+
+
+@pytest.mark.parametrize('binary', [False, True])
+def test_search_jobs(engine, genomes, binary):
+    """Database, search and RBH jobs run against the stub, and each hit
+    table has the normalised columns, as text or binary hit table."""
+    joblist = blast.make_blast_jobs(genomes, 'out', jobprefix='T',
+                                    engine=engine, binary=binary)
+    assert [job.executable for job in joblist[:2]] == [engine.db_exe] * 2
+    assert all(job.thread_option == engine.thread_option for job in
+               joblist[2:4])
+    retvals = aio.run_dependency_graph(joblist, 2, os.path.join('out',
+                                                                'logs'))
+    assert set(retvals.values()) == {0}, retvals
+    hitsfile = blast.get_blastp_outfile('genomeA', 'genomeB', 'out',
+                                        binary=binary)
+    if binary:
+        hits = hittable.read_hits(hitsfile).to_frame()
+    else:
+        hits = rbh.read_hits(hitsfile)
+    assert list(hits.columns) == list(blast.BLASTP_COLUMNS)
+    assert hits.loc[0, ['qseqid', 'sseqid']].tolist() == ['genomeA_1',
+                                                          'genomeB_1']
+    assert hits.loc[0, 'pident'] == 95.0
+    assert hits.loc[0, 'qcovs'] == 98.0
+    rbhits = pd.read_csv(blast.get_rbh_outfile('genomeA', 'genomeB', 'out'),
+                         sep='\t')
+    assert rbhits[['qseqid', 'sseqid']].values.tolist() == \
+        [['genomeA_1', 'genomeB_1']]
+
+
+def test_streamed_search(engine, genomes):
+    """Search output written to stdout is reduced to best hits."""
+    joblist = blast.make_blast_jobs(genomes, 'out', jobprefix='T',
+                                    engine=engine, stream=True)
+    retvals = aio.run_dependency_graph(joblist, 2, os.path.join('out',
+                                                                'logs'))
+    assert set(retvals.values()) == {0}, retvals
+    best = rbh.read_hits(blast.get_blastp_outfile('genomeB', 'genomeA',
+                                                  'out', stream=True))
+    assert best['qseqid'].tolist() == ['genomeB_1']
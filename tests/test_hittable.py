@@ -0,0 +1,75 @@
+# Copyright 2015-2016 The James Hutton Institute
+# Author: Leighton Pritchard
+#
+# test_hittable.py
+#
+# This code is part of the pyrbbh package, and is governed by its licence.
+# Please see the LICENSE file that should have been included as part of this
+# package.
+
+"""Tests of the binary hit table format: writing search output a chunk at
+a time, and reading columns back without copying them.
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from pyrbbh import hittable
+
+# A row of numeric BLASTP columns, following the sequence IDs
+NUMERIC_ROW = '\t'.join(['100', '120', '200.5', '90', '80', '88.9', '75',
+                         '75', '1', '90', '1', '90'])
+
+
+def write_text_hits(path, nrows):
+    """Writes nrows HSPs of BLASTP tabular output to path, with repeated
+    sequence IDs, and returns its path as a string.
+    """
+    path.write_text(''.join("q%d\ts%d\t%s\n" % (idx % 7, idx % 3, NUMERIC_ROW)
+                            for idx in range(nrows)))
+    return str(path)
+
+
+def test_chunked_conversion(tmp_path):
+    """Search output converted a chunk at a time reads back as the whole
+    text table, with IDs interned across chunks."""
+    textfile = write_text_hits(tmp_path / 'hits.tab', 25)
+    outfile = str(tmp_path / 'hits.hits')
+    writer = hittable.HitWriter(outfile)
+    for hits in hittable.read_text_chunks(textfile, chunksize=4):
+        writer.write(hits)
+    writer.close()
+    table = hittable.read_hits(outfile)
+    expected = hittable.read_text_hits(textfile)
+    pd.testing.assert_frame_equal(table.to_frame().astype(expected.dtypes),
+                                  expected)
+    assert list(table.names('qseqid')) == ['q%d' % idx for idx in range(7)]
+    assert sorted(os.listdir(str(tmp_path))) == ['hits.hits', 'hits.tab']
+
+
+def test_to_frame_shares_memory(tmp_path):
+    """Numeric columns of to_frame() are views of the mapped file."""
+    outfile = str(tmp_path / 'hits.hits')
+    hittable.convert_hits([write_text_hits(tmp_path / 'hits.tab', 10)],
+                          outfile)
+    table = hittable.read_hits(outfile)
+    frame = table.to_frame()
+    for col in frame.columns:
+        if col not in hittable.ID_COLUMNS:
+            assert np.shares_memory(frame[col].to_numpy(), table.column(col))
+
+
+def test_run_converted(tmp_path):
+    """A wrapped command's output is written as a hit table if it succeeds,
+    and nothing is written if it fails."""
+    textfile = write_text_hits(tmp_path / 'hits.tab', 10)
+    outfile = str(tmp_path / 'hits.hits')
+    assert hittable.run_converted(['cat', textfile], outfile) == 0
+    assert len(hittable.read_hits(outfile)) == 10
+    failfile = str(tmp_path / 'fail.hits')
+    assert hittable.run_converted([sys.executable, '-c',
+                                   'import sys; sys.exit(4)'], failfile) == 4
+    assert sorted(os.listdir(str(tmp_path))) == ['hits.hits', 'hits.tab']
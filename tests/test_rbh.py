@@ -0,0 +1,40 @@
+# Copyright 2015-2016 The James Hutton Institute
+# Author: Leighton Pritchard
+#
+# test_rbh.py
+#
+# This code is part of the pyrbbh package, and is governed by its licence.
+# Please see the LICENSE file that should have been included as part of this
+# package.
+
+"""Tests of calling reciprocal best hits for a pair of genomes, as an RBH
+job does, and adding them to the results store from the tables it writes.
+"""
+
+from pyrbbh import blast, rbh, store
+
+# A row of numeric BLASTP columns, following the sequence IDs
+NUMERIC_ROW = '\t'.join(['100', '120', '200.5', '90', '80', '88.9', '75',
+                         '75', '1', '90', '1', '90'])
+
+
+def test_best_hits_loaded_into_store(tmp_path):
+    """Best hits written with the RBH table fill the store as if the job
+    had written to it directly."""
+    fwdfile, revfile = tmp_path / 'A_vs_B.tab', tmp_path / 'B_vs_A.tab'
+    fwdfile.write_text("a1\tb1\t%s\na2\tb2\t%s\n" % (NUMERIC_ROW,
+                                                     NUMERIC_ROW))
+    revfile.write_text("b1\ta1\t%s\n" % NUMERIC_ROW)
+    rbhfile = blast.get_rbh_outfile('A', 'B', str(tmp_path))
+    bestfiles = blast.get_besthits_outfiles('A', 'B', str(tmp_path))
+    direct = store.ResultStore(str(tmp_path / 'direct.sqlite'))
+    rbh.call_pair(str(fwdfile), str(revfile), rbhfile, 0.8, 0.7,
+                  direct.filename, ('A', 'B'), bestfiles=bestfiles)
+    loaded = store.ResultStore(str(tmp_path / 'loaded.sqlite'))
+    loaded.add_pair('A', 'B', rbh.read_rbh(bestfiles[0]),
+                    rbh.read_rbh(bestfiles[1]), rbh.read_rbh(rbhfile))
+    for seqid in ('a1', 'a2', 'b1'):
+        assert loaded.best_hits(seqid).equals(direct.best_hits(seqid))
+    assert loaded.orthologues('b1').values.tolist() == \
+        [['B', 'b1', 'A', 'a1', 88.9, 200.5]]
+    assert loaded.pair('A', 'B').equals(direct.pair('A', 'B'))
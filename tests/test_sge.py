@@ -0,0 +1,255 @@
+# Copyright 2015-2016 The James Hutton Institute
+# Author: Leighton Pritchard
+#
+# test_sge.py
+#
+# This code is part of the pyrbbh package, and is governed by its licence.
+# Please see the LICENSE file that should have been included as part of this
+# package.
+
+"""Tests of SGE array job submission and monitoring, against stub qsub and
+qstat executables.
+
+The stub qsub logs its arguments and runs each task of the submitted array
+at once, in task ID order, so that arrays submitted level by level run in
+dependency order. Setting STUB_QSUB_FAIL to an array name makes its
+submission fail, and STUB_QSUB_LOSE makes its tasks leave the queue
+without running. The stub qstat lists the job names in STUB_QSTAT_QUEUED,
+or fails if STUB_QSTAT_FAIL is set. The monitor's polling floor is lowered
+so that the tests do not wait between polls.
+"""
+
+import os
+
+import pytest
+
+from pyrbbh import jobs, monitor, sge
+
+QSUB_STUB = """
+import os
+import subprocess
+import sys
+
+args = sys.argv[1:]
+with open(os.environ['STUB_QSUB_LOG'], 'a') as ofh:
+    ofh.write(' '.join(args) + '\\n')
+name = args[args.index('-N') + 1]
+if name == os.environ.get('STUB_QSUB_FAIL'):
+    sys.exit(1)
+if name != os.environ.get('STUB_QSUB_LOSE'):
+    first, last = args[args.index('-t') + 1].split('-')
+    for taskid in range(int(first), int(last) + 1):
+        subprocess.call(['sh', args[-1]],
+                        env=dict(os.environ, SGE_TASK_ID=str(taskid)))
+print(name)
+"""
+
+QSTAT_STUB = """
+import os
+import sys
+
+if os.environ.get('STUB_QSTAT_FAIL'):
+    sys.exit(1)
+names = [name for name in os.environ.get('STUB_QSTAT_QUEUED', '').split(',')
+         if name]
+print("<?xml version='1.0'?><job_info><queue_info>%s</queue_info>"
+      "<job_info></job_info></job_info>" %
+      ''.join('<job_list><JB_name>%s</JB_name></job_list>' % name for name in
+              names))
+"""
+
+
+@pytest.fixture
+def scheduler(stub, tmp_path, monkeypatch):
+    """Returns a tuple of paths to stub (qsub, qstat) executables, with the
+    working directory set to tmp_path and qsub calls logged to qsub.log.
+    """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(monitor, 'SGE_POLL_MIN', 0.01)
+    monkeypatch.setenv('STUB_QSUB_LOG', str(tmp_path / 'qsub.log'))
+    for name in ('STUB_QSUB_FAIL', 'STUB_QSUB_LOSE', 'STUB_QSTAT_QUEUED',
+                 'STUB_QSTAT_FAIL'):
+        monkeypatch.delenv(name, raising=False)
+    return stub('qsub', QSUB_STUB), stub('qstat', QSTAT_STUB)
+
+
+def make_jobgraph():
+    """Returns a two-level job graph: a job writing a file, and two jobs
+    depending on it that copy the file.
+    """
+    first = jobs.Job('first', 'echo data > first.txt')
+    graph = [first]
+    for idx in range(2):
+        job = jobs.Job('second%d' % idx, 'cp first.txt second%d.txt' % idx)
+        job.add_dependency(first)
+        graph.append(job)
+    return graph
+
+
+def read_qsub_log(tmp_path):
+    """Returns the list of qsub argument lists logged by the stub."""
+    with open(tmp_path / 'qsub.log') as fh:
+        return [line.split() for line in fh]
+
+
+def test_create_arrays_longest_first():
+    """Jobs at each level are split into arrays of at most maxtasks Jobs,
+    longest first when costs are given."""
+    graph = [jobs.Job('j%d' % idx, 'true') for idx in range(4)]
+    costs = {'j0': 1, 'j1': 4, 'j2': 3, 'j3': 2}
+    levels = sge.create_arrays(graph, 'T', 3,
+                               costs=lambda job: costs[job.name])
+    assert [[(name, [job.name for job in tasks]) for name, tasks in level]
+            for level in levels] == [[('T_L00_000', ['j1', 'j2', 'j3']),
+                                      ('T_L00_001', ['j0'])]]
+
+
+def test_run_dependency_graph(scheduler, tmp_path):
+    """Each level is submitted as one array, held on the level before, and
+    every Job's exit code is read from its sentinel file."""
+    qsub, qstat = scheduler
+    finished = []
+    retvals = sge.run_dependency_graph(make_jobgraph(), str(tmp_path), 'T',
+                                       qsub, qstat,
+                                       callback=lambda job, retval:
+                                       finished.append((job.name, retval)))
+    assert retvals == {'first': 0, 'second0': 0, 'second1': 0}
+    assert sorted(finished) == sorted(retvals.items())
+    assert (tmp_path / 'second1.txt').read_text() == 'data\n'
+    calls = read_qsub_log(tmp_path)
+    assert [call[call.index('-N') + 1] for call in calls] == ['T_L00_000',
+                                                              'T_L01_000']
+    assert '-hold_jid' not in calls[0]
+    assert calls[1][calls[1].index('-hold_jid') + 1] == 'T_L00_000'
+    assert calls[1][calls[1].index('-t') + 1] == '1-2'
+    statusdir = tmp_path / sge.SGE_DIRNAME / sge.STATUS_DIRNAME
+    assert sorted(os.listdir(statusdir)) == ['T_L00_000.1', 'T_L01_000.1',
+                                             'T_L01_000.2']
+
+
+def test_failed_task(scheduler, tmp_path):
+    """A task's nonzero exit code is reported for its Job."""
+    qsub, qstat = scheduler
+    graph = [jobs.Job('ok', 'true'), jobs.Job('bad', 'exit 3')]
+    retvals = sge.run_dependency_graph(graph, str(tmp_path), 'T', qsub,
+                                       qstat)
+    assert retvals == {'ok': 0, 'bad': 3}
+    assert graph[1].stats['exit_code'] == 3
+
+
+def test_blocked_tasks(scheduler, tmp_path):
+    """Jobs depending, directly or not, on a failed Job are not run, and are
+    marked blocked with no exit value."""
+    qsub, qstat = scheduler
+    graph = [jobs.Job('first', 'exit 3'), jobs.Job('second', 'touch s.txt'),
+             jobs.Job('third', 'touch third.txt'), jobs.Job('other', 'true')]
+    graph[1].add_dependency(graph[0])
+    graph[2].add_dependency(graph[1])
+    retvals = sge.run_dependency_graph(graph, str(tmp_path), 'T', qsub,
+                                       qstat)
+    assert retvals == {'first': 3, 'other': 0}
+    assert [job.stats['status'] for job in graph] == ['failed', 'blocked',
+                                                      'blocked', 'done']
+    assert not (tmp_path / 's.txt').exists()
+    assert not (tmp_path / 'third.txt').exists()
+
+
+def test_submission_failure(scheduler, tmp_path, monkeypatch):
+    """Nothing more is submitted after a failed qsub, and unsubmitted Jobs
+    are reported with exit value -1."""
+    qsub, qstat = scheduler
+    monkeypatch.setenv('STUB_QSUB_FAIL', 'T_L01_000')
+    retvals = sge.run_dependency_graph(make_jobgraph(), str(tmp_path), 'T',
+                                       qsub, qstat)
+    assert retvals == {'first': 0, 'second0': -1, 'second1': -1}
+
+
+def test_lost_task(scheduler, tmp_path, monkeypatch):
+    """A task leaving the queue without writing a sentinel is reported with
+    exit value 1."""
+    qsub, qstat = scheduler
+    monkeypatch.setenv('STUB_QSUB_LOSE', 'T_L00_000')
+    retvals = sge.run_dependency_graph([jobs.Job('lost', 'true')],
+                                       str(tmp_path), 'T', qsub, qstat)
+    assert retvals == {'lost': 1}
+
+
+def test_reused_prefix(scheduler, tmp_path, monkeypatch):
+    """Sentinels left by an earlier run with the same prefix are not read
+    as the exit codes of this run's tasks."""
+    qsub, qstat = scheduler
+    retvals = sge.run_dependency_graph([jobs.Job('a', 'echo 1 > a.txt')],
+                                       str(tmp_path), 'X', qsub, qstat)
+    assert retvals == {'a': 0}
+    monkeypatch.setenv('STUB_QSUB_LOSE', 'X_L00_000')
+    retvals = sge.run_dependency_graph([jobs.Job('b', 'exit 5')],
+                                       str(tmp_path), 'X', qsub, qstat)
+    assert retvals == {'b': 1}
+
+
+def test_monitor_poll(scheduler, tmp_path, monkeypatch):
+    """A poll reports watched jobs with sentinels, and keeps watching queued
+    jobs; jobs that have left the queue without a sentinel are reported
+    lost only on the second listing that misses them."""
+    qsub, qstat = scheduler
+    monkeypatch.setenv('STUB_QSTAT_QUEUED', 'arrayA,arrayB')
+    (tmp_path / 'arrayA.1').write_text('0\n')
+    (tmp_path / 'arrayA.2').write_text('2\n')
+    jobmonitor = monitor.JobMonitor(str(tmp_path), qstat, qstat_every=1)
+    for name in ('arrayA.1', 'arrayA.2', 'arrayA.3'):
+        jobmonitor.watch(name, 'arrayA')
+    jobmonitor.watch('arrayC.1', 'arrayC')
+    jobmonitor.watch('arrayC.2', 'arrayC')
+    assert sorted(jobmonitor.poll(), key=lambda event: event[0]) == \
+        [('arrayA.1', 0), ('arrayA.2', 2)]
+    assert jobmonitor.outstanding == 3
+    (tmp_path / 'arrayC.2').write_text('0\n')  # seen late, e.g. over NFS
+    assert sorted(jobmonitor.poll(), key=lambda event: event[0]) == \
+        [('arrayC.1', None), ('arrayC.2', 0)]
+    assert jobmonitor.outstanding == 1
+    assert jobmonitor.poll() == []
+
+
+def test_monitor_qstat_every(scheduler, tmp_path, monkeypatch):
+    """The queue is listed only every qstat_every polls, while sentinels are
+    read at every poll, and the polling interval has a floor."""
+    qsub, qstat = scheduler
+    jobmonitor = monitor.JobMonitor(str(tmp_path), qstat, qstat_every=3)
+    calls = []
+    monkeypatch.setattr(jobmonitor, 'get_queued',
+                        lambda: calls.append(1) or set())
+    jobmonitor.watch('j1')
+    for _ in range(4):
+        jobmonitor.poll()
+    assert len(calls) == 2 and jobmonitor.outstanding == 0
+    monkeypatch.setattr(monitor, 'SGE_POLL_MIN', 5)
+    assert monitor.JobMonitor(interval=0.01).interval == 5
+
+
+def test_monitor_qstat_failure(scheduler, tmp_path, monkeypatch):
+    """A failed qstat call is treated as transient: no job is reported lost,
+    but sentinels are still read."""
+    qsub, qstat = scheduler
+    monkeypatch.setenv('STUB_QSTAT_FAIL', '1')
+    (tmp_path / 'done').write_text('0\n')
+    jobmonitor = monitor.JobMonitor(str(tmp_path), qstat)
+    jobmonitor.watch('done')
+    jobmonitor.watch('running')
+    assert jobmonitor.get_queued() is None
+    assert jobmonitor.poll() == [('done', 0)]
+    assert jobmonitor.outstanding == 1
+
+
+def test_monitor_wait(scheduler, tmp_path, monkeypatch):
+    """wait() returns every watched job's exit code, calling back as each
+    completes."""
+    qsub, qstat = scheduler
+    (tmp_path / 'j1').write_text('0\n')
+    (tmp_path / 'j2').write_text('1\n')
+    jobmonitor = monitor.JobMonitor(str(tmp_path), qstat, interval=0.01)
+    jobmonitor.watch('j1')
+    jobmonitor.watch('j2')
+    events = []
+    assert jobmonitor.wait(lambda name, retval:
+                           events.append(name)) == {'j1': 0, 'j2': 1}
+    assert sorted(events) == ['j1', 'j2']
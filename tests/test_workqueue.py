@@ -0,0 +1,113 @@
+# Copyright 2015-2016 The James Hutton Institute
+# Author: Leighton Pritchard
+#
+# test_workqueue.py
+#
+# This code is part of the pyrbbh package, and is governed by its licence.
+# Please see the LICENSE file that should have been included as part of this
+# package.
+
+"""Tests of the TCP work queue, with a coordinator and workers on localhost.
+
+The coordinator and each worker run their own event loop, in threads of
+the test process. Heartbeats and the worker timeout are shortened, so that
+a silent worker is lost within a second.
+"""
+
+import json
+import os
+import socket
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from pyrbbh import jobs, workqueue
+
+TOKEN = 'secret'
+
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    """Returns the address of a free localhost port, with the working
+    directory set to tmp_path, and short worker heartbeats.
+    """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(workqueue, 'QUEUE_HEARTBEAT', 0.2)
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return '127.0.0.1', sock.getsockname()[1]
+
+
+def start_coordinator(executor, jobgraph, port, timeout=60):
+    """Returns a future for the exit values of jobgraph, served on port."""
+    return executor.submit(workqueue.run_dependency_graph, jobgraph, TOKEN,
+                           '127.0.0.1', port, 'logs', timeout=timeout)
+
+
+def start_worker(executor, port, name, token=TOKEN):
+    """Returns a future for the number of Jobs run by a worker."""
+    return executor.submit(workqueue.run_worker, '127.0.0.1:%d' % port,
+                           token, 1, name, 10)
+
+
+def test_two_workers(queue):
+    """Jobs are shared between two workers, dependencies are respected, and
+    a worker presenting the wrong token is refused."""
+    host, port = queue
+    first = [jobs.Job('first%d' % idx, 'sleep 0.5; echo %d > first%d.txt' %
+                      (idx, idx)) for idx in range(4)]
+    last = jobs.Job('last', 'cat first*.txt > last.txt')
+    for job in first:
+        last.add_dependency(job)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        coordinator = start_coordinator(executor, first + [last], port)
+        workers = [start_worker(executor, port, 'w%d' % idx) for idx in
+                   range(2)]
+        intruder = start_worker(executor, port, 'intruder', 'wrong')
+        retvals = coordinator.result(timeout=60)
+        counts = [worker.result(timeout=60) for worker in workers]
+    assert retvals == {job.name: 0 for job in first + [last]}
+    assert intruder.result() is None
+    assert sum(counts) == 5 and min(counts) > 0
+    assert set(job.stats['host'].split('#')[0] for job in first) == \
+        {'w0', 'w1'}
+    with open('last.txt') as fh:
+        assert sorted(fh.read().split()) == ['0', '1', '2', '3']
+    assert os.path.isfile(os.path.join('logs', 'last.out'))
+
+
+def test_silent_worker_requeued(queue):
+    """The Job of a worker that falls silent is returned to the queue and
+    run by another worker."""
+    host, port = queue
+    job = jobs.Job('only', 'echo done > only.txt')
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        coordinator = start_coordinator(executor, [job], port, timeout=1)
+        # Connect a worker that takes a Job, then sends nothing more
+        deadline = time.time() + 10
+        while True:
+            try:
+                silent = socket.create_connection((host, port))
+                break
+            except OSError:
+                assert time.time() < deadline
+                time.sleep(0.1)
+        silent.sendall(json.dumps({'type': 'hello', 'name': 'silent',
+                                   'cores': 1, 'token': TOKEN}).encode() +
+                       b'\n')
+        reader = silent.makefile()
+        assert json.loads(reader.readline())['type'] == 'welcome'
+        assert json.loads(reader.readline())['name'] == 'only'
+        assert not os.path.exists('only.txt')
+        # A real worker then runs the Job once the silent worker is lost
+        worker = start_worker(executor, port, 'live')
+        retvals = coordinator.result(timeout=60)
+        assert worker.result(timeout=60) == 1
+        reader.close()
+        silent.close()
+    assert retvals == {'only': 0}
+    assert job.stats['host'].startswith('live#')
+    with open('only.txt') as fh:
+        assert fh.read() == 'done\n'